@@ -1,6 +1,7 @@
 import functools
+import struct
 from enum import Enum
-from typing import Optional, Union, NamedTuple, List
+from typing import Optional, Union, NamedTuple, List, Tuple
 
 from pretty import Pretty
 
@@ -8,29 +9,43 @@ BeltItem = Union['BeltSlice', 'BeltNum']
 
 
 class Belt(Pretty):
-    SIZE = 16
+    SIZE = 16  # must be a power of two, positions are masked onto the ring
+    _MASK = SIZE - 1
+
+    __slots__ = ('_items', '_head')
 
     def __init__(self):
-        self._items: List[BeltItem] = [BeltNum(data_type=DataType.I8, value=Integer(0))] * Belt.SIZE
+        self._items: List[BeltItem] = [BeltNum.of(DataType.I8, 0)] * Belt.SIZE
+        # physical index of logical belt position 0; the belt is a ring and
+        # pushing moves the head one slot back, overwriting the oldest item.
+        self._head = 0
 
     def __getitem__(self, item: int) -> BeltItem:
-        return self._items[item]
+        return self._items[(self._head + item) & Belt._MASK]
 
     def get_num(self, item: int) -> 'BeltNum':
-        item = self._items[item]
+        item = self._items[(self._head + item) & Belt._MASK]
         if isinstance(item, BeltSlice):
             raise ValueError('Expected num, got slice')
         return item
 
     def get_slice(self, item: int) -> 'BeltSlice':
-        item = self._items[item]
+        item = self._items[(self._head + item) & Belt._MASK]
         if isinstance(item, BeltNum):
             raise ValueError('Expected slice, got num')
         return item
 
     def push(self, value: BeltItem):
-        self._items.pop(-1)
-        self._items.insert(0, value)
+        head = (self._head - 1) & Belt._MASK
+        self._head = head
+        self._items[head] = value
+
+    def items(self) -> List[BeltItem]:
+        head = self._head
+        return self._items[head:] + self._items[:head]
+
+    def __repr__(self):
+        return f'Belt({self.items()!r})'
 
 
 class DataType(Enum):
@@ -39,44 +54,91 @@ class DataType(Enum):
     I32 = 32
     I64 = 64
 
+    # precomputed below the class; attributes of members are much cheaper to read than .value or calls to Enum
+    bits: int
+    size: int  # in bytes
+    mask: int  # all bits of the type set
+    sign_bit: int
+    modulus: int  # 1 << bits
+    # indexed by is_signed
+    mod_values: Tuple[int, int]
+    max_values: Tuple[int, int]
+    min_values: Tuple[int, int]
+    # promotions[other.index] is the wider of the two types
+    index: int
+    promotions: List['DataType']
+    # little-endian unsigned layout, for loads and stores in BeltSlices
+    layout: struct.Struct
+
+    # interned BeltNums of this type, set up below BeltNum
+    err_num: 'BeltNum'
+    interned_nums: List['BeltNum']
+
     def mod_value(self, is_signed: bool) -> int:
-        bits = self.value
-        val = 1 << (bits - is_signed)
-        return val
+        return self.mod_values[is_signed]
 
     def max_value(self, is_signed: bool) -> int:
-        bits = self.value
-        val = 1 << (bits - is_signed)
-        return val - 1
+        return self.max_values[is_signed]
 
     def min_value(self, is_signed: bool) -> int:
-        if is_signed:
-            bits = self.value
-            return -(1 << (bits - 1))
-        return 0
+        return self.min_values[is_signed]
 
     def promote(self, other: 'DataType') -> 'DataType':
-        return DataType(max(self.value, other.value))
+        return self.promotions[other.index]
 
     def num_bytes(self) -> int:
-        return self.value // 8
+        return self.size
+
+
+for _index, _data_type in enumerate(DataType):
+    _bits = _data_type.value
+    _data_type.bits = _bits
+    _data_type.size = _bits // 8
+    _data_type.mask = (1 << _bits) - 1
+    _data_type.sign_bit = 1 << (_bits - 1)
+    _data_type.modulus = 1 << _bits
+    _data_type.mod_values = (1 << _bits, 1 << (_bits - 1))
+    _data_type.max_values = ((1 << _bits) - 1, (1 << (_bits - 1)) - 1)
+    _data_type.min_values = (0, -(1 << (_bits - 1)))
+    _data_type.index = _index
+    _data_type.layout = struct.Struct('<' + {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}[_bits])
+for _data_type in DataType:
+    _data_type.promotions = [max(_data_type, _other, key=lambda data_type: data_type.bits) for _other in DataType]
 
 
 class Integer:
+    """
+    Number that is either an int or Err (None). Ops work on the raw ints stored in BeltNum; Integer is the boxed
+    view of them. Err is the shared Integer.ERR and small values are interned, see Integer.of.
+    """
+
+    __slots__ = ('_value',)
+
+    ERR: 'Integer'
+    NUM_INTERNED = 256
+
     def __init__(self, value: Optional[int]):
         self._value = value
 
+    @staticmethod
+    def of(value: Optional[int]) -> 'Integer':
+        if value is None:
+            return Integer.ERR
+        if 0 <= value < Integer.NUM_INTERNED:
+            return _INTERNED_INTEGERS[value]
+        return Integer(value)
+
     @staticmethod
     def _binary_func(f):
         @functools.wraps(f)
         def wrapped(self: 'Integer', other) -> 'Integer':
             if isinstance(other, Integer):
-                if other._value is None:
-                    return Integer(None)
                 other = other._value
+                if other is None:
+                    return Integer.ERR
             if self._value is None:
-                return Integer(None)
-            return Integer(f(self._value, other))
+                return Integer.ERR
+            return Integer.of(f(self._value, other))
         return wrapped
 
     __add__ = _binary_func.__func__(int.__add__)
@@ -115,88 +177,164 @@ class Integer:
         return f'Integer({self._value})'
 
 
-class BeltNum(NamedTuple):
+Integer.ERR = Integer(None)
+_INTERNED_INTEGERS = [Integer(value) for value in range(Integer.NUM_INTERNED)]
+
+
+class BeltNum:
+    """
+    Number on the belt. int_value holds the raw, unsigned bit pattern of the number, or None for Err.
+
+    BeltNums are immutable and shared freely; use BeltNum.of to construct them on hot paths, it returns the interned
+    Err and small values of each DataType without allocating.
+    """
+
+    __slots__ = ('data_type', 'int_value')
+
     data_type: DataType
-    value: Integer
+    int_value: Optional[int]
 
-    def to_signed(self, is_signed: bool) -> 'Integer':
-        if is_signed:
-            val = self.value.to_int()
-            if val is None:
-                return Integer(None)
-            int_bytes = val.to_bytes(self.data_type.num_bytes(), 'little', signed=False)
-            return Integer(int.from_bytes(int_bytes, 'little', signed=True))
-        return self.value
+    def __init__(self, data_type: DataType, value: Integer) -> None:
+        self.data_type = data_type
+        self.int_value = value.to_int()
 
     @staticmethod
-    def from_signed(val: Integer, data_type: DataType, is_signed: bool) -> 'BeltNum':
-        val = val.to_int()
+    def of(data_type: DataType, int_value: Optional[int]) -> 'BeltNum':
+        if int_value is None:
+            return data_type.err_num
+        if 0 <= int_value < Integer.NUM_INTERNED:
+            return data_type.interned_nums[int_value]
+        num = _new_belt_num(BeltNum)
+        num.data_type = data_type
+        num.int_value = int_value
+        return num
+
+    @property
+    def value(self) -> Integer:
+        return Integer.of(self.int_value)
+
+    def expect_int(self) -> int:
+        if self.int_value is None:
+            raise ValueError('Expected int, got Err')
+        return self.int_value
+
+    def to_signed(self, is_signed: bool) -> Optional[int]:
+        val = self.int_value
+        if is_signed and val is not None and val & self.data_type.sign_bit:
+            return val - self.data_type.modulus
+        return val
+
+    @staticmethod
+    def from_signed(val: Optional[int], data_type: DataType, is_signed: bool) -> 'BeltNum':
+        """
+        Inverse of to_signed. Raises OverflowError if val doesn't fit into data_type.
+        """
         if val is None:
-            return BeltNum(data_type=data_type, value=Integer(None))
-        int_bytes = val.to_bytes(data_type.num_bytes(), 'little', signed=is_signed)
-        return BeltNum(
-            data_type=data_type,
-            value=Integer(int.from_bytes(int_bytes, 'little', signed=False))
-        )
+            return data_type.err_num
+        if val > data_type.max_values[is_signed]:
+            raise OverflowError('int too big to convert')
+        if val < data_type.min_values[is_signed]:
+            raise OverflowError('int too big to convert' if is_signed else "can't convert negative int to unsigned")
+        return BeltNum.of(data_type, val & data_type.mask)
 
     def wrap(self, data_type: DataType) -> 'BeltNum':
-        if self.data_type.value < data_type.value:
+        if self.data_type.bits < data_type.bits:
             raise ValueError(f'Cannot use wrap to up-cast value from'
                              f'{self.data_type} to {data_type}')
         if self.data_type == data_type:
             return self
-        return BeltNum(
-            data_type=data_type,
-            value=self.value % data_type.mod_value(False)
-        )
+        val = self.int_value
+        if val is None:
+            return data_type.err_num
+        return BeltNum.of(data_type, val & data_type.mask)
 
     def cast_sat(self, data_type: DataType, is_signed: bool) -> 'BeltNum':
-        if self.data_type.value < data_type.value:
+        if self.data_type.bits < data_type.bits:
             raise ValueError(f'Cannot use cast_sat to up-cast value from'
                              f'{self.data_type} to {data_type}')
         if self.data_type == data_type:
             return self
-        val = self.to_signed(is_signed).to_int()
+        val = self.to_signed(is_signed)
         if val is None:
-            return BeltNum(data_type, Integer(None))
-        val = max(val, data_type.min_value(is_signed))
-        val = min(val, data_type.max_value(is_signed))
-        return BeltNum.from_signed(Integer(val), data_type=data_type, is_signed=is_signed)
+            return data_type.err_num
+        val = max(val, data_type.min_values[is_signed])
+        val = min(val, data_type.max_values[is_signed])
+        return BeltNum.from_signed(val, data_type=data_type, is_signed=is_signed)
 
     def cast_checked(self, data_type: DataType, is_signed: bool) -> 'BeltNum':
-        if self.data_type.value < data_type.value:
+        if self.data_type.bits < data_type.bits:
             raise ValueError(f'Cannot use cast_checked to up-cast value from'
                              f'{self.data_type} to {data_type}')
         if self.data_type == data_type:
             return self
-        val = self.to_signed(is_signed).to_int()
+        val = self.to_signed(is_signed)
         if val is None or \
-                val < data_type.min_value(is_signed) or \
-                val > data_type.max_value(is_signed):
-            return BeltNum(data_type, Integer(None))
-        return BeltNum.from_signed(Integer(val), data_type=data_type, is_signed=is_signed)
+                val < data_type.min_values[is_signed] or \
+                val > data_type.max_values[is_signed]:
+            return data_type.err_num
+        return BeltNum.from_signed(val, data_type=data_type, is_signed=is_signed)
 
     def extend(self, data_type: DataType, is_signed: bool) -> 'BeltNum':
-        if self.data_type.value > data_type.value:
+        if self.data_type.bits > data_type.bits:
             raise ValueError(f'Cannot use extend to down-cast value from'
                              f'{self.data_type} to {data_type}')
         if self.data_type == data_type:
             return self
-        val = self.to_signed(is_signed).to_int()
-        return BeltNum.from_signed(Integer(val), data_type=data_type, is_signed=is_signed)
+        val = self.to_signed(is_signed)
+        return BeltNum.from_signed(val, data_type=data_type, is_signed=is_signed)
 
     def binary_op(self, other: 'BeltNum', is_signed: bool, f) -> 'BeltNum':
         data_type = self.data_type.promote(other.data_type)
-        a = self.extend(data_type, is_signed)
-        b = other.extend(data_type, is_signed)
+        a = self.extend(data_type, is_signed).to_signed(is_signed)
+        b = other.extend(data_type, is_signed).to_signed(is_signed)
+        if a is None or b is None:
+            return data_type.err_num
         return BeltNum.from_signed(f(a, b), data_type, is_signed=is_signed)
 
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, BeltNum):
+            return NotImplemented
+        return self.data_type == other.data_type and self.int_value == other.int_value
+
+    def __hash__(self) -> int:
+        return hash((self.data_type, self.int_value))
+
+    def __repr__(self):
+        return f'BeltNum(data_type={self.data_type}, value={self.value!r})'
+
+
+_new_belt_num = object.__new__
+
+
+def _make_belt_num(data_type: DataType, int_value: Optional[int]) -> BeltNum:
+    num = _new_belt_num(BeltNum)
+    num.data_type = data_type
+    num.int_value = int_value
+    return num
+
+
+for _data_type in DataType:
+    _data_type.err_num = _make_belt_num(_data_type, None)
+    _data_type.interned_nums = [_make_belt_num(_data_type, value) for value in range(Integer.NUM_INTERNED)]
+
+
+# bytes BeltSlice.compare checks for equality at a time
+COMPARE_CHUNK = 4096
+
 
 class BeltSlice(NamedTuple):
-    data: Union[bytes, bytearray]
+    """
+    A window into a buffer. data is a memoryview of the whole buffer, shared by all slices of it; a read-only one
+    (over bytes) can't be stored in. Loads and stores pack and unpack in place, without copying bytes out.
+    """
+    data: memoryview
     start: int
     length: int
 
+    @staticmethod
+    def over(buffer: Union[bytes, bytearray]) -> 'BeltSlice':
+        return BeltSlice(memoryview(buffer), 0, len(buffer))
+
     def trim_l(self, num_bytes: int) -> 'BeltSlice':
         if num_bytes < 0 or num_bytes > self.length:
             raise ValueError('Tried trimming beyond slice boundaries')
@@ -220,24 +358,67 @@ class BeltSlice(NamedTuple):
     def load(self, data_type: DataType, offset: int) -> BeltNum:
         if offset < 0:
             raise ValueError('Offset is negative')
-        num_bytes = data_type.num_bytes()
-        if offset + num_bytes > self.length:
-            return BeltNum(data_type, Integer(None))
-        i = self.start + offset
-        int_bytes = self.data[i:i + num_bytes]
-        return BeltNum(data_type, Integer(int.from_bytes(int_bytes, 'little', signed=False)))
+        if offset + data_type.size > self.length:
+            return data_type.err_num
+        value, = data_type.layout.unpack_from(self.data, self.start + offset)
+        return BeltNum.of(data_type, value)
 
     def store(self, offset: int, num: BeltNum) -> None:
         if offset < 0:
             raise ValueError('Offset is negative')
-        num_bytes = num.data_type.num_bytes()
-        val = num.value.to_int()
+        val = num.int_value
         if val is None:
             return
-        if isinstance(self.data, bytes):
+        if self.data.readonly:
             raise ValueError('Cannot store in write-only slice')
-        if offset + num_bytes > self.length:
+        if offset + num.data_type.size > self.length:
             raise ValueError('Tried writing value out of bounds')
-        int_bytes = val.to_bytes(num_bytes, 'little', signed=False)
-        i = self.start + offset
-        self.data[i:i + num_bytes] = int_bytes
+        num.data_type.layout.pack_into(self.data, self.start + offset, val)
+
+    # bulk operations, running native operations over the bytes of the slice
+
+    def view(self) -> memoryview:
+        return self.data[self.start:self.start + self.length]
+
+    def copy_from(self, src: 'BeltSlice') -> None:
+        """
+        Copies all of src to the start of this slice. They may overlap.
+        """
+        if self.data.readonly:
+            raise ValueError('Cannot store in write-only slice')
+        if src.length > self.length:
+            raise ValueError('Tried writing value out of bounds')
+        self.data[self.start:self.start + src.length] = src.view()
+
+    def fill(self, value: int) -> None:
+        if self.data.readonly:
+            raise ValueError('Cannot store in write-only slice')
+        self.data[self.start:self.start + self.length] = bytes((value,)) * self.length
+
+    def compare(self, other: 'BeltSlice') -> int:
+        """
+        Lexicographic comparison of the bytes of both slices: -1, 0 or 1.
+        """
+        a, b = self.view(), other.view()
+        common = min(len(a), len(b))
+        # memoryviews only compare for equality, only the first chunk that differs is copied to order it
+        for start in range(0, common, COMPARE_CHUNK):
+            end = min(start + COMPARE_CHUNK, common)
+            if a[start:end] != b[start:end]:
+                return -1 if a[start:end].tobytes() < b[start:end].tobytes() else 1
+        return (len(a) > len(b)) - (len(a) < len(b))
+
+    def equals(self, other: 'BeltSlice') -> int:
+        return int(self.view() == other.view())
+
+    def find(self, value: int) -> Optional[int]:
+        """
+        Offset of the first byte equal to value, None if there is none.
+        """
+        base = self.data.obj
+        if isinstance(base, (bytes, bytearray)) and len(base) == self.data.nbytes:
+            # the view is all of its buffer, so offsets into both are the same
+            idx = base.find(value, self.start, self.start + self.length)
+            return None if idx < 0 else idx - self.start
+        idx = self.view().tobytes().find(value)
+        return None if idx < 0 else idx
@@ -0,0 +1,413 @@
+"""
+Microbenchmarks for the VM. Run ``python bench.py`` for all of them, or pass benchmark names to pick some.
+"""
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from lark import Lark
+
+import flat
+import programs
+from belt import Belt, BeltNum, BeltSlice, DataType, Integer
+from bytecode import encode, decode
+from hooks import OpcodeCountHook, InstructionTimeHook, LoopIterationHook, TraceHook
+from lang.parse import Compiler, grammar
+from loop_stack import LoopStack
+from loop_tree import LazyLoopTreeArray, LoopTree, LoopTreeArray, decode_loop_trees, encode_loop_trees
+from merkle import MerkleCache, merkle_levels, merkle_path
+from op import Block, Instruction, Engine
+from optimize import optimize
+from ops.arith import InsArith, ArithMode, InsRel, InsConvert
+from ops.flow import InsLoopSpecified
+from ops.misc import InsConst, InsIsErr, InsLocalGet, InsLoad, InsStore
+from program_cache import ProgramCache
+from tx import Tx, Input, Output, Outpoint, UnlockData
+from tx_encoding import decode_tx, encode_tx
+from verify import verify_tx, ParallelVerifier, _check_amounts
+from vm import VM
+
+
+def _report(name: str, seconds: float, number: int, unit: str = 'op') -> None:
+    print(f'{name:<40} {seconds / number * 1e9:>10.1f} ns/{unit}')
+
+
+def _time(stmt: Callable[[], object], number: int, repeat: int = 15) -> float:
+    return min(timeit.repeat(stmt, number=number, repeat=repeat))
+
+
+def bench_belt() -> None:
+    belt = Belt()
+    num = BeltNum(DataType.I8, Integer(1))
+    number = 1_000_000
+    push, get_num = belt.push, belt.get_num
+    _report('belt push', _time(lambda: push(num), number), number)
+    _report('belt get_num', _time(lambda: get_num(3), number), number)
+    slc, num32 = BeltSlice.over(bytearray(64)), BeltNum.of(DataType.I32, 0x1234_5678)
+    load, store = slc.load, slc.store
+    _report('slice load u32', _time(lambda: load(DataType.I32, 8), number), number)
+    _report('slice store u32', _time(lambda: store(8, num32), number), number)
+
+
+def bench_conversions() -> None:
+    number = 200_000
+    num = BeltNum.of(DataType.I32, 0xffff_fff0)
+    to_signed, from_signed = num.to_signed, BeltNum.from_signed
+    widening_split = InsArith([0, 1], True, ArithMode.WIDENING, int.__mul__)._op
+    i32, i64 = DataType.I32, DataType.I64
+
+    def bytes_to_signed():
+        int_bytes = num.int_value.to_bytes(4, 'little', signed=False)
+        return int.from_bytes(int_bytes, 'little', signed=True)
+
+    def bytes_from_signed():
+        int_bytes = (-16).to_bytes(4, 'little', signed=True)
+        return BeltNum.of(i32, int.from_bytes(int_bytes, 'little', signed=False))
+
+    def bytes_widening_split():
+        wide_bytes = (-3 * 0x7fff_ffff).to_bytes(8, 'little', signed=True)
+        return [int.from_bytes(wide_bytes[4:], 'little', signed=True),
+                int.from_bytes(wide_bytes[:4], 'little', signed=True)]
+
+    _report('to_signed', _time(lambda: to_signed(True), number), number)
+    _report('to_signed via bytes', _time(bytes_to_signed, number), number)
+    _report('from_signed', _time(lambda: from_signed(-16, i32, True), number), number)
+    _report('from_signed via bytes', _time(bytes_from_signed, number), number)
+    _report('widening split', _time(lambda: widening_split(i32, -3, 0x7fff_ffff), number), number)
+    _report('widening split via bytes', _time(bytes_widening_split, number), number)
+    _report('promote', _time(lambda: i32.promote(i64), number), number)
+    _report('promote via DataType(max)', _time(lambda: DataType(max(i32.value, i64.value)), number), number)
+    _report('max_value', _time(lambda: i32.max_value(True), number), number)
+    _report('max_value via shifts', _time(lambda: (1 << (i32.value - True)) - 1, number), number)
+
+
+def _fib_program():
+    return Block([
+        InsConst(BeltNum(DataType.I64, Integer(1))),
+        InsLoopSpecified(Block([
+            InsArith([0, 1], False, ArithMode.CHECKED, int.__add__),
+        ])),
+    ])
+
+
+def bench_fib_loop() -> None:
+    num_loops = 90
+    block = _fib_program()
+
+    for name, metered in [('fib loop', False), ('fib loop, metered', True)]:
+        def run():
+            vm = VM(LoopStack([LoopTree.LEAF(num_loops)]), num_locals=0, ram_size=0, metered=metered)
+            block.run(vm)
+
+        number = 200
+        _report(name, _time(run, number), number * num_loops, 'iteration')
+
+
+def bench_fib_body() -> None:
+    # the fib loop body without Block.run and the loop stack: one add and one push per step
+    num_loops = 90
+    const = InsConst(BeltNum(DataType.I64, Integer(1)))
+    add = InsArith([0, 1], False, ArithMode.CHECKED, int.__add__)
+
+    def run():
+        vm = VM(LoopStack([]), num_locals=0, ram_size=0)
+        const.run(vm)
+        for _ in range(num_loops):
+            add.run(vm)
+
+    number = 2000
+    _report('fib loop body', _time(run, number), number * num_loops, 'iteration')
+
+
+def _nested_program():
+    return Block([
+        InsConst(BeltNum(DataType.I32, Integer(0))),
+        InsLoopSpecified(Block([
+            InsLoopSpecified(Block([
+                InsArith([0, 1], True, ArithMode.CHECKED, int.__sub__),
+            ])),
+            InsLoopSpecified(Block([
+                InsArith([0, 2], True, ArithMode.CHECKED, int.__add__),
+            ])),
+        ])),
+    ])
+
+
+def bench_engines() -> None:
+    programs = [
+        ('fib', _fib_program(), lambda: [LoopTree.LEAF(90)]),
+        ('nested', _nested_program(), lambda: [LoopTree.CARTESIAN(10, [LoopTree.LEAF(5), LoopTree.LEAF(5)])]),
+    ]
+    number = 100
+    for name, block, loop_trees in programs:
+        for engine in Engine:
+            runner = block.runner(engine)
+
+            def run():
+                runner(VM(LoopStack(loop_trees()), num_locals=0, ram_size=0))
+
+            _report(f'{name} ({engine.value})', _time(run, number), number, 'run')
+
+
+def bench_hooks() -> None:
+    block = _nested_program()
+    number = 100
+    with open(os.devnull, 'w') as devnull:
+        hooks = [
+            ('no hook', lambda: None),
+            ('opcode counts', OpcodeCountHook),
+            ('instruction times', InstructionTimeHook),
+            ('loop iterations', LoopIterationHook),
+            ('trace', lambda: TraceHook(devnull)),
+        ]
+        for name, make_hook in hooks:
+            def run():
+                loop_trees = [LoopTree.CARTESIAN(10, [LoopTree.LEAF(5), LoopTree.LEAF(5)])]
+                block.run(VM(LoopStack(loop_trees), num_locals=0, ram_size=0, hook=make_hook()))
+
+            _report(f'nested ({name})', _time(run, number), number, 'run')
+
+
+def _alloc_instructions() -> List[Tuple[str, Instruction]]:
+    return [
+        ('const', InsConst(BeltNum(DataType.I32, Integer(1000)))),
+        ('add small', InsArith([0, 1], False, ArithMode.CHECKED, int.__add__)),
+        ('add large', InsArith([2, 3], False, ArithMode.CHECKED, int.__add__)),
+        ('add signed', InsArith([2, 3], True, ArithMode.CHECKED, int.__add__)),
+        ('add overflow (Err)', InsArith([4, 4], False, ArithMode.CHECKED, int.__add__)),
+        ('add widening', InsArith([2, 3], False, ArithMode.WIDENING, int.__add__)),
+        ('rel <', InsRel(2, 3, False, int.__lt__)),
+        ('is_err', InsIsErr(2)),
+        ('local get', InsLocalGet(0)),
+        ('extend i64', InsConvert(2, DataType.I64, True, BeltNum.extend)),
+        ('load u32', InsLoad(DataType.I32, 5, 0)),
+        ('store u32', InsStore(3, 5, 4)),
+    ]
+
+
+def _alloc_vm() -> VM:
+    vm = VM(LoopStack([]), num_locals=1, ram_size=8)
+    vm.set_local(0, BeltNum(DataType.I32, Integer(70000)))
+    vm.belt().push(vm.ram())
+    vm.belt().push(BeltNum(DataType.I32, Integer(0xffff_ffff)))
+    vm.belt().push(BeltNum(DataType.I32, Integer(50000)))
+    vm.belt().push(BeltNum(DataType.I32, Integer(60000)))
+    vm.belt().push(BeltNum(DataType.I32, Integer(2)))
+    vm.belt().push(BeltNum(DataType.I32, Integer(1)))
+    return vm
+
+
+def bench_alloc() -> None:
+    # allocations per run of each instruction, measured with tracemalloc: blocks and bytes still alive afterwards
+    # (the results on the belt, averaged over many VMs) and the peak of temporary memory during a single run
+    number = 1000
+    tracemalloc.start()
+    for name, ins in _alloc_instructions():
+        ins.run(_alloc_vm())
+        vms = [_alloc_vm() for _ in range(number)]
+        before = tracemalloc.take_snapshot()
+        for vm in vms:
+            ins.run(vm)
+        after = tracemalloc.take_snapshot()
+        diff = after.compare_to(before, 'filename')
+        blocks = sum(stat.count_diff for stat in diff) / number
+        size = sum(stat.size_diff for stat in diff) / number
+        vm = _alloc_vm()
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        ins.run(vm)
+        _, peak = tracemalloc.get_traced_memory()
+        print(f'{name:<24} {blocks:>5.1f} blocks {size:>6.1f} B retained {peak - current:>6} B peak')
+    tracemalloc.stop()
+
+
+def bench_bytecode() -> None:
+    number = 20
+    for name, src in [('if_else', programs.IF_ELSE), ('fib', programs.FIB), ('nested_break', programs.NESTED_BREAK)]:
+        binary = encode(Compiler().compile(src))
+        _report(f'{name} compile source', _time(lambda: Compiler().compile(src), number), number, 'program')
+        _report(f'{name} decode binary ({len(binary)} B)', _time(lambda: decode(binary), number), number, 'program')
+
+
+def bench_compile() -> None:
+    number = 20
+    earley = Compiler(Lark(grammar))
+    lalr = Compiler()
+    for name, src in [('if_else', programs.IF_ELSE), ('fib', programs.FIB), ('nested_break', programs.NESTED_BREAK)]:
+        _report(f'{name} compile earley', _time(lambda: earley.compile(src), number), number, 'program')
+        _report(f'{name} compile lalr', _time(lambda: lalr.compile(src), number), number, 'program')
+    srcs = programs.ALL * 100
+    _report(f'batch of {len(srcs)} earley', _time(lambda: [earley.compile(src) for src in srcs], 1, 3), len(srcs),
+            'program')
+    _report(f'batch of {len(srcs)} lalr', _time(lambda: [lalr.compile(src) for src in srcs], 1, 3), len(srcs),
+            'program')
+
+
+CONSTANT_LOOP = """
+    version 0.0.1;
+    n = 0u32;
+    loop l {
+        a = 3u32;
+        b = 5u32;
+        c = a * b;
+        d = c + a;
+        e = d >> b;
+        limit = cast_extend32(e);
+        ok = n < limit;
+        n = n | n;
+    }
+"""
+
+
+def bench_optimize() -> None:
+    number = 100
+    for name, src, loop_trees in [('fib', programs.FIB, lambda: [LoopTree.LEAF(30)]),
+                                  ('constant loop', CONSTANT_LOOP, lambda: [LoopTree.LEAF(100)])]:
+        result = Compiler().compile(src)
+        _report(f'{name} optimize', _time(lambda: optimize(result), number), number, 'program')
+        for label, compiled in [('plain', result), ('optimized', optimize(result))]:
+            runner = Block(compiled.instructions).runner(Engine.CLOSURE)
+
+            def run():
+                runner(VM(LoopStack(loop_trees()), num_locals=compiled.num_locals, ram_size=0))
+
+            _report(f'{name} ({label})', _time(run, number), number, 'run')
+
+
+def _verify_txs(num_txs: int, num_inputs: int) -> List[Tx]:
+    binary = encode(Compiler().compile(programs.FIB))
+    tx = Tx(
+        inputs=[
+            Input(
+                outpoints=[Outpoint(tx_hash=bytes(32), idx=0, amount=1000, constraints=[], carryover=b'')],
+                bytecode_merkle_path=[],
+                bytecode=binary,
+            )
+            for _ in range(num_inputs)
+        ],
+        outputs=[],
+        preambles=[],
+        unlock_data=[UnlockData(data=[], loop_trees=bytes.fromhex('001e'), ram_size=0) for _ in range(num_inputs)],
+        signatures=[],
+    )
+    return [tx] * num_txs
+
+
+def bench_verify() -> None:
+    txs = _verify_txs(64, 4)
+    cache = ProgramCache()
+    _report('serial verify_tx', _time(lambda: [verify_tx(tx, cache) for tx in txs], 1, 3), len(txs), 'tx')
+    for max_workers in sorted({1, 2, os.cpu_count() or 1}):
+        with ParallelVerifier(max_workers) as verifier:
+            verifier.verify_txs(txs[:max_workers])
+            _report(f'parallel, {max_workers} workers', _time(lambda: verifier.verify_txs(txs), 1, 3), len(txs), 'tx')
+
+
+def bench_tx_parse() -> None:
+    tx, = _verify_txs(1, 16)
+    encoded = encode_tx(tx)
+    number = 2_000
+    print(f'{len(encoded)} byte tx with {len(tx.inputs)} inputs')
+    _report('encode_tx', _time(lambda: encode_tx(tx), number), number, 'tx')
+    _report('decode_tx', _time(lambda: decode_tx(encoded), number), number, 'tx')
+    _report('decode_tx, check amounts', _time(lambda: _check_amounts(decode_tx(encoded)), number), number, 'tx')
+    _report('decode_tx, to_tx', _time(lambda: decode_tx(encoded).to_tx(), number), number, 'tx')
+    seconds = _time(lambda: decode_tx(encoded).to_tx(), number)
+    print(f'{"full decode throughput":<40} {len(encoded) * number / seconds / 1e6:>10.1f} MB/s')
+
+
+def bench_merkle() -> None:
+    # a block's inputs spending random contracts of one tree with 4096 contracts
+    bytecodes = [b'contract %d' % idx for idx in range(4096)]
+    levels = merkle_levels(bytecodes)
+    root = levels[-1][0]
+    rng = random.Random(0)
+    inputs = [(bytecodes[idx], merkle_path(levels, idx)) for idx in (rng.randrange(4096) for _ in range(2000))]
+    for name, max_entries in [('no cache', 0), ('cache', 65536), ('cache, 1024 entries', 1024)]:
+        def run():
+            cache = MerkleCache(max_entries)
+            for bytecode, path in inputs:
+                cache.verify(bytecode, path, root)
+        _report(f'merkle path, {name}', _time(run, 1, 5), len(inputs), 'input')
+
+
+def bench_loop_trees() -> None:
+    rolled_out = encode_loop_trees([LoopTree.ROLLED_OUT([[LoopTree.LEAF(idx % 200), LoopTree.CARTESIAN(3, [
+        LoopTree.LEAF(5)])] for idx in range(2000)])])
+    for name, data, number in [('leaf', bytes.fromhex('001e'), 100_000), ('rolled out 2000x2', rolled_out, 20)]:
+        _report(f'decode loop trees, {name}', _time(lambda: decode_loop_trees(data), number, 5), number, 'blob')
+        _report(f'decode loop tree array, {name}', _time(lambda: LoopTreeArray.decode(data), number, 5), number, 'blob')
+    # a failing program only enters the first rows of a large witness
+    trees = [LoopTree.ROLLED_OUT([[LoopTree.LEAF(idx % 200), LoopTree.CARTESIAN(3, [LoopTree.LEAF(5)])]
+                                  for idx in range(50_000)])]
+    plain, indexed = encode_loop_trees(trees), encode_loop_trees(trees, indexed=True)
+
+    def enter_rows(loop_trees) -> None:
+        stack = LoopStack(loop_trees)
+        stack.start_loop()
+        for _ in range(3):
+            stack.next()
+            stack.start_loop()
+            stack.break_loop()
+            stack.start_loop()
+            stack.break_loop()
+
+    _report('enter 3 of 50000 rows, eager', _time(lambda: enter_rows(LoopTreeArray.decode(plain, max_nodes=1 << 20)),
+                                                  1, 5), 1, 'blob')
+    _report('enter 3 of 50000 rows, lazy', _time(lambda: enter_rows(LazyLoopTreeArray(indexed)), 100, 5), 100, 'blob')
+
+
+def bench_lanes() -> None:
+    from lanes import run_lanes
+
+    straight_line = Block([InsConst(BeltNum.of(DataType.I32, 3)), InsConst(BeltNum.of(DataType.I32, 5))] + [
+        InsArith([0, 1], False, ArithMode.CHECKED, op)
+        for op in [int.__add__, int.__mul__, int.__xor__, int.__sub__, int.__and__] * 20
+    ])
+    programs = [
+        ('fib loop', flat.lower(_fib_program()), lambda: [LoopTree.LEAF(90)]),
+        ('straight-line', flat.lower(straight_line), lambda: []),
+    ]
+    for name, program, loop_trees in programs:
+        for num_lanes in [1, 100, 1000]:
+            def vms():
+                return [VM(LoopStack(loop_trees()), num_locals=0, ram_size=0) for _ in range(num_lanes)]
+
+            def run_scalar():
+                for vm in vms():
+                    program.run(vm)
+
+            _report(f'{name} {num_lanes} lanes scalar', _time(run_scalar, 1, 5), num_lanes, 'lane')
+            _report(f'{name} {num_lanes} lanes vectorized', _time(lambda: run_lanes(program, vms()), 1, 5),
+                    num_lanes, 'lane')
+
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+    'belt': bench_belt,
+    'conversions': bench_conversions,
+    'fib_loop': bench_fib_loop,
+    'fib_body': bench_fib_body,
+    'alloc': bench_alloc,
+    'engines': bench_engines,
+    'hooks': bench_hooks,
+    'bytecode': bench_bytecode,
+    'compile': bench_compile,
+    'verify': bench_verify,
+    'lanes': bench_lanes,
+    'tx_parse': bench_tx_parse,
+    'merkle': bench_merkle,
+    'loop_trees': bench_loop_trees,
+    'optimize': bench_optimize,
+}
+
+
+def main(names) -> None:
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
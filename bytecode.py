@@ -0,0 +1,376 @@
+"""
+Binary encoding of compiled programs.
+
+    program:     MAGIC VERSION num_locals:uleb block
+    block:       num_instructions:uleb instruction*
+    instruction: prefix:u8 operand*
+
+Operands are encoded by kind: belt indices, flags, data types and op table entries as one byte, local indices,
+depths, offsets and constants as unsigned LEB128 (like the loop tree format), child blocks inline.
+
+The decoder walks a memoryview of the input without copying it and builds the Instructions directly, validating
+every operand, so verifying compiled bytecode never touches the parser.
+"""
+from abc import ABC, abstractmethod
+from typing import List, Optional, Union, Dict, Type, Sequence, Any
+
+from belt import Belt, BeltNum, BeltSlice, DataType
+from lang.parse import CompileResult
+from op import Opcode, Instruction, Block
+from ops.arith import InsRel, InsRelVerify, InsNAryOp, InsArith, InsConvert, ArithMode, divmod_op, cast_wrap
+from ops.binary import CHECKED, CHECKED_OPS, COMPARE, COMPARE_OPS, WIDENING, WIDENING_OPS, InsDivModSigned, \
+    InsDivModUnsigned
+from ops.flow import InsNop, InsUnreachable, InsAlignBlock, InsLoopSpecified, InsIfUnspecified, InsBr, InsBrIf, \
+    InsBrContinue
+from ops.misc import InsConst, InsLocalGet, InsLocalSet, InsIsErr, InsVerify, InsVerifyOk, InsSliceLen, InsSliceOp, \
+    InsSubSlice, InsLoad, InsStore, InsRam, InsSliceCopy, InsSliceFill, InsSliceRel, InsSliceFind
+from ops.digest import HASHES, InsDigest, InsHashInit, InsHashUpdate, InsHashFinal
+
+MAGIC = b'\x00MTR'
+VERSION = 1
+MAX_BLOCK_DEPTH = 64
+# each local is allocated when the program starts
+MAX_LOCALS = 1 << 16
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class Reader:
+    def __init__(self, data: Buffer) -> None:
+        self._view = memoryview(data)
+        self._pos = 0
+        self.num_locals = 0
+        self.block_depth = 0
+
+    def at_end(self) -> bool:
+        return self._pos == len(self._view)
+
+    def byte(self) -> int:
+        if self._pos >= len(self._view):
+            raise ValueError('Unexpected end of bytecode')
+        b = self._view[self._pos]
+        self._pos += 1
+        return b
+
+    def uleb(self) -> int:
+        view, pos = self._view, self._pos
+        result = 0
+        shift = 0
+        while True:
+            if pos >= len(view):
+                raise ValueError('Unexpected end of bytecode')
+            b = view[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+            if shift > 63:
+                raise ValueError('LEB128 value too large')
+        self._pos = pos
+        return result
+
+    def expect(self, data: bytes) -> None:
+        end = self._pos + len(data)
+        if self._view[self._pos:end] != data:
+            raise ValueError('Not a binary program')
+        self._pos = end
+
+    def block(self) -> Block:
+        if self.block_depth >= MAX_BLOCK_DEPTH:
+            raise ValueError('Blocks nested too deeply')
+        self.block_depth += 1
+        num_instructions = self.uleb()
+        instructions = []
+        for _ in range(num_instructions):
+            prefix = self.byte()
+            opcode = OPCODES_BY_PREFIX.get(prefix)
+            if opcode is None:
+                raise ValueError(f'Unknown opcode prefix {prefix:#04x}')
+            instructions.append(opcode.decode(self))
+        self.block_depth -= 1
+        return Block(instructions)
+
+
+def _uleb(out: bytearray, value: int) -> None:
+    if value < 0:
+        raise ValueError(f'Cannot encode negative value {value}')
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+class Operand(ABC):
+    @abstractmethod
+    def encode(self, out: bytearray, value) -> None:
+        pass
+
+    @abstractmethod
+    def decode(self, reader: Reader):
+        pass
+
+
+class BeltIdx(Operand):
+    def encode(self, out: bytearray, value: int) -> None:
+        out.append(value)
+
+    def decode(self, reader: Reader) -> int:
+        idx = reader.byte()
+        if idx >= Belt.SIZE:
+            raise ValueError(f'Belt index {idx} out of range')
+        return idx
+
+
+class BeltIndices(Operand):
+    def encode(self, out: bytearray, value: List[int]) -> None:
+        out.append(len(value))
+        out.extend(value)
+
+    def decode(self, reader: Reader) -> List[int]:
+        num = reader.byte()
+        if num == 0:
+            raise ValueError('Expected at least one belt index')
+        return [BELT_IDX.decode(reader) for _ in range(num)]
+
+
+class LocalIdx(Operand):
+    def encode(self, out: bytearray, value: int) -> None:
+        _uleb(out, value)
+
+    def decode(self, reader: Reader) -> int:
+        idx = reader.uleb()
+        if idx >= reader.num_locals:
+            raise ValueError(f'Local index {idx} out of range')
+        return idx
+
+
+class Uint(Operand):
+    def encode(self, out: bytearray, value: int) -> None:
+        _uleb(out, value)
+
+    def decode(self, reader: Reader) -> int:
+        return reader.uleb()
+
+
+class Flag(Operand):
+    def encode(self, out: bytearray, value: bool) -> None:
+        out.append(int(value))
+
+    def decode(self, reader: Reader) -> bool:
+        flag = reader.byte()
+        if flag > 1:
+            raise ValueError(f'Invalid flag {flag}')
+        return flag == 1
+
+
+class Table(Operand):
+    """
+    One of a fixed list of values (op functions, enum members), encoded as its index.
+    """
+
+    def __init__(self, values: Sequence[Any]) -> None:
+        self._values = list(values)
+
+    def encode(self, out: bytearray, value) -> None:
+        for idx, candidate in enumerate(self._values):
+            if candidate is value:
+                out.append(idx)
+                return
+        raise ValueError(f'{value} has no binary encoding')
+
+    def decode(self, reader: Reader):
+        idx = reader.byte()
+        if idx >= len(self._values):
+            raise ValueError(f'Invalid table index {idx}')
+        return self._values[idx]
+
+
+class Num(Operand):
+    # data type index, with the high bit set for Err; followed by the value unless Err
+    ERR_FLAG = 0x80
+
+    def encode(self, out: bytearray, value: BeltNum) -> None:
+        type_idx = DATA_TYPES.index(value.data_type)
+        if value.int_value is None:
+            out.append(type_idx | self.ERR_FLAG)
+        else:
+            out.append(type_idx)
+            _uleb(out, value.int_value)
+
+    def decode(self, reader: Reader) -> BeltNum:
+        tag = reader.byte()
+        type_idx = tag & ~self.ERR_FLAG
+        if type_idx >= len(DATA_TYPES):
+            raise ValueError(f'Invalid data type {type_idx}')
+        data_type = DATA_TYPES[type_idx]
+        if tag & self.ERR_FLAG:
+            return data_type.err_num
+        value = reader.uleb()
+        if value > data_type.max_value(False):
+            raise ValueError(f'Constant {value} out of range for {data_type}')
+        return BeltNum.of(data_type, value)
+
+
+class BlockOperand(Operand):
+    def encode(self, out: bytearray, value: Block) -> None:
+        _encode_block(out, value)
+
+    def decode(self, reader: Reader) -> Block:
+        return reader.block()
+
+
+DATA_TYPES = [DataType.I8, DataType.I16, DataType.I32, DataType.I64]
+ARITH_OPS = [int.__add__, int.__sub__, int.__mul__, int.__floordiv__, int.__mod__,
+             int.__lshift__, int.__rshift__, int.__and__, int.__or__, int.__xor__]
+REL_OPS = [int.__eq__, int.__ne__, int.__lt__, int.__le__, int.__gt__, int.__ge__]
+NARY_OPS = [divmod_op]
+CONVERT_OPS = [BeltNum.extend, cast_wrap, BeltNum.cast_sat, BeltNum.cast_checked]
+SLICE_OPS = [BeltSlice.trim_l, BeltSlice.trim_r, BeltSlice.shrink]
+SLICE_RELS = [BeltSlice.compare, BeltSlice.equals]
+
+BELT_IDX = BeltIdx()
+BELT_INDICES = BeltIndices()
+LOCAL_IDX = LocalIdx()
+UINT = Uint()
+FLAG = Flag()
+NUM = Num()
+BLOCK = BlockOperand()
+DATA_TYPE = Table(DATA_TYPES)
+
+
+class InsOpcode(Opcode):
+    """
+    Opcode of one instruction class; the payload is the instruction's constructor arguments, encoded in order
+    by the given operands. If num_indices is given, the BELT_INDICES operand must have that many indices, the arity
+    of the ops in the instruction's table.
+    """
+
+    def __init__(self, prefix: int, name: str, ins_type: Type[Instruction], operands: List[Operand],
+                 num_indices: Optional[int] = None) -> None:
+        self._prefix = prefix
+        self._name = name
+        self._ins_type = ins_type
+        self._operands = operands
+        self._num_indices = num_indices
+
+    def name(self) -> str:
+        return self._name
+
+    def prefix(self) -> int:
+        return self._prefix
+
+    def operands(self) -> List[Operand]:
+        return self._operands
+
+    def instruction(self, payload) -> Instruction:
+        return self._ins_type(*payload)
+
+    def _check_indices(self, payload: Sequence[Any]) -> None:
+        if self._num_indices is None:
+            return
+        for operand, value in zip(self._operands, payload):
+            if operand is BELT_INDICES and len(value) != self._num_indices:
+                raise ValueError(f'{self._name} takes {self._num_indices} belt indices, got {len(value)}')
+
+    def encode(self, out: bytearray, ins: Instruction) -> None:
+        payload = ins.payload()
+        self._check_indices(payload)
+        out.append(self._prefix)
+        for operand, value in zip(self._operands, payload):
+            operand.encode(out, value)
+
+    def decode(self, reader: Reader) -> Instruction:
+        payload = [operand.decode(reader) for operand in self._operands]
+        self._check_indices(payload)
+        return self.instruction(payload)
+
+
+OPCODES: List[InsOpcode] = [
+    InsOpcode(0x00, 'nop', InsNop, []),
+    InsOpcode(0x01, 'unreachable', InsUnreachable, []),
+    InsOpcode(0x02, 'loop', InsLoopSpecified, [BLOCK]),
+    InsOpcode(0x03, 'if', InsIfUnspecified, [BELT_IDX, BLOCK, BLOCK]),
+    InsOpcode(0x04, 'br', InsBr, [UINT]),
+    InsOpcode(0x05, 'br_if', InsBrIf, [BELT_IDX, UINT]),
+    InsOpcode(0x06, 'continue', InsBrContinue, [UINT]),
+    InsOpcode(0x07, 'align', InsAlignBlock, [UINT, BLOCK]),
+    InsOpcode(0x10, 'const', InsConst, [NUM]),
+    InsOpcode(0x11, 'local_get', InsLocalGet, [LOCAL_IDX]),
+    InsOpcode(0x12, 'local_set', InsLocalSet, [LOCAL_IDX]),
+    InsOpcode(0x13, 'is_err', InsIsErr, [BELT_IDX]),
+    InsOpcode(0x14, 'verify', InsVerify, [BELT_IDX]),
+    InsOpcode(0x15, 'verify_ok', InsVerifyOk, [BELT_IDX]),
+    InsOpcode(0x16, 'length', InsSliceLen, [BELT_IDX]),
+    InsOpcode(0x17, 'slice_op', InsSliceOp, [BELT_IDX, BELT_IDX, Table(SLICE_OPS)]),
+    InsOpcode(0x18, 'subslice', InsSubSlice, [BELT_IDX, BELT_IDX, BELT_IDX]),
+    InsOpcode(0x19, 'load', InsLoad, [DATA_TYPE, BELT_IDX, UINT]),
+    InsOpcode(0x1a, 'store', InsStore, [BELT_IDX, BELT_IDX, UINT]),
+    InsOpcode(0x1b, 'slice_copy', InsSliceCopy, [BELT_IDX, BELT_IDX]),
+    InsOpcode(0x1c, 'slice_fill', InsSliceFill, [BELT_IDX, BELT_IDX]),
+    InsOpcode(0x1d, 'slice_rel', InsSliceRel, [BELT_IDX, BELT_IDX, Table(SLICE_RELS)]),
+    InsOpcode(0x1e, 'slice_find', InsSliceFind, [BELT_IDX, BELT_IDX]),
+    InsOpcode(0x1f, 'ram', InsRam, []),
+    # all ops of the arith and nary tables are binary
+    InsOpcode(0x20, 'arith', InsArith, [BELT_INDICES, FLAG, Table(list(ArithMode)), Table(ARITH_OPS)], num_indices=2),
+    InsOpcode(0x21, 'rel', InsRel, [BELT_IDX, BELT_IDX, FLAG, Table(REL_OPS)]),
+    InsOpcode(0x22, 'rel_verify', InsRelVerify, [BELT_IDX, BELT_IDX, FLAG, Table(REL_OPS)]),
+    InsOpcode(0x23, 'nary', InsNAryOp, [BELT_INDICES, FLAG, Table(NARY_OPS)], num_indices=2),
+    InsOpcode(0x24, 'convert', InsConvert, [BELT_IDX, DATA_TYPE, FLAG, Table(CONVERT_OPS)]),
+]
+# the specialized binary instructions, one opcode per operator and signedness (the low bit is set for signed)
+for base, names, table, prefix in [(0x30, CHECKED_OPS, CHECKED, ''), (0x48, COMPARE_OPS, COMPARE, ''),
+                                   (0x58, WIDENING_OPS, WIDENING, 'widening_')]:
+    for i, (name, op) in enumerate(names.items()):
+        for is_signed in (False, True):
+            OPCODES.append(InsOpcode(base + 2 * i + is_signed, f'{prefix}{name}_{"s" if is_signed else "u"}',
+                                     table[op, is_signed], [BELT_IDX, BELT_IDX]))
+OPCODES += [
+    InsOpcode(0x5e, 'divmod_u', InsDivModUnsigned, [BELT_IDX, BELT_IDX]),
+    InsOpcode(0x5f, 'divmod_s', InsDivModSigned, [BELT_IDX, BELT_IDX]),
+    InsOpcode(0x60, 'digest', InsDigest, [BELT_IDX, BELT_IDX, Table(HASHES)]),
+    InsOpcode(0x61, 'hash_init', InsHashInit, [Table(HASHES)]),
+    InsOpcode(0x62, 'hash_update', InsHashUpdate, [BELT_IDX, BELT_IDX]),
+    InsOpcode(0x63, 'hash_final', InsHashFinal, [BELT_IDX, BELT_IDX]),
+]
+OPCODES_BY_PREFIX: Dict[int, InsOpcode] = {opcode.prefix(): opcode for opcode in OPCODES}
+OPCODES_BY_TYPE: Dict[Type[Instruction], InsOpcode] = {opcode._ins_type: opcode for opcode in OPCODES}
+
+
+def _encode_block(out: bytearray, block: Block) -> None:
+    instructions = block.instructions()
+    _uleb(out, len(instructions))
+    for ins in instructions:
+        opcode = OPCODES_BY_TYPE.get(type(ins))
+        if opcode is None:
+            raise ValueError(f'{type(ins).__name__} has no binary encoding')
+        opcode.encode(out, ins)
+
+
+def encode(result: CompileResult) -> bytes:
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    if result.num_locals > MAX_LOCALS:
+        raise ValueError(f'Too many locals: {result.num_locals}')
+    _uleb(out, result.num_locals)
+    _encode_block(out, Block(result.instructions))
+    return bytes(out)
+
+
+def is_binary(data: Buffer) -> bool:
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def decode(data: Buffer) -> CompileResult:
+    reader = Reader(data)
+    reader.expect(MAGIC)
+    version = reader.byte()
+    if version != VERSION:
+        raise ValueError(f'Unsupported bytecode version {version}')
+    reader.num_locals = reader.uleb()
+    if reader.num_locals > MAX_LOCALS:
+        raise ValueError(f'Too many locals: {reader.num_locals}')
+    block = reader.block()
+    if not reader.at_end():
+        raise ValueError('Trailing bytes after program')
+    return CompileResult(block.instructions(), reader.num_locals)
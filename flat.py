@@ -0,0 +1,213 @@
+"""
+Flat execution engine. Lowers a tree of Blocks into one linear list of opcodes and operands, with the targets of
+br/br_if/continue resolved to absolute offsets, and runs it in a single non-recursive dispatch loop.
+
+Layout of the code list, each opcode followed by its operands:
+
+    CALL runner                 run a straight-line instruction (built with Instruction.build)
+    JUMP target
+    JUMP_IF_ZERO idx target     jump if belt item idx is 0 (raises on Err)
+    LOOP_START                  LoopStack.start_loop
+    LOOP_NEXT target            LoopStack.next, jump to target if the loop is done
+    BREAK_LOOP                  LoopStack.break_loop
+    CONTINUE_LOOP               LoopStack.continue_loop
+    SET_ALIGN alignment         save the current alignment and set a new one
+    RESTORE_ALIGN               restore the last saved alignment
+    RAISE message               raise ValueError(message)
+    HALT
+    CALL_JUMP_IF_ZERO runner target
+                                call runner, jump if it returns 0 (compare-and-branch superinstructions)
+"""
+from contextlib import contextmanager
+from enum import Enum
+from typing import List, Optional, Dict, Any, NamedTuple, Iterator, Callable, TYPE_CHECKING
+
+from vm import VM
+
+if TYPE_CHECKING:
+    from op import Instruction
+
+CALL = 0
+JUMP = 1
+JUMP_IF_ZERO = 2
+LOOP_START = 3
+LOOP_NEXT = 4
+BREAK_LOOP = 5
+CONTINUE_LOOP = 6
+SET_ALIGN = 7
+RESTORE_ALIGN = 8
+RAISE = 9
+HALT = 10
+CALL_JUMP_IF_ZERO = 11
+
+
+class FrameKind(Enum):
+    LOOP = 0
+    IF = 1
+    ALIGN = 2
+
+
+class Frame(NamedTuple):
+    kind: FrameKind
+    head: Optional[int]  # label continue jumps to, loops only
+    end: int  # label br jumps to
+
+
+class Lowering:
+    """
+    Emits the flat code of an instruction tree. Instructions lower themselves with Instruction.lower; control flow
+    opens a Frame for each of its child blocks so breaks know which loops and alignments they leave.
+    """
+
+    def __init__(self) -> None:
+        self._code: List[Any] = []
+        self._frames: List[Frame] = []
+        self._labels: List[Optional[int]] = []
+        self._fixups: List[int] = []
+        self._calls: Dict[int, 'Instruction'] = {}
+        self._end = self.label()
+
+    def label(self) -> int:
+        self._labels.append(None)
+        return len(self._labels) - 1
+
+    def place(self, label: int) -> None:
+        self._labels[label] = len(self._code)
+
+    def emit(self, opcode: int, *operands: Any) -> None:
+        self._code.append(opcode)
+        self._code.extend(operands)
+
+    def emit_call(self, ins: 'Instruction') -> None:
+        self._calls[len(self._code)] = ins
+        self.emit(CALL, ins.build())
+
+    def emit_call_jump(self, ins: 'Instruction', runner: Callable[[VM], int], target: int) -> None:
+        self._calls[len(self._code)] = ins
+        self.emit_jump(CALL_JUMP_IF_ZERO, runner, target=target)
+
+    def emit_jump(self, opcode: int, *operands: Any, target: int) -> None:
+        self.emit(opcode, *operands)
+        self._fixups.append(len(self._code))
+        self._code.append(target)
+
+    @contextmanager
+    def frame(self, kind: FrameKind, end: int, head: Optional[int] = None) -> Iterator[None]:
+        self._frames.append(Frame(kind, head, end))
+        yield
+        self._frames.pop()
+
+    def emit_break(self, depth: int, is_continue: bool) -> None:
+        # a break of depth n leaves the n innermost blocks, continue re-enters the loop owning the n-th block
+        if depth == 0:
+            return
+        frames = self._frames[::-1]
+        num_exited = depth - 1 if is_continue else depth
+        for frame in frames[:num_exited]:
+            self._emit_exit(frame)
+        if not is_continue:
+            # breaking out of more blocks than there are frames leaves the outermost block: the program ends
+            self.emit_jump(JUMP, target=frames[depth - 1].end if depth <= len(frames) else self._end)
+            return
+        if num_exited >= len(frames):
+            self.emit_jump(JUMP, target=self._end)
+            return
+        target = frames[num_exited]
+        if target.kind == FrameKind.LOOP:
+            self.emit(CONTINUE_LOOP)
+            self.emit_jump(JUMP, target=target.head)
+        elif target.kind == FrameKind.IF:
+            self.emit(RAISE, 'Cannot continue if/else/end block')
+        else:
+            self._emit_exit(target)
+            self.emit_jump(JUMP, target=target.end)
+
+    def _emit_exit(self, frame: Frame) -> None:
+        if frame.kind == FrameKind.LOOP:
+            self.emit(BREAK_LOOP)
+        elif frame.kind == FrameKind.ALIGN:
+            self.emit(RESTORE_ALIGN)
+
+    def finish(self) -> 'FlatProgram':
+        self.place(self._end)
+        self.emit(HALT)
+        code = self._code
+        for offset in self._fixups:
+            code[offset] = self._labels[code[offset]]
+        return FlatProgram(code, self._calls)
+
+
+class FlatProgram:
+    def __init__(self, code: List[Any], calls: Optional[Dict[int, 'Instruction']] = None) -> None:
+        self._code = code
+        self._calls = calls if calls is not None else {}
+
+    def code(self) -> List[Any]:
+        return self._code
+
+    def call(self, pc: int) -> Optional['Instruction']:
+        """
+        The instruction of the CALL or CALL_JUMP_IF_ZERO at pc, if it was lowered with Lowering.emit_call or
+        Lowering.emit_call_jump.
+        """
+        return self._calls.get(pc)
+
+    def run(self, vm: VM, pc: int = 0, saved_alignments: Optional[List[int]] = None) -> None:
+        """
+        Runs the program from pc. Resuming at a pc other than 0 needs the alignments saved by the SET_ALIGNs passed
+        so far, the rest of the state is in the VM.
+        """
+        code = self._code
+        loop_stack = vm.loop_stack()
+        saved_alignments = list(saved_alignments) if saved_alignments is not None else []
+        while True:
+            opcode = code[pc]
+            if opcode == CALL:
+                if code[pc + 1](vm) is not None:
+                    raise ValueError(f'Unexpected break from {code[pc + 1]}')
+                pc += 2
+            elif opcode == CALL_JUMP_IF_ZERO:
+                if code[pc + 1](vm):
+                    pc += 3
+                else:
+                    pc = code[pc + 2]
+            elif opcode == LOOP_NEXT:
+                if loop_stack.next():
+                    pc = code[pc + 1]
+                else:
+                    pc += 2
+            elif opcode == JUMP:
+                pc = code[pc + 1]
+            elif opcode == JUMP_IF_ZERO:
+                if vm.belt().get_num(code[pc + 1]).expect_int():
+                    pc += 3
+                else:
+                    pc = code[pc + 2]
+            elif opcode == LOOP_START:
+                loop_stack.start_loop()
+                pc += 1
+            elif opcode == BREAK_LOOP:
+                loop_stack.break_loop()
+                pc += 1
+            elif opcode == CONTINUE_LOOP:
+                loop_stack.continue_loop()
+                pc += 1
+            elif opcode == SET_ALIGN:
+                saved_alignments.append(vm.alignment())
+                vm.set_alignment(code[pc + 1])
+                pc += 2
+            elif opcode == RESTORE_ALIGN:
+                vm.set_alignment(saved_alignments.pop())
+                pc += 1
+            elif opcode == RAISE:
+                raise ValueError(code[pc + 1])
+            elif opcode == HALT:
+                return None
+            else:
+                raise ValueError(f'Unknown opcode {opcode} at {pc}')
+
+
+def lower(block) -> FlatProgram:
+    lowering = Lowering()
+    block.lower(lowering)
+    return lowering.finish()
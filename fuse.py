@@ -0,0 +1,175 @@
+"""
+Peephole pass fusing adjacent pairs of instructions into superinstructions (see ops/fused.py), and the tool choosing
+which pairs to fuse:
+
+    python fuse.py [TRACE ...]
+
+counts the adjacent pairs of executed instructions in TraceHook traces (of the corpus below if no trace files are
+given), then times the corpus on the closure and flat engines with each fusable pair fused on its own and reports
+which fusions paid off.
+"""
+import io
+import sys
+import timeit
+from collections import Counter
+from typing import AbstractSet, Callable, Dict, FrozenSet, Iterable, List, Sequence, TextIO, Tuple
+
+import programs
+from bytecode import BLOCK, OPCODES_BY_TYPE
+from hooks import TraceHook
+from lang.parse import CompileResult, Compiler
+from loop_stack import LoopStack
+from loop_tree import LoopTree
+from op import Block, Engine, Instruction
+from ops.fused import InsFused, superinstruction
+from vm import VM
+
+# (name of the first instruction class, name of the second one)
+Pair = Tuple[str, str]
+
+# chosen by running this tool on CORPUS: the fusions that made it faster on both engines, run after run
+DEFAULT_PAIRS: FrozenSet[Pair] = frozenset({
+    ('InsConst', 'InsAddUnsigned'),
+    ('InsGeUnsigned', 'InsBrIf'),
+})
+
+# programs with the loop trees to run them with
+CORPUS: List[Tuple[str, List[LoopTree]]] = [
+    (programs.IF_ELSE, []),
+    (programs.FIB, [LoopTree.LEAF(90)]),
+    (programs.NESTED_BREAK, [LoopTree.CARTESIAN(10, [LoopTree.LEAF(30)])]),
+    (programs.COUNT_TO, [LoopTree.LEAF(100)]),
+]
+# a compiled program of the corpus with its loop trees
+Sample = Tuple[CompileResult, List[LoopTree]]
+
+
+def fuse(instructions: Sequence[Instruction], pairs: AbstractSet[Pair] = DEFAULT_PAIRS) -> List[Instruction]:
+    """
+    Fuses the adjacent instructions of each block whose pair of class names is in pairs, left to right.
+    """
+    code: List[Instruction] = []
+    for ins in instructions:
+        ins = _fuse_blocks(ins, pairs)
+        if code and not isinstance(code[-1], InsFused) and (type(code[-1]).__name__, type(ins).__name__) in pairs:
+            fused = superinstruction(code[-1], ins)
+            if fused is not None:
+                code[-1] = fused
+                continue
+        code.append(ins)
+    return code
+
+
+def _fuse_blocks(ins: Instruction, pairs: AbstractSet[Pair]) -> Instruction:
+    opcode = OPCODES_BY_TYPE.get(type(ins))
+    if opcode is None or BLOCK not in opcode.operands():
+        return ins
+    return opcode.instruction([Block(fuse(value.instructions(), pairs)) if operand is BLOCK else value
+                               for operand, value in zip(opcode.operands(), ins.payload())])
+
+
+def count_pairs(lines: Iterable[str]) -> Counter:
+    """
+    Counts the adjacent pairs of instructions in a trace printed by TraceHook.
+    """
+    names = [line.split(' ', 1)[0] for line in lines if line.strip()]
+    return Counter(zip(names, names[1:]))
+
+
+def trace(result: CompileResult, loop_trees: Sequence[LoopTree]) -> List[str]:
+    """
+    The TraceHook trace of running result.
+    """
+    out = io.StringIO()
+    vm = VM(LoopStack(list(loop_trees)), num_locals=result.num_locals, ram_size=0, hook=TraceHook(out))
+    try:
+        Block(result.instructions).run(vm)
+    except ValueError:
+        pass
+    return out.getvalue().splitlines()
+
+
+def fusable_pairs(results: Iterable[CompileResult]) -> Dict[Pair, Tuple[Instruction, Instruction]]:
+    """
+    The pairs of adjacent instructions in results that have a superinstruction, with an example of each.
+    """
+    found: Dict[Pair, Tuple[Instruction, Instruction]] = {}
+
+    def walk(instructions: Sequence[Instruction]) -> None:
+        for first, second in zip(instructions, instructions[1:]):
+            if superinstruction(first, second) is not None:
+                found.setdefault((type(first).__name__, type(second).__name__), (first, second))
+        for ins in instructions:
+            for value in ins.payload():
+                if isinstance(value, Block):
+                    walk(value.instructions())
+    for result in results:
+        walk(result.instructions)
+    return found
+
+
+def _corpus_runner(samples: Sequence[Sample], engine: Engine, pairs: AbstractSet[Pair]) -> Callable[[], None]:
+    runners = [(Block(fuse(result.instructions, pairs)).runner(engine), result.num_locals, loop_trees)
+               for result, loop_trees in samples]
+
+    def run() -> None:
+        for runner, num_locals, loop_trees in runners:
+            try:
+                runner(VM(LoopStack(list(loop_trees)), num_locals=num_locals, ram_size=0))
+            except ValueError:
+                pass
+    return run
+
+
+def speedup(samples: Sequence[Sample], engine: Engine, pairs: AbstractSet[Pair], rounds: int = 15) -> float:
+    """
+    How much faster the corpus runs with pairs fused, e.g. 0.05 for 5%. Unfused and fused runs alternate so both see
+    the same noise, the best time of each is compared.
+    """
+    plain, fused = _corpus_runner(samples, engine, frozenset()), _corpus_runner(samples, engine, pairs)
+    plain_times, fused_times = [], []
+    for _ in range(rounds):
+        plain_times.append(min(timeit.repeat(plain, number=5, repeat=3)))
+        fused_times.append(min(timeit.repeat(fused, number=5, repeat=3)))
+    return min(plain_times) / min(fused_times) - 1
+
+
+def report(counts: Counter, samples: Sequence[Sample], out: TextIO = sys.stdout) -> List[Pair]:
+    """
+    Prints the most executed pairs and, for the fusable ones, the speedup of fusing each of them on its own. Returns
+    the pairs that paid off on both the closure and the flat engine.
+    """
+    total = sum(counts.values())
+    print(f'{"pair":<40} {"count":>8} {"share":>7}', file=out)
+    for (first, second), count in counts.most_common(15):
+        print(f'{first + " " + second:<40} {count:>8} {count / max(total, 1):>7.1%}', file=out)
+    engines = [Engine.CLOSURE, Engine.FLAT]
+    paid_off = []
+    print(f'\n{"fusion":<40} {"count":>8} {"closure":>8} {"flat":>8}', file=out)
+    for pair in sorted(fusable_pairs(result for result, _ in samples), key=lambda pair: -counts[pair]):
+        speedups = [speedup(samples, engine, {pair}) for engine in engines]
+        if all(value > 0 for value in speedups):
+            paid_off.append(pair)
+        print(f'{" ".join(pair):<40} {counts[pair]:>8} ' + ' '.join(f'{value:>+8.1%}' for value in speedups),
+              file=out)
+    speedups = [speedup(samples, engine, frozenset(paid_off)) for engine in engines]
+    print(f'{"all that paid off":<40} {"":>8} ' + ' '.join(f'{value:>+8.1%}' for value in speedups), file=out)
+    return paid_off
+
+
+def main(paths: Sequence[str]) -> None:
+    samples = [(Compiler().compile(src), loop_trees) for src, loop_trees in CORPUS]
+    counts: Counter = Counter()
+    if paths:
+        for path in paths:
+            with open(path) as f:
+                counts.update(count_pairs(f))
+    else:
+        for result, loop_trees in samples:
+            counts.update(count_pairs(trace(result, loop_trees)))
+    paid_off = report(counts, samples)
+    print('\npaid off:', ', '.join(' '.join(pair) for pair in paid_off) or 'none')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,107 @@
+"""
+Hooks observe execution in the reference engine (Block.run). Attach one with VM.set_hook; without a hook, Block.run
+and the loops take their unhooked path and tracing costs nothing. The closure and flat engines don't call hooks.
+"""
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional, TextIO, TYPE_CHECKING
+
+from belt import BeltSlice
+
+if TYPE_CHECKING:
+    from op import Instruction
+    from vm import VM
+
+
+class Hook:
+    def before_instruction(self, ins: 'Instruction', vm: 'VM') -> None:
+        pass
+
+    def after_instruction(self, ins: 'Instruction', vm: 'VM') -> None:
+        pass
+
+    def loop_iteration(self, loop: 'Instruction', vm: 'VM') -> None:
+        pass
+
+
+class MultiHook(Hook):
+    def __init__(self, hooks: List[Hook]) -> None:
+        self.hooks = hooks
+
+    def before_instruction(self, ins: 'Instruction', vm: 'VM') -> None:
+        for hook in self.hooks:
+            hook.before_instruction(ins, vm)
+
+    def after_instruction(self, ins: 'Instruction', vm: 'VM') -> None:
+        for hook in self.hooks:
+            hook.after_instruction(ins, vm)
+
+    def loop_iteration(self, loop: 'Instruction', vm: 'VM') -> None:
+        for hook in self.hooks:
+            hook.loop_iteration(loop, vm)
+
+
+class OpcodeCountHook(Hook):
+    """
+    Number of executions per instruction class.
+    """
+
+    def __init__(self) -> None:
+        self.counts: Counter = Counter()
+
+    def after_instruction(self, ins: 'Instruction', vm: 'VM') -> None:
+        self.counts[type(ins).__name__] += 1
+
+
+class InstructionTimeHook(Hook):
+    """
+    Cumulative time in nanoseconds per instruction class. Time of control flow instructions includes the
+    instructions of their blocks.
+
+    Starts are kept by instruction: an instruction that raises gets no after_instruction, its start is replaced the
+    next time it runs rather than being taken for the start of another one.
+    """
+
+    def __init__(self) -> None:
+        self.times_ns: Counter = Counter()
+        self._starts: Dict[int, int] = {}
+
+    def before_instruction(self, ins: 'Instruction', vm: 'VM') -> None:
+        self._starts[id(ins)] = time.perf_counter_ns()
+
+    def after_instruction(self, ins: 'Instruction', vm: 'VM') -> None:
+        self.times_ns[type(ins).__name__] += time.perf_counter_ns() - self._starts.pop(id(ins))
+
+
+class LoopIterationHook(Hook):
+    """
+    Number of iterations per loop instruction, keyed by the instruction itself.
+    """
+
+    def __init__(self) -> None:
+        self.iterations: Dict['Instruction', int] = {}
+
+    def loop_iteration(self, loop: 'Instruction', vm: 'VM') -> None:
+        self.iterations[loop] = self.iterations.get(loop, 0) + 1
+
+
+class TraceHook(Hook):
+    """
+    Prints every executed instruction with the belt after it.
+    """
+
+    def __init__(self, file: Optional[TextIO] = None) -> None:
+        self.file = file
+
+    def after_instruction(self, ins: 'Instruction', vm: 'VM') -> None:
+        print(type(ins).__name__, ' '.join(format_belt_item(item) for item in vm.belt().items()),
+              file=self.file or sys.stdout)
+
+
+def format_belt_item(item) -> str:
+    if isinstance(item, BeltSlice):
+        return f'[{item.start}..+{item.length}]'
+    if item.int_value is None:
+        return 'Err'
+    return str(item.int_value)
@@ -0,0 +1,488 @@
+"""
+Lane-vectorized execution: runs one program over many inputs (VMs) at once. Every belt slot and local holds one NumPy
+array with a lane per VM plus a mask of the lanes that are Err, so straight-line arithmetic runs as one array
+operation for all lanes.
+
+Runs on the flat code of the program (see flat.py). Instructions without a lane implementation below are run lane by
+lane on the VMs and their results packed again, so every program runs. Control flow is taken by all lanes together
+as long as they agree; once they diverge (an if or br_if going different ways, loops running for a different number
+of iterations) every remaining lane finishes on its own VM with the scalar flat engine.
+
+Values of I8 to I32 are kept in int64 arrays, I64 in object arrays of Python ints, so none of them can overflow.
+"""
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+
+import flat
+from belt import Belt, BeltItem, BeltNum, DataType
+from flat import FlatProgram
+from loop_stack import LoopStack
+from loop_tree import load_loop_trees
+from op import Instruction, Runner
+from ops.arith import InsArith, ArithMode, InsConvert, InsNAryOp, InsRel, InsRelVerify, cast_wrap, divmod_op
+from ops.binary import CHECKED, COMPARE, InsBinary, InsCompare, InsDivMod, InsDivModSigned, InsDivModUnsigned
+from ops.fused import InsFused, InsPushBinary
+from ops.misc import InsConst, InsIsErr, InsLocalGet, InsLocalSet, InsVerify, InsVerifyOk
+from program_cache import CachedProgram
+from tx import UnlockData
+from vm import VM
+
+
+class LaneNum(NamedTuple):
+    """
+    A number per lane: values holds the raw, unsigned bit patterns like BeltNum.int_value, with 0 in the lanes where
+    err is set.
+    """
+    data_type: DataType
+    values: np.ndarray
+    err: np.ndarray
+
+
+# lanes that don't hold numbers of one common DataType keep their items as a plain list, one per lane
+LaneItem = Union[LaneNum, List[BeltItem]]
+
+
+class _Scalar(Exception):
+    """
+    Raised by lane implementations (before changing any state) to have the instruction run lane by lane.
+    """
+
+
+def _dtype(data_type: DataType) -> type:
+    return object if data_type is DataType.I64 else np.int64
+
+
+def _signed(num: LaneNum, is_signed: bool) -> np.ndarray:
+    if not is_signed:
+        return num.values
+    bits = num.data_type.value
+    return np.where(num.values >= 1 << (bits - 1), num.values - (1 << bits), num.values)
+
+
+def _lane_num(data_type: DataType, values: np.ndarray, err: np.ndarray) -> LaneNum:
+    # values may be signed and of any dtype, wrap them to the raw representation of data_type
+    dtype = _dtype(data_type)
+    if dtype is object:
+        values = values.astype(object)
+    values = np.where(err, 0, np.remainder(values, 1 << data_type.value))
+    return LaneNum(data_type, values.astype(dtype), err)
+
+
+class Lanes:
+    """
+    State of a lane-vectorized run: the belt and locals of all lanes, the lanes still running and the errors of the
+    lanes that failed.
+    """
+
+    def __init__(self, vms: Sequence[VM]) -> None:
+        self.vms = vms
+        self.active = np.ones(len(vms), dtype=bool)
+        self.errors: List[Optional[Exception]] = [None] * len(vms)
+        self.alignment = vms[0].alignment() if vms else 0
+        self.saved_alignments: List[int] = []
+        self.belt: List[LaneItem] = []
+        self.locals: List[LaneItem] = []
+        self.unpack()
+
+    def num(self, idx: int) -> LaneNum:
+        item = self.belt[idx]
+        if not isinstance(item, LaneNum):
+            raise _Scalar
+        return item
+
+    def push(self, item: LaneItem) -> None:
+        self.belt.insert(0, item)
+        del self.belt[Belt.SIZE:]
+
+    def full(self, num: BeltNum) -> LaneNum:
+        n = len(self.vms)
+        value = num.int_value
+        return LaneNum(num.data_type,
+                       np.full(n, 0 if value is None else value, dtype=_dtype(num.data_type)),
+                       np.full(n, value is None, dtype=bool))
+
+    def fail(self, mask: np.ndarray, make_error: Callable[[int], Exception]) -> None:
+        for lane in np.flatnonzero(mask & self.active):
+            self.errors[lane] = make_error(lane)
+            self.active[lane] = False
+
+    def each(self, f: Callable[[VM], object]) -> Dict[int, object]:
+        """
+        Calls f with the VM of every running lane; lanes for which it raises fail.
+        """
+        results = {}
+        for lane in np.flatnonzero(self.active):
+            try:
+                results[lane] = f(self.vms[lane])
+            except Exception as ex:
+                self.errors[lane] = ex
+                self.active[lane] = False
+        return results
+
+    def pack(self, items: List[BeltItem]) -> LaneItem:
+        active = self.active.tolist()
+        data_types = {item.data_type if isinstance(item, BeltNum) else None
+                      for item, is_active in zip(items, active) if is_active}
+        if len(data_types) != 1 or None in data_types:
+            return items
+        data_type, = data_types
+        values = [item.int_value or 0 if is_active else 0 for item, is_active in zip(items, active)]
+        err = [is_active and item.int_value is None for item, is_active in zip(items, active)]
+        return LaneNum(data_type, np.array(values, dtype=_dtype(data_type)), np.array(err, dtype=bool))
+
+    def unpack(self) -> None:
+        """
+        Reads the belts and locals of the running lanes from their VMs.
+        """
+        vms = self.vms
+        self.belt = [self.pack([vm.belt()[idx] for vm in vms]) for idx in range(Belt.SIZE)]
+        num_locals = vms[0].num_locals() if vms else 0
+        self.locals = [self.pack([vm.local(idx) for vm in vms]) for idx in range(num_locals)]
+
+    def store(self) -> None:
+        """
+        Writes the belts, locals and alignment of the running lanes to their VMs.
+        """
+        belt_columns = [_lane_items(item) for item in reversed(self.belt)]
+        local_columns = [_lane_items(item) for item in self.locals]
+        for lane in np.flatnonzero(self.active):
+            vm = self.vms[lane]
+            belt = vm.belt()
+            for column in belt_columns:
+                belt.push(column[lane])
+            for idx, column in enumerate(local_columns):
+                vm.set_local(idx, column[lane])
+            vm.set_alignment(self.alignment)
+
+    def step_scalar(self, runner: Runner) -> None:
+        def run(vm: VM) -> None:
+            if runner(vm) is not None:
+                raise ValueError(f'Unexpected break from {runner}')
+
+        self.store()
+        self.each(run)
+        self.unpack()
+
+    def diverge(self, program: FlatProgram, pcs: Dict[int, int]) -> None:
+        """
+        Finishes every running lane with the scalar flat engine, lane i resuming at pcs[i].
+        """
+        self.store()
+        for lane in np.flatnonzero(self.active):
+            try:
+                program.run(self.vms[lane], pcs[lane], self.saved_alignments)
+            except Exception as ex:
+                self.errors[lane] = ex
+        self.active[:] = False
+
+
+def _lane_items(item: LaneItem) -> List[BeltItem]:
+    if not isinstance(item, LaneNum):
+        return item
+    data_type, of = item.data_type, BeltNum.of
+    err_num = data_type.err_num
+    return [err_num if err else of(data_type, value) for value, err in zip(item.values.tolist(), item.err.tolist())]
+
+
+def _const(lanes: Lanes, ins: InsConst) -> None:
+    belt_num, = ins.payload()
+    lanes.push(lanes.full(belt_num))
+
+
+def _local_get(lanes: Lanes, ins: InsLocalGet) -> None:
+    local_idx, = ins.payload()
+    lanes.push(lanes.locals[local_idx])
+
+
+def _local_set(lanes: Lanes, ins: InsLocalSet) -> None:
+    local_idx, = ins.payload()
+    lanes.locals[local_idx] = lanes.belt[0]
+
+
+def _is_err(lanes: Lanes, ins: InsIsErr) -> None:
+    item_idx, = ins.payload()
+    num = lanes.num(item_idx)
+    lanes.push(LaneNum(DataType.I8, num.err.astype(np.int64), np.zeros_like(num.err)))
+
+
+def _verify(lanes: Lanes, ins: InsVerify) -> None:
+    item_idx, = ins.payload()
+    num = lanes.num(item_idx)
+    lanes.fail(num.err | (num.values == 0), lambda _: ValueError('Verify failed'))
+
+
+def _verify_ok(lanes: Lanes, ins: InsVerifyOk) -> None:
+    item_idx, = ins.payload()
+    lanes.fail(lanes.num(item_idx).err, lambda _: ValueError('Verify failed'))
+
+
+_REL_OPS = {
+    int.__eq__: np.equal,
+    int.__ne__: np.not_equal,
+    int.__lt__: np.less,
+    int.__le__: np.less_equal,
+    int.__gt__: np.greater,
+    int.__ge__: np.greater_equal,
+}
+
+
+def _rel_operands(lanes: Lanes, a_idx: int, b_idx: int, is_signed: bool, op):
+    rel_op = _REL_OPS.get(op)
+    if rel_op is None:
+        raise _Scalar
+    a, b = lanes.num(a_idx), lanes.num(b_idx)
+    return rel_op(_signed(a, is_signed), _signed(b, is_signed)), a.err | b.err
+
+
+def _push_rel(lanes: Lanes, a_idx: int, b_idx: int, is_signed: bool, op) -> None:
+    result, err = _rel_operands(lanes, a_idx, b_idx, is_signed, op)
+    lanes.push(LaneNum(DataType.I8, np.where(err, 0, result).astype(np.int64), err))
+
+
+def _rel(lanes: Lanes, ins: InsRel) -> None:
+    _push_rel(lanes, *ins.payload())
+
+
+def _compare(lanes: Lanes, ins: InsCompare) -> None:
+    _push_rel(lanes, *ins.payload(), ins.is_signed, ins.op)
+
+
+def _rel_verify(lanes: Lanes, ins: InsRelVerify) -> None:
+    result, err = _rel_operands(lanes, *ins.payload())
+    lanes.fail(err | ~result, lambda _: ValueError('Verify failed'))
+
+
+class _ArithOp(NamedTuple):
+    ufunc: np.ufunc
+    raises: Optional[Callable[[np.ndarray], np.ndarray]]  # lanes (by right operand) in which the int op raises
+    exact_bits: int  # int64 gives exact results for operands of up to this many bits, wider ones use Python ints
+
+
+_ARITH_OPS = {
+    int.__add__: _ArithOp(np.add, None, 32),
+    int.__sub__: _ArithOp(np.subtract, None, 32),
+    int.__mul__: _ArithOp(np.multiply, None, 16),
+    int.__floordiv__: _ArithOp(np.floor_divide, lambda b: b == 0, 0),
+    int.__mod__: _ArithOp(np.remainder, lambda b: b == 0, 0),
+    int.__lshift__: _ArithOp(np.left_shift, lambda b: b < 0, 0),
+    int.__rshift__: _ArithOp(np.right_shift, lambda b: b < 0, 0),
+    int.__and__: _ArithOp(np.bitwise_and, None, 32),
+    int.__or__: _ArithOp(np.bitwise_or, None, 32),
+    int.__xor__: _ArithOp(np.bitwise_xor, None, 32),
+}
+
+
+def _binary_operands(lanes: Lanes, param_indices, is_signed: bool, exact_bits: int):
+    if len(param_indices) != 2:
+        raise _Scalar
+    a_idx, b_idx = param_indices
+    a_num, b_num = lanes.num(a_idx), lanes.num(b_idx)
+    data_type = a_num.data_type.promote(b_num.data_type)
+    a, b = _signed(a_num, is_signed), _signed(b_num, is_signed)
+    if data_type.value > exact_bits:
+        a, b = a.astype(object), b.astype(object)
+    return data_type, a, b, a_num.err | b_num.err
+
+
+def _fail_raising(lanes: Lanes, raises, op, a: np.ndarray, b: np.ndarray, err: np.ndarray) -> np.ndarray:
+    """
+    Fails the lanes in which the scalar op raises with the error it raises, returns b with those lanes made safe.
+    """
+    raising = raises(b) & ~err & lanes.active
+
+    def make_error(lane: int) -> Exception:
+        try:
+            op(int(a[lane]), int(b[lane]))
+        except Exception as ex:
+            return ex
+        raise ValueError('Unreachable')
+
+    lanes.fail(raising, make_error)
+    return np.where(raises(b), 1, b)
+
+
+def _push_checked(lanes: Lanes, param_indices, is_signed: bool, arith_op) -> None:
+    op = _ARITH_OPS.get(arith_op)
+    if op is None:
+        raise _Scalar
+    data_type, a, b, err = _binary_operands(lanes, param_indices, is_signed, op.exact_bits)
+    if op.raises is not None:
+        b = _fail_raising(lanes, op.raises, arith_op, a, b, err)
+    result = op.ufunc(a, b)
+    err = err | (result > data_type.max_value(is_signed)) | (result < data_type.min_value(is_signed))
+    lanes.push(_lane_num(data_type, result, err))
+
+
+def _arith(lanes: Lanes, ins: InsArith) -> None:
+    param_indices, is_signed, arith_mode, arith_op = ins.payload()
+    if arith_mode != ArithMode.CHECKED:
+        raise _Scalar
+    _push_checked(lanes, param_indices, is_signed, arith_op)
+
+
+def _checked(lanes: Lanes, ins: InsBinary) -> None:
+    _push_checked(lanes, ins.payload(), ins.is_signed, ins.op)
+
+
+def _push_divmod(lanes: Lanes, param_indices, is_signed: bool) -> None:
+    data_type, a, b, err = _binary_operands(lanes, param_indices, is_signed, 0)
+    if (err & lanes.active).any():
+        # an Err operand makes the op push a single Err instead of two results, the belts of the lanes would differ
+        raise _Scalar
+    err = b == 0
+    b = np.where(err, 1, b)
+    div, mod = np.floor_divide(a, b), np.remainder(a, b)
+    if ((div > data_type.max_value(is_signed)) & lanes.active).any():
+        # the minimum divided by -1 doesn't fit, BeltNum.from_signed raises on it
+        raise _Scalar
+    lanes.push(_lane_num(data_type, mod, err))
+    lanes.push(_lane_num(data_type, div, err))
+
+
+def _nary(lanes: Lanes, ins: InsNAryOp) -> None:
+    param_indices, is_signed, op = ins.payload()
+    if op is not divmod_op:
+        raise _Scalar
+    _push_divmod(lanes, param_indices, is_signed)
+
+
+def _divmod(lanes: Lanes, ins: InsDivMod) -> None:
+    _push_divmod(lanes, ins.payload(), ins.is_signed)
+
+
+def _convert(lanes: Lanes, ins: InsConvert) -> None:
+    item_idx, data_type, is_signed, op = ins.payload()
+    num = lanes.num(item_idx)
+    if num.data_type is data_type:
+        lanes.push(num)
+        return
+    is_extend = num.data_type.value < data_type.value
+    if op is BeltNum.extend and is_extend:
+        lanes.push(_lane_num(data_type, _signed(num, is_signed), num.err))
+    elif op is cast_wrap and not is_extend:
+        lanes.push(_lane_num(data_type, num.values, num.err))
+    elif op is BeltNum.cast_sat and not is_extend:
+        values = np.clip(_signed(num, is_signed), data_type.min_value(is_signed), data_type.max_value(is_signed))
+        lanes.push(_lane_num(data_type, values, num.err))
+    elif op is BeltNum.cast_checked and not is_extend:
+        values = _signed(num, is_signed)
+        err = num.err | (values < data_type.min_value(is_signed)) | (values > data_type.max_value(is_signed))
+        lanes.push(_lane_num(data_type, values, err))
+    else:
+        # unknown conversions and casts in the wrong direction (which raise) are left to the instruction
+        raise _Scalar
+
+
+def _fused(lanes: Lanes, ins: InsFused) -> None:
+    for part in ins.pair():
+        _step(lanes, part, part.build())
+
+
+_LANE_OPS: Dict[type, Callable[[Lanes, Instruction], None]] = {
+    InsConst: _const,
+    InsLocalGet: _local_get,
+    InsLocalSet: _local_set,
+    InsIsErr: _is_err,
+    InsVerify: _verify,
+    InsVerifyOk: _verify_ok,
+    InsRel: _rel,
+    InsRelVerify: _rel_verify,
+    InsArith: _arith,
+    InsNAryOp: _nary,
+    InsConvert: _convert,
+    InsDivModUnsigned: _divmod,
+    InsDivModSigned: _divmod,
+    **{cls: _checked for cls in CHECKED.values()},
+    **{cls: _compare for cls in COMPARE.values()},
+    InsPushBinary: _fused,
+}
+
+
+def _step(lanes: Lanes, ins: Optional[Instruction], runner: Runner) -> None:
+    lane_op = _LANE_OPS.get(type(ins))
+    try:
+        if lane_op is None:
+            raise _Scalar
+        lane_op(lanes, ins)
+    except _Scalar:
+        lanes.step_scalar(runner)
+
+
+def run_lanes(program: FlatProgram, vms: Sequence[VM]) -> List[Optional[Exception]]:
+    """
+    Runs program on all vms, like program.run on each of them. Returns the error of each lane, None if it ran
+    through; the VMs of those lanes end up in the same state as after program.run.
+    """
+    lanes = Lanes(vms)
+    code = program.code()
+    pc = 0
+    while lanes.active.any():
+        opcode = code[pc]
+        if opcode == flat.CALL:
+            _step(lanes, program.call(pc), code[pc + 1])
+            pc += 2
+        elif opcode == flat.LOOP_NEXT:
+            done = lanes.each(lambda vm: vm.loop_stack().next())
+            targets = {lane: code[pc + 1] if is_done else pc + 2 for lane, is_done in done.items()}
+            if len(set(targets.values())) > 1:
+                lanes.diverge(program, targets)
+                break
+            pc = targets.popitem()[1] if targets else pc
+        elif opcode == flat.JUMP:
+            pc = code[pc + 1]
+        elif opcode == flat.JUMP_IF_ZERO or opcode == flat.CALL_JUMP_IF_ZERO:
+            condition_idx = code[pc + 1]
+            if opcode == flat.CALL_JUMP_IF_ZERO:
+                # compare-and-branch: the compare, then the jump on its result like JUMP_IF_ZERO; the compare pushes
+                # I8 numbers, so the condition is a LaneNum and the jump can't be redone from pc
+                compare, _ = program.call(pc).pair()
+                _step(lanes, compare, compare.build())
+                condition_idx = 0
+            condition = lanes.belt[condition_idx]
+            if not isinstance(condition, LaneNum):
+                lanes.diverge(program, {lane: pc for lane in np.flatnonzero(lanes.active)})
+                break
+            lanes.fail(condition.err, lambda _: ValueError('Expected int, got Err'))
+            running = np.flatnonzero(lanes.active)
+            targets = {lane: pc + 3 if condition.values[lane] else code[pc + 2] for lane in running}
+            if len(set(targets.values())) > 1:
+                lanes.diverge(program, targets)
+                break
+            pc = targets.popitem()[1] if targets else pc
+        elif opcode == flat.LOOP_START:
+            lanes.each(lambda vm: vm.loop_stack().start_loop())
+            pc += 1
+        elif opcode == flat.BREAK_LOOP:
+            lanes.each(lambda vm: vm.loop_stack().break_loop())
+            pc += 1
+        elif opcode == flat.CONTINUE_LOOP:
+            lanes.each(lambda vm: vm.loop_stack().continue_loop())
+            pc += 1
+        elif opcode == flat.SET_ALIGN:
+            lanes.saved_alignments.append(lanes.alignment)
+            lanes.alignment = code[pc + 1]
+            pc += 2
+        elif opcode == flat.RESTORE_ALIGN:
+            lanes.alignment = lanes.saved_alignments.pop()
+            pc += 1
+        elif opcode == flat.RAISE:
+            message = code[pc + 1]
+            lanes.fail(lanes.active, lambda _: ValueError(message))
+        elif opcode == flat.HALT:
+            lanes.store()
+            break
+        else:
+            raise ValueError(f'Unknown opcode {opcode} at {pc}')
+    return lanes.errors
+
+
+def run_program_lanes(program: CachedProgram, unlock_data: Sequence[UnlockData]) -> List[Optional[Exception]]:
+    """
+    Runs a program once for each of the unlock data, like verify.run_program, but vectorized over all of them.
+    """
+    vms = [
+        VM(LoopStack(load_loop_trees(data.loop_trees)), program.compile_result.num_locals, data.ram_size)
+        for data in unlock_data
+    ]
+    return run_lanes(flat.lower(program.block), vms)
@@ -4,12 +4,14 @@ from typing import List, Dict, Tuple, NamedTuple, Set, Optional
 
 from lark import Lark, Tree
 
-from belt import BeltNum, DataType, Integer, Belt, BeltSlice
+from belt import BeltNum, DataType, Belt, BeltSlice
 from op import Instruction, Block
-from ops.arith import InsArith, ArithMode, InsRel, InsRelVerify, InsNAryOp, InsConvert
+from ops.arith import ArithMode, InsRelVerify, InsConvert, cast_wrap
+from ops.binary import CHECKED, COMPARE, WIDENING, DIVMOD
 from ops.flow import InsLoopSpecified, InsIfUnspecified, InsUnreachable, InsNop, InsBr, InsBrIf, InsBrContinue
 from ops.misc import InsConst, InsLocalSet, InsLocalGet, InsVerify, InsVerifyOk, InsIsErr, InsSliceLen, InsSliceOp, \
-    InsSubSlice, InsLoad, InsStore
+    InsSubSlice, InsLoad, InsStore, InsRam, InsSliceCopy, InsSliceFill, InsSliceRel, InsSliceFind
+from ops.digest import InsDigest, InsHashInit, InsHashUpdate, InsHashFinal, ripemd160, sha256
 
 import re
 
@@ -21,15 +23,15 @@ loop: "loop" NAME "{" statement* "}"
 assign: assign_target "=" expr ";"
 call_stmt: call ";"
 store: NAME "[" OFFSET "]" "=" NAME ";"
-load: NAME "=" NAME "[" OFFSET "]" "as" TYPE ";"
+load: assign_target "=" NAME "[" OFFSET "]" "as" TYPE ";"
 if: "if" NAME then else?
 then: "{" statement* "}"
 else: "else" "{" statement* "}"
 expr: lit | name | call | operation | slicing
 call: NAME "(" params ")"
-params: (NAME ",")* (NAME ","?)?
+params: (NAME ("," NAME)* ","?)?
 assign_target: local_name | assign_target_names
-assign_target_names: (NAME ",")* NAME ","?
+assign_target_names: NAME ("," NAME)* ","?
 name: NAME | LOCAL_NAME
 local_name: LOCAL_NAME
 operation: NAME OPERATOR NAME
@@ -38,9 +40,9 @@ lit: NUM
 VERSION: /\d+\.\d+\.\d+/
 NAME: /[a-zA-Z0-9_]+/
 LOCAL_NAME: /\$[a-zA-Z0-9_]+/
-NUM: /(-?\d[\d_]*)(i|u)(8|16|32|64)/
+NUM.2: /(-?\d[\d_]*)(i|u)(8|16|32|64)(?![a-zA-Z0-9_])/
 TYPE: /(i|u)(8|16|32|64)/
-OFFSET: /\d+/
+OFFSET.2: /\d+(?![a-zA-Z0-9_])/
 OPERATOR: "_+_" | "_-_" | "_*_" | "+" | "-" | "*" | "/" | "%" | "<<" | ">>" | "&" | "|" | "^" | "==" | "!=" | "<" | "<=" | ">" | ">="
 SLICE_SEP: ".."
 COMMENT: /#.*/
@@ -50,21 +52,45 @@ COMMENT: /#.*/
 %ignore "\n"
 """
 
+# built once per process: LALR with the contextual lexer is deterministic and parses in linear time, unlike the
+# default Earley parser. Compilers share it, it holds no per-parse state.
+parser = Lark(grammar, parser='lalr', lexer='contextual')
+
 
 class CompilerBeltItem(NamedTuple):
     name: str
     is_signed: Optional[bool]
     is_slice: bool
+    data_type: Optional[DataType]  # exact type of a number, None for slices
     is_consistent: bool = True
     other_item: Optional['CompilerBeltItem'] = None
+    aliases: Tuple[str, ...] = ()  # other names of the item, given by conversions that are no-ops
+
+    def has_name(self, name: str) -> bool:
+        return self.name == name or name in self.aliases
+
+    def same_type(self, other: 'CompilerBeltItem') -> bool:
+        return self.is_signed == other.is_signed and self.is_slice == other.is_slice and \
+            self.data_type == other.data_type
 
 
 class CompilerLocal(NamedTuple):
     is_signed: Optional[bool]
     is_slice: bool
+    data_type: Optional[DataType]
     local_idx: int
 
 
+def _type_name(item) -> str:
+    if item.is_slice:
+        return 'slice'
+    return f'{"i" if item.is_signed else "u"}{item.data_type.value}'
+
+
+# hash of the sha256 and ripemd160 calls, and of their _init variants
+HASH_CALLS = {'sha256': sha256, 'ripemd160': ripemd160}
+
+
 @dataclass
 class Scope:
     scope_name: Optional[str]
@@ -81,25 +107,49 @@ class Compiler:
     VERSION = '0.0.1'
     REG_LIT = re.compile(r'^(-?\d+)([iu])(8|16|32|64)$')
     REG_TYPE = re.compile(r'^([iu])(8|16|32|64)$')
-    REG_CAST = re.compile(r'(cast_extend|cast_warp|cast_sat|cast_checked)(8|16|32|64)')
+    REG_CAST = re.compile(r'(cast_extend|cast_wrap|cast_sat|cast_checked)(8|16|32|64)')
 
-    def __init__(self) -> None:
-        self._grammar = Lark(grammar)
+    def __init__(self, grammar_parser: Lark = parser) -> None:
+        self._grammar = grammar_parser
         self._belt: List[CompilerBeltItem] = []
         self._locals: Dict[str, CompilerLocal] = {}
         self._scopes: List[Scope] = []
 
+    def reset(self) -> None:
+        self._belt = []
+        self._locals = {}
+        self._scopes = []
+
     def compile(self, src: str) -> CompileResult:
+        self.reset()
         tree = self._grammar.parse(src)
         instructions = self._handle_program(tree)
         return CompileResult(instructions, len(self._locals))
 
     def _push(self, item: CompilerBeltItem):
-        del self._belt[Belt.SIZE:]
+        del self._belt[Belt.SIZE - 1:]
         self._belt.insert(0, item)
         if self._scopes:
             self._scopes[-1].belt_items.add(item.name)
 
+    def _alias(self, idx: int, name: str) -> bool:
+        """
+        Gives the belt item at idx another name instead of pushing an identical copy of it. Not possible if an item in
+        front of it already has that name, it would shadow the alias.
+        """
+        if any(item.has_name(name) for item in self._belt[:idx]):
+            return False
+        if self._belt[idx].has_name(name):
+            return True
+        for other_idx, item in enumerate(self._belt):
+            if name in item.aliases:
+                self._belt[other_idx] = item._replace(aliases=tuple(alias for alias in item.aliases if alias != name))
+        item = self._belt[idx]
+        self._belt[idx] = item._replace(aliases=(name,) + item.aliases)
+        if self._scopes:
+            self._scopes[-1].belt_items.add(name)
+        return True
+
     def _begin_scope(self, name: Optional[str]):
         self._scopes.append(Scope(name, set(), []))
 
@@ -108,14 +158,14 @@ class Compiler:
 
     def _get_item(self, name: str, assert_is_slice: Optional[bool] = None) -> Tuple[int, CompilerBeltItem]:
         for idx, item in enumerate(self._belt):
-            if item.name == name:
+            if item.has_name(name):
                 if not item.is_consistent:
                     raise ValueError(f"Inconsistent belt item (due to branch), got {item}")
                 if assert_is_slice is not None and item.is_slice != assert_is_slice:
                     raise ValueError(f"Invalid type: {name} is a {'number' if assert_is_slice else 'slice'}")
                 if self._scopes:
-                    if item.name not in self._scopes[-1].belt_items:
-                        self._scopes[-1].out_of_scope_access.append(item.name)
+                    if name not in self._scopes[-1].belt_items:
+                        self._scopes[-1].out_of_scope_access.append(name)
                 return idx, item
         raise ValueError(f"Belt item with the name `{name}` not found, maybe it's pushed of the belt? "
                          f"Consider using locals in this case.")
@@ -161,12 +211,12 @@ class Compiler:
         scope = self._scopes[-1]
         for name in scope.out_of_scope_access:
             for new_idx, new_item in enumerate(self._belt):
-                if new_item.name == name:
+                if new_item.has_name(name):
                     break
             else:
                 raise ValueError(f'Invalid loop: loop variable {name} not on belt')
             for old_idx, old_item in enumerate(belt_before_loop):
-                if old_item.name == name:
+                if old_item.has_name(name):
                     break
             else:
                 raise ValueError(f'Unreachable')
@@ -175,6 +225,11 @@ class Compiler:
                     f'Invalid loop: Incompatible signs, old item {"is" if old_item.is_signed else "is not"} signed, '
                     f'but new item {"is" if new_item.is_signed else "is not"}.'
                 )
+            if not new_item.same_type(old_item):
+                raise ValueError(
+                    f'Invalid loop: loop variable {name} changes its type from {_type_name(old_item)} '
+                    f'to {_type_name(new_item)}'
+                )
             if new_idx != old_idx:
                 raise ValueError(
                     f'Invalid loop: loop variable {name} ends up on different belt positions {old_idx} != {new_idx}'
@@ -200,23 +255,19 @@ class Compiler:
             other_belt = old_belt
             else_code = []
         for idx, (other_item, belt_item) in enumerate(zip_longest(other_belt, self._belt,
-                                                                  fillvalue=CompilerBeltItem(..., None, False, False))):
+                                                                  fillvalue=CompilerBeltItem(..., None, False, None,
+                                                                                             False))):
             if not other_item.is_consistent or not belt_item.is_consistent or \
                     other_item.name != belt_item.name or \
-                    other_item.is_signed != belt_item.is_signed or \
-                    other_item.is_slice != belt_item.is_slice:
-                self._belt[idx] = CompilerBeltItem(
-                    belt_item.name,
-                    belt_item.is_signed,
-                    belt_item.is_slice,
-                    False,
-                    other_item,
-                )
+                    other_item.aliases != belt_item.aliases or \
+                    not other_item.same_type(belt_item):
+                self._belt[idx] = belt_item._replace(is_consistent=False, other_item=other_item)
         return [InsIfUnspecified(condition_idx, Block(then_code), Block(else_code))]
 
     def _handle_assign(self, assign: Tree) -> List[Instruction]:
         target, expr = assign.children
-        names = [name.children[0] for name in target.children]
+        target, = target.children
+        names = list(target.children)
         return self._handle_expr(names, expr)
 
     def _handle_call_stmt(self, call_stmt: Tree) -> List[Instruction]:
@@ -249,7 +300,6 @@ class Compiler:
                     scope_name = None
             br_depth = 1
             if scope_name is not None:
-                scope_name, = params
                 for idx, scope in enumerate(reversed(self._scopes)):
                     if scope.scope_name == scope_name:
                         br_depth = idx + 1
@@ -286,10 +336,48 @@ class Compiler:
                     f'Incompatible operands, {a_name} {"is" if a.is_signed else "is not"} signed, '
                     f'but {b_name} {"is" if b.is_signed else "is not"}.'
                 )
-            return [InsRelVerify(a_idx, b_idx, a.is_signed, lambda x, y: x == y)]
+            return [InsRelVerify(a_idx, b_idx, a.is_signed, int.__eq__)]
+        elif call_name == 'copy':
+            if len(params) != 2:
+                raise ValueError(f'{call_name} takes exactly 2 arguments')
+            dst_name, src_name = params
+            dst_idx, _ = self._get_item(dst_name, True)
+            src_idx, _ = self._get_item(src_name, True)
+            return [InsSliceCopy(dst_idx, src_idx)]
+        elif call_name == 'fill':
+            if len(params) != 2:
+                raise ValueError(f'{call_name} takes exactly 2 arguments')
+            dst_name, value_name = params
+            dst_idx, _ = self._get_item(dst_name, True)
+            value_idx = self._get_byte(call_name, value_name)
+            return [InsSliceFill(dst_idx, value_idx)]
+        elif call_name in {'sha256', 'ripemd160'}:
+            if len(params) != 2:
+                raise ValueError(f'{call_name} takes exactly 2 arguments')
+            dst_name, src_name = params
+            dst_idx, _ = self._get_item(dst_name, True)
+            src_idx, _ = self._get_item(src_name, True)
+            return [InsDigest(dst_idx, src_idx, HASH_CALLS[call_name])]
+        elif call_name in {'hash_update', 'hash_final'}:
+            if len(params) != 2:
+                raise ValueError(f'{call_name} takes exactly 2 arguments')
+            handle_name, slice_name = params
+            handle_idx, handle = self._get_item(handle_name, False)
+            if handle.data_type is not DataType.I32 or handle.is_signed:
+                raise ValueError(f'{call_name} takes a hash handle, got {handle_name} of type {_type_name(handle)}')
+            slice_idx, _ = self._get_item(slice_name, True)
+            if call_name == 'hash_update':
+                return [InsHashUpdate(handle_idx, slice_idx)]
+            return [InsHashFinal(handle_idx, slice_idx)]
         else:
             raise ValueError(f'Unknown call statement: {call_name}')
 
+    def _get_byte(self, call_name: str, name: str) -> int:
+        idx, item = self._get_item(name, False)
+        if item.data_type is not DataType.I8:
+            raise ValueError(f'{call_name} takes an 8 bit number, got {name} of type {_type_name(item)}')
+        return idx
+
     def _handle_store(self, store: Tree) -> List[Instruction]:
         target_name, offset_lit, value_name = store.children
         target_idx, _ = self._get_item(target_name, True)
@@ -298,13 +386,17 @@ class Compiler:
         return [InsStore(value_idx, target_idx, offset)]
 
     def _handle_load(self, load: Tree) -> List[Instruction]:
-        target_name, source_name, offset_lit, type_name = load.children
+        target, source_name, offset_lit, type_name = load.children
+        target, = target.children
+        if target.data == 'local_name':
+            raise ValueError('Cannot load into locals, load onto the belt first')
+        target_name, = target.children
         source_idx, _ = self._get_item(source_name, True)
         offset = int(offset_lit)
         type_match = self.REG_TYPE.match(type_name)
         is_signed = type_match.group(1) == 'i'
         bit_size = int(type_match.group(2))
-        self._push(CompilerBeltItem(target_name, is_signed, False))
+        self._push(CompilerBeltItem(target_name, is_signed, False, DataType(bit_size)))
         return [InsLoad(DataType(bit_size), source_idx, offset)]
 
     def _handle_expr(self, names: List[str], expr: Tree) -> List[Instruction]:
@@ -332,8 +424,8 @@ class Compiler:
         num = int(m.group(1))
         is_signed = m.group(2) == 'i'
         bit_size = int(m.group(3))
-        self._push(CompilerBeltItem(assigned_name, is_signed, False))
-        return [InsConst(BeltNum.from_signed(Integer(num), DataType(bit_size), is_signed))]
+        self._push(CompilerBeltItem(assigned_name, is_signed, False, DataType(bit_size)))
+        return [InsConst(BeltNum.from_signed(num, DataType(bit_size), is_signed))]
 
     def _handle_name(self, names: List[str], name: Tree) -> List[Instruction]:
         assigned_name, = names
@@ -343,9 +435,14 @@ class Compiler:
                 raise ValueError('Can only assign belt items to locals, not local to local')
             self._get_item(source_name)
             front = self._belt[0]
-            if front.name != source_name:
+            if not front.has_name(source_name):
                 raise ValueError(f'Can only assign the front belt ({front.name}) item to a local, got {source_name}')
-            local = self._locals.setdefault(assigned_name, CompilerLocal(front.is_signed, front.is_slice, len(self._locals)))
+            local = self._locals.setdefault(
+                assigned_name, CompilerLocal(front.is_signed, front.is_slice, front.data_type, len(self._locals))
+            )
+            if (local.is_signed, local.is_slice, local.data_type) != (front.is_signed, front.is_slice, front.data_type):
+                raise ValueError(f'Cannot assign {source_name} of type {_type_name(front)} to local {assigned_name} '
+                                 f'of type {_type_name(local)}')
             return [InsLocalSet(local.local_idx)]
         else:
             if not source_name.startswith('$'):
@@ -353,7 +450,7 @@ class Compiler:
             local = self._locals.get(source_name, None)
             if local is None:
                 raise ValueError(f'Local {source_name} not defined')
-            self._push(CompilerBeltItem(assigned_name, local.is_signed, local.is_slice))
+            self._push(CompilerBeltItem(assigned_name, local.is_signed, local.is_slice, local.data_type))
             return [InsLocalGet(local.local_idx)]
 
     def _handle_call(self, names: List[str], call: Tree) -> List[Instruction]:
@@ -365,7 +462,7 @@ class Compiler:
             item_name, = params
             result_name, = names
             item_idx, item = self._get_item(item_name, False)
-            self._push(CompilerBeltItem(result_name, False, False))
+            self._push(CompilerBeltItem(result_name, False, False, DataType.I8))
             return [InsIsErr(item_idx)]
         elif call_name == 'length':
             if len(params) != 1:
@@ -373,8 +470,40 @@ class Compiler:
             slice_name, = params
             result_name, = names
             slice_idx, _ = self._get_item(slice_name, True)
-            self._push(CompilerBeltItem(result_name, False, False))
+            self._push(CompilerBeltItem(result_name, False, False, DataType.I32))
             return [InsSliceLen(slice_idx)]
+        elif call_name == 'ram':
+            if params:
+                raise ValueError(f'{call_name} takes no arguments')
+            result_name, = names
+            self._push(CompilerBeltItem(result_name, None, True, None))
+            return [InsRam()]
+        elif call_name in {'sha256_init', 'ripemd160_init'}:
+            if params:
+                raise ValueError(f'{call_name} takes no arguments')
+            result_name, = names
+            # the handle of the hash state, an u32
+            self._push(CompilerBeltItem(result_name, False, False, DataType.I32))
+            return [InsHashInit(HASH_CALLS[call_name[:-len('_init')]])]
+        elif call_name in {'compare', 'equal'}:
+            if len(params) != 2:
+                raise ValueError(f'{call_name} takes exactly 2 arguments')
+            a_name, b_name = params
+            result_name, = names
+            a_idx, _ = self._get_item(a_name, True)
+            b_idx, _ = self._get_item(b_name, True)
+            # compare gives -1, 0 or 1, equal 0 or 1
+            self._push(CompilerBeltItem(result_name, call_name == 'compare', False, DataType.I8))
+            return [InsSliceRel(a_idx, b_idx, BeltSlice.compare if call_name == 'compare' else BeltSlice.equals)]
+        elif call_name == 'find':
+            if len(params) != 2:
+                raise ValueError(f'{call_name} takes exactly 2 arguments')
+            slice_name, value_name = params
+            result_name, = names
+            slice_idx, _ = self._get_item(slice_name, True)
+            value_idx = self._get_byte(call_name, value_name)
+            self._push(CompilerBeltItem(result_name, False, False, DataType.I32))
+            return [InsSliceFind(slice_idx, value_idx)]
         elif call_name in {'trim_l', 'trim_r', 'shrink'}:
             if len(params) != 2:
                 raise ValueError(f'{call_name} takes exactly 2 argument')
@@ -382,7 +511,7 @@ class Compiler:
             result_name, = names
             slice_idx, _ = self._get_item(slice_name, True)
             num_bytes_idx, _ = self._get_item(num_bytes_name, False)
-            self._push(CompilerBeltItem(result_name, None, True))
+            self._push(CompilerBeltItem(result_name, None, True, None))
             return [InsSliceOp(slice_idx, num_bytes_idx, {
                 'trim_l': BeltSlice.trim_l,
                 'trim_r': BeltSlice.trim_r,
@@ -399,9 +528,10 @@ class Compiler:
                 raise ValueError(
                     f'Incompatible operands, {a_name} {"is" if a.is_signed else "is not"} signed, '
                     f'but {b_name} {"is" if b.is_signed else "is not"}.')
-            self._push(CompilerBeltItem(div_name, a.is_signed, False))
-            self._push(CompilerBeltItem(mod_name, a.is_signed, False))
-            return [InsNAryOp([a_idx, b_idx], a.is_signed, lambda _, x, y: [None, None] if y == 0 else divmod(x, y))]
+            data_type = a.data_type.promote(b.data_type)
+            self._push(CompilerBeltItem(mod_name, a.is_signed, False, data_type))
+            self._push(CompilerBeltItem(div_name, a.is_signed, False, data_type))
+            return [DIVMOD[a.is_signed](a_idx, b_idx)]
         elif call_name in {'rotl', 'rotr', 'clz', 'ctz', 'popcnt'}:
             raise NotImplemented
         else:
@@ -413,14 +543,12 @@ class Compiler:
                 item_name, = params
                 result, = names
                 item_idx, item = self._get_item(item_name, False)
-                self._push(CompilerBeltItem(result, item.is_signed, False))
                 if call_name == 'cast_extend':
                     if bit_size == 8:
                         raise ValueError("Cannot use cast_extend8")
                     func = BeltNum.extend
                 elif call_name == 'cast_wrap':
-                    def func(num: BeltNum, _data_type: DataType, _: bool) -> BeltNum:
-                        return num.wrap(_data_type)
+                    func = cast_wrap
                     if bit_size == 64:
                         raise ValueError("Cannot use cast_wrap8")
                 elif call_name == 'cast_sat':
@@ -433,6 +561,13 @@ class Compiler:
                     func = BeltNum.cast_checked
                 else:
                     raise ValueError('Unreachable')
+                if (item.data_type.bits > data_type.bits) if func is BeltNum.extend else \
+                        (item.data_type.bits < data_type.bits):
+                    raise ValueError(f'Cannot use {call_name}{bit_size} on {item_name} of type {_type_name(item)}')
+                if item.data_type is data_type and self._alias(item_idx, result):
+                    # converting to the same type returns the item itself, it only needs another name
+                    return []
+                self._push(CompilerBeltItem(result, item.is_signed, False, data_type))
                 return [InsConvert(item_idx, data_type, item.is_signed, func)]
             else:
                 raise ValueError(f"Unknown function {call_name}")
@@ -446,6 +581,7 @@ class Compiler:
                 f'Incompatible operands, {a_name} {"is" if a.is_signed else "is not"} signed, '
                 f'but {b_name} {"is" if b.is_signed else "is not"}.')
         is_signed = a.is_signed
+        data_type = a.data_type.promote(b.data_type)
         if op == '_+_':
             arith_mode, func = ArithMode.WIDENING, int.__add__
         elif op == '_-_':
@@ -488,40 +624,43 @@ class Compiler:
             raise ValueError(f'Unexpected operator {op}')
         if arith_mode is None:
             name, = names
-            self._push(CompilerBeltItem(name, is_signed, False))
-            return [InsRel(a_idx, b_idx, is_signed, func)]
+            self._push(CompilerBeltItem(name, is_signed, False, DataType.I8))
+            return [COMPARE[func, is_signed](a_idx, b_idx)]
         elif arith_mode == ArithMode.WIDENING:
             result_a, result_b = names
-            self._push(CompilerBeltItem(result_b, is_signed, False))
-            self._push(CompilerBeltItem(result_a, is_signed, False))
-        elif arith_mode == ArithMode.CHECKED:
+            self._push(CompilerBeltItem(result_b, is_signed, False, data_type))
+            self._push(CompilerBeltItem(result_a, is_signed, False, data_type))
+            return [WIDENING[func, is_signed](a_idx, b_idx)]
+        else:
             result, = names
-            self._push(CompilerBeltItem(result, is_signed, False))
-        return [InsArith([a_idx, b_idx], is_signed, arith_mode, func)]
+            self._push(CompilerBeltItem(result, is_signed, False, data_type))
+            return [CHECKED[func, is_signed](a_idx, b_idx)]
 
     def _handle_slicing(self, names: List[str], slicing: Tree) -> List[Instruction]:
         slice_name, *rest = slicing.children
         start_name = rest[0] if rest[0] != '..' else None
         length_name = rest[-1] if rest[-1] != '..' else None
         result, = names
-        self._push(CompilerBeltItem(result, None, True))
         if start_name is None and length_name is None:
             raise ValueError('At least either start or length must be given for slice')
+        # the operands are looked up before the result is pushed, which moves them one further down the belt
         elif start_name is not None and length_name is not None:
             slice_idx, _ = self._get_item(slice_name, True)
             start_idx, _ = self._get_item(start_name, False)
             length_idx, _ = self._get_item(length_name, False)
-            return [InsSubSlice(slice_idx, start_idx, length_idx)]
+            code = [InsSubSlice(slice_idx, start_idx, length_idx)]
         elif start_name is not None:
             slice_idx, _ = self._get_item(slice_name, True)
             start_idx, _ = self._get_item(start_name, False)
-            return [InsSliceOp(slice_idx, start_idx, BeltSlice.trim_l)]
+            code = [InsSliceOp(slice_idx, start_idx, BeltSlice.trim_l)]
         elif length_name is not None:
             slice_idx, _ = self._get_item(slice_name, True)
-            length_idx, _ = self._get_item(start_name, False)
-            return [InsSliceOp(slice_idx, length_idx, BeltSlice.shrink)]
+            length_idx, _ = self._get_item(length_name, False)
+            code = [InsSliceOp(slice_idx, length_idx, BeltSlice.shrink)]
         else:
             raise ValueError('Unreachable')
+        self._push(CompilerBeltItem(result, None, True, None))
+        return code
 
 
 if __name__ == "__main__":
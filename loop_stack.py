@@ -1,100 +1,101 @@
-from dataclasses import dataclass
-from typing import List
+from typing import List, Tuple, Union
 
-from loop_tree import LoopTree
-
-
-@dataclass
-class LoopStackItem:
-    tree: LoopTree
-    position: int
-    inner_position: int
+from loop_tree import LazyLoopTreeArray, LoopTree, LoopTreeArray
 
 
 class LoopStack:
-    def __init__(self, loop_trees: List[LoopTree]):
-        self._loop_trees = loop_trees
+    """
+    Walks the loop trees of a witness as the program starts and iterates its loops. The trees are read from a
+    LoopTreeArray, or a LazyLoopTreeArray decoding the nodes as they are entered; the current loop is kept as integer
+    cursors (node, position, inner position) and those of the loops it is nested in are saved on a stack, so iterating
+    is an integer compare and increment.
+    """
+
+    def __init__(self, loop_trees: Union[List[LoopTree], LoopTreeArray, LazyLoopTreeArray]):
+        if isinstance(loop_trees, (LoopTreeArray, LazyLoopTreeArray)):
+            trees = loop_trees
+        else:
+            trees = LoopTreeArray.from_trees(loop_trees)
+        self._root = trees.root
+        self._child = trees.child
+        # the columns of a LazyLoopTreeArray grow in place, so they can be cached too
+        self._kinds = trees.kinds
+        self._loops = trees.loops
+        self._children = trees.children
         self._loop_index = 0
-        self._stack: List[LoopStackItem] = []
+        # (node, position, inner position) of the loops the current one is nested in
+        self._saved: List[Tuple[int, int, int]] = []
+        # the current loop; -1 if there is none, its position and number of loops are then equal so next() checks
+        self._node = -1
+        self._position = -1
+        self._inner_position = 0
+        self._num_loops = -1
+
+    def _enter(self, node: int, position: int, inner_position: int) -> None:
+        self._node = node
+        self._position = position
+        self._inner_position = inner_position
+        self._num_loops = self._loops[node] if node >= 0 else -1
 
     def start_loop(self):
-        if not self._stack:
-            tree = self._loop_trees[self._loop_index]
-            self._stack.append(LoopStackItem(
-                tree=tree,
-                position=0,
-                inner_position=0,
-            ))
+        node = self._node
+        if node < 0:
+            root = self._root(self._loop_index)
             self._loop_index += 1
-        else:
-            top = self._stack[-1]
-
-            def leaf(_):
-                raise ValueError('Cannot start loop in leaf')
-
-            def nested_loop(t: LoopTree):
-                self._stack.append(LoopStackItem(
-                    tree=t,
-                    position=0,
-                    inner_position=0,
-                ))
-                top.inner_position += 1
-
-            def rolled_out(matrix):
-                if top.position == 0:
-                    raise ValueError('Tried starting loop within loop before any iteration')
-                if top.position > len(matrix):
-                    raise ValueError('Iterated rolled out loop too far')
-                if top.inner_position >= len(matrix[top.position - 1]):
-                    raise ValueError('Tried starting a non-existing loop in a rolled out loop')
-                nested_loop(matrix[top.position - 1][top.inner_position])
-
-            def cartesian(n, children):
-                if top.position == 0:
-                    raise ValueError('Tried starting loop within loop before any iteration')
-                if top.position > n:
-                    raise ValueError('Iterated cartesian loop too far')
-                if top.inner_position >= len(children):
-                    raise ValueError('Tried starting a non-existing loop in a rolled out loop')
-                nested_loop(children[top.inner_position])
-
-            top.tree.match(
-                LEAF=leaf,
-                ROLLED_OUT=rolled_out,
-                CARTESIAN=cartesian,
-            )
+            self._enter(root, 0, 0)
+            return
+        kind = self._kinds[node]
+        if kind == LoopTreeArray.LEAF:
+            raise ValueError('Cannot start loop in leaf')
+        position = self._position
+        if position == 0:
+            raise ValueError('Tried starting loop within loop before any iteration')
+        num_children = self._children[node]
+        if kind == LoopTreeArray.ROLLED_OUT:
+            if position > self._num_loops:
+                raise ValueError('Iterated rolled out loop too far')
+        elif position > self._num_loops:
+            raise ValueError('Iterated cartesian loop too far')
+        inner_position = self._inner_position
+        if inner_position >= num_children:
+            raise ValueError('Tried starting a non-existing loop in a rolled out loop')
+        child = self._child(node, position, inner_position)
+        self._saved.append((node, position, inner_position + 1))
+        self._enter(child, 0, 0)
 
     def next(self) -> bool:
-        if not self._stack:
+        position = self._position
+        if position != self._num_loops:
+            self._position = position + 1
+            return False
+        if self._node < 0:
             raise ValueError('No current loop')
-        top = self._stack[-1]
-
-        if top.position == top.tree.num_loops():
-            self._stack.pop()
-            if self._stack:
-                top = self._stack[-1]
-                if top.inner_position == top.tree.num_children():
-                    top.inner_position = 0
-            return True
-        top.position += 1
-
-        return False
+        if self._saved:
+            node, position, inner_position = self._saved.pop()
+            if inner_position == self._children[node]:
+                inner_position = 0
+            self._enter(node, position, inner_position)
+        else:
+            self._enter(-1, -1, 0)
+        return True
 
     def break_loop(self):
-        if not self._stack:
+        if self._node < 0:
             raise ValueError('No current loop')
-        self._stack.pop()
-        if self._stack:
-            top = self._stack[-1]
-            top.inner_position += 1
-            if top.inner_position == top.tree.num_children():
-                top.inner_position = 0
+        if self._saved:
+            node, position, inner_position = self._saved.pop()
+            inner_position += 1
+            if inner_position == self._children[node]:
+                inner_position = 0
+            self._enter(node, position, inner_position)
+        else:
+            self._enter(-1, -1, 0)
 
     def continue_loop(self):
-        if not self._stack:
+        if self._node < 0:
             raise ValueError('No current loop')
-        top = self._stack[-1]
-        top.inner_position = 0
+        self._inner_position = 0
 
     def __str__(self):
-        return f'LoopStack<{self._stack}>'
+        loops = self._saved + ([(self._node, self._position, self._inner_position)] if self._node >= 0 else [])
+        return f'LoopStack<{loops}>'
@@ -1,6 +1,6 @@
-from typing import List, BinaryIO, Optional
+from array import array
+from typing import BinaryIO, Dict, List, Tuple, Union
 
-import leb128
 from adt import adt, Case
 
 
@@ -25,37 +25,409 @@ class LoopTree:
         )
 
 
+# limits of decode_loop_trees; a loop tree can't be entered deeper than blocks can be nested (bytecode.MAX_BLOCK_DEPTH)
+MAX_NODES = 1 << 16
+MAX_DEPTH = 64
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+# first byte of the indexed encoding (see LazyLoopTreeArray), not a valid kind
+INDEXED = 0xff
+
+
+def encode_loop_trees(trees: List[LoopTree], indexed: bool = False) -> bytes:
+    out = bytearray()
+    if indexed:
+        out.append(INDEXED)
+    for tree in trees:
+        _encode_loop_tree(out, tree, indexed)
+    return bytes(out)
+
+
+def _uleb(out: bytearray, value: int) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _encode_loop_tree(out: bytearray, tree: LoopTree, indexed: bool) -> None:
+    if not indexed:
+        _encode_node(out, tree, indexed)
+        return
+    # prefixed with its size, so it can be skipped
+    body = bytearray()
+    _encode_node(body, tree, indexed)
+    _uleb(out, len(body))
+    out += body
+
+
+def _encode_node(out: bytearray, tree: LoopTree, indexed: bool) -> None:
+    def rolled_out(matrix: List[List[LoopTree]]) -> None:
+        out.append(1)
+        _uleb(out, len(matrix))
+        _uleb(out, tree.num_children())
+        for row in matrix:
+            if len(row) != tree.num_children():
+                raise ValueError('Rows of a rolled out loop must have the same number of children')
+            for child in row:
+                _encode_loop_tree(out, child, indexed)
+
+    def cartesian(num_loops: int, children: List[LoopTree]) -> None:
+        out.append(2)
+        _uleb(out, num_loops)
+        _uleb(out, len(children))
+        for child in children:
+            _encode_loop_tree(out, child, indexed)
+
+    def leaf(num_loops: int) -> None:
+        out.append(0)
+        _uleb(out, num_loops)
+    tree.match(LEAF=leaf, ROLLED_OUT=rolled_out, CARTESIAN=cartesian)
+
+
 def parse_loop_trees(reader: BinaryIO) -> List[LoopTree]:
-    trees = []
-    while True:
-        tree = parse_loop_tree(reader)
-        if tree is None:
-            return trees
-        trees.append(tree)
-
-
-def parse_loop_tree(reader: BinaryIO) -> Optional[LoopTree]:
-    kind = reader.read(1)
-    if len(kind) == 0:
-        return None
-    kind = kind[0]
-    if kind == 0:
-        num_loops, _ = leb128.u.decode_reader(reader)
-        return LoopTree.LEAF(num_loops)
-    elif kind == 1:
-        num_loops, _ = leb128.u.decode_reader(reader)
-        num_children, _ = leb128.u.decode_reader(reader)
-        matrix = []
-        for _ in range(num_loops):
-            children = []
-            for _ in range(num_children):
-                children.append(parse_loop_tree(reader))
-            matrix.append(children)
-        return LoopTree.ROLLED_OUT(matrix)
-    elif kind == 2:
-        num_loops, _ = leb128.u.decode_reader(reader)
-        num_children, _ = leb128.u.decode_reader(reader)
-        children = []
-        for _ in range(num_children):
-            children.append(parse_loop_tree(reader))
-        return LoopTree.CARTESIAN(num_loops, children)
+    return decode_loop_trees(reader.read())
+
+
+def decode_loop_trees(data: Buffer, max_nodes: int = MAX_NODES, max_depth: int = MAX_DEPTH) -> List[LoopTree]:
+    """
+    Decodes the loop trees in data, see LoopTreeArray.decode.
+    """
+    return LoopTreeArray.decode(data, max_nodes, max_depth).to_trees()
+
+
+class LoopTreeArray:
+    """
+    Loop trees as parallel columns with one entry per node: kind, number of loops, number of children and the index
+    of the first child. The children of a node are stored next to each other, a rolled out loop's row by row, so
+    node queries are array reads and a node costs 20 bytes rather than a Python object (or a list per row).
+
+    Loop counts are unsigned 64 bit like in the encoding, so that column is array('Q').
+    """
+    LEAF = 0
+    ROLLED_OUT = 1
+    CARTESIAN = 2
+
+    def __init__(self) -> None:
+        self.kinds = array('I')
+        self.loops = array('Q')
+        self.children = array('I')
+        self.first_child = array('I')
+        self.roots = array('I')
+
+    def num_nodes(self) -> int:
+        return len(self.kinds)
+
+    def num_trees(self) -> int:
+        return len(self.roots)
+
+    def kind(self, node: int) -> int:
+        return self.kinds[node]
+
+    def num_loops(self, node: int) -> int:
+        return self.loops[node]
+
+    def num_children(self, node: int) -> int:
+        return self.children[node]
+
+    def root(self, idx: int) -> int:
+        if idx >= len(self.roots):
+            raise IndexError('No loop tree left to start')
+        return self.roots[idx]
+
+    def child(self, node: int, position: int, inner_position: int) -> int:
+        """
+        The child started at inner_position in iteration position (from 1) of node; the same children are started
+        in every iteration of a cartesian loop.
+        """
+        if self.kinds[node] == self.ROLLED_OUT:
+            return self.first_child[node] + (position - 1) * self.children[node] + inner_position
+        return self.first_child[node] + inner_position
+
+    def _reserve(self, num_nodes: int) -> int:
+        first = len(self.kinds)
+        self.kinds.frombytes(bytes(4 * num_nodes))
+        self.loops.frombytes(bytes(8 * num_nodes))
+        self.children.frombytes(bytes(4 * num_nodes))
+        self.first_child.frombytes(bytes(4 * num_nodes))
+        return first
+
+    def _set(self, node: int, kind: int, num_loops: int, num_children: int) -> int:
+        """
+        Sets the columns of node, reserves its children and returns how many there are.
+        """
+        self.kinds[node] = kind
+        self.loops[node] = num_loops
+        self.children[node] = num_children
+        num_expected = num_loops * num_children if kind == self.ROLLED_OUT else num_children
+        if num_expected:
+            self.first_child[node] = self._reserve(num_expected)
+        return num_expected
+
+    @classmethod
+    def from_trees(cls, trees: List[LoopTree]) -> 'LoopTreeArray':
+        result = cls()
+        pending = []
+        for tree in trees:
+            root = result._reserve(1)
+            result.roots.append(root)
+            pending.append((tree, root))
+        while pending:
+            tree, node = pending.pop()
+            kind, num_loops, children = tree.match(
+                LEAF=lambda n: (cls.LEAF, n, []),
+                ROLLED_OUT=lambda matrix: (cls.ROLLED_OUT, len(matrix), matrix),
+                CARTESIAN=lambda n, children: (cls.CARTESIAN, n, [children]),
+            )
+            num_children = len(children[0]) if children else 0
+            if any(len(row) != num_children for row in children):
+                raise ValueError('Rows of a rolled out loop must have the same number of children')
+            result._set(node, kind, num_loops, num_children)
+            first = result.first_child[node]
+            pending.extend((child, first + idx) for idx, child in enumerate(child for row in children for child in row))
+        return result
+
+    def to_trees(self) -> List[LoopTree]:
+        # children come after their parent, so building from the last node on finds them built
+        built: List[LoopTree] = [None] * len(self.kinds)  # type: ignore
+        kinds, loops, children, first_child = self.kinds, self.loops, self.children, self.first_child
+        leaf = LoopTree.LEAF
+        for node in reversed(range(len(kinds))):
+            kind, num_loops, num_children, first = kinds[node], loops[node], children[node], first_child[node]
+            if kind == self.LEAF:
+                built[node] = leaf(num_loops)
+            elif kind == self.ROLLED_OUT:
+                built[node] = LoopTree.ROLLED_OUT([
+                    built[first + row * num_children:first + (row + 1) * num_children] for row in range(num_loops)
+                ])
+            else:
+                built[node] = LoopTree.CARTESIAN(num_loops, built[first:first + num_children])
+        return [built[root] for root in self.roots]
+
+    @classmethod
+    def decode(cls, data: Buffer, max_nodes: int = MAX_NODES, max_depth: int = MAX_DEPTH) -> 'LoopTreeArray':
+        """
+        Decodes the loop trees in data:
+
+            tree: 0x00 num_loops:uleb                                         LEAF
+                  0x01 num_loops:uleb num_children:uleb tree{num_loops * num_children}  ROLLED_OUT, row by row
+                  0x02 num_loops:uleb num_children:uleb tree{num_children}    CARTESIAN
+
+        Children are reserved when their parent is read and filled in as they are decoded, the parents with children
+        left to decode are kept on a stack instead of recursing. Raises if there are more than max_nodes nodes
+        (counting the rows of rolled out loops, which to_trees makes lists of) or they are nested deeper than
+        max_depth.
+        """
+        if isinstance(data, memoryview):
+            data = data.tobytes()  # indexing bytes is faster
+        result = cls()
+        end = len(data)
+        pos = 0
+        # rows of the rolled out loops so far; the nodes are counted by the columns, which hold every node reserved
+        # so far, decoded or not
+        num_rows = 0
+        # parents with children left to decode: [next child, number of children left, depth of the children]
+        stack: List[List[int]] = []
+        while pos < end or stack:
+            # kind and the first byte of num_loops, the LEB128 tail (values from 0x80 on) is decoded by _uleb_tail
+            if pos + 2 > end:
+                raise ValueError('Unexpected end of loop trees')
+            kind = data[pos]
+            num_loops = data[pos + 1]
+            pos += 2
+            if num_loops >= 0x80:
+                num_loops, pos = _uleb_tail(data, pos, num_loops)
+            # a root isn't reserved yet
+            num_nodes = len(result.kinds) + num_rows + (0 if stack else 1)
+            if num_nodes > max_nodes:
+                raise ValueError('Too many loop tree nodes')
+            num_children = 0
+            num_expected = 0
+            if kind != cls.LEAF:
+                if kind > cls.CARTESIAN:
+                    raise ValueError(f'Invalid loop tree kind {kind}')
+                if pos >= end:
+                    raise ValueError('Unexpected end of loop trees')
+                num_children = data[pos]
+                pos += 1
+                if num_children >= 0x80:
+                    num_children, pos = _uleb_tail(data, pos, num_children)
+                if num_children > max_nodes:
+                    raise ValueError('Too many loop tree nodes')
+                if kind == cls.ROLLED_OUT:
+                    num_rows += num_loops
+                    num_nodes += num_loops
+                    num_expected = num_loops * num_children
+                else:
+                    num_expected = num_children
+                if num_nodes + num_expected > max_nodes:
+                    raise ValueError('Too many loop tree nodes')
+            if stack:
+                parent = stack[-1]
+                node = parent[0]
+                depth = parent[2]
+                parent[0] += 1
+                parent[1] -= 1
+                if not parent[1]:
+                    stack.pop()
+            else:
+                node = result._reserve(1)
+                result.roots.append(node)
+                depth = 1
+            if result._set(node, kind, num_loops, num_children):
+                if depth > max_depth:
+                    raise ValueError('Loop trees nested too deeply')
+                stack.append([result.first_child[node], num_expected, depth + 1])
+        return result
+
+
+class LazyLoopTreeArray:
+    """
+    Loop trees in the indexed encoding, decoded as far as a LoopStack walks them:
+
+        trees: INDEXED tree*
+        tree:  size:uleb node    where node is encoded like in LoopTreeArray.decode, its children being trees
+
+    The size of each tree lets the ones that aren't entered be skipped, so a witness costs what the program ran of
+    it: a node is decoded the first time it is started, finding it skips the sizes of the trees before it. Trees that
+    are never entered aren't validated. The decoded nodes are in columns like those of LoopTreeArray, but children
+    are appended as they are found rather than stored next to each other.
+    """
+
+    def __init__(self, data: Buffer, max_nodes: int = MAX_NODES) -> None:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if not data or data[0] != INDEXED:
+            raise ValueError('Loop trees are not indexed')
+        self._data = data
+        self._max_nodes = max_nodes
+        self.kinds = array('I')
+        self.loops = array('Q')
+        self.children = array('I')
+        # where the children of each decoded node start and where the node ends
+        self._body = array('Q')
+        self._end = array('Q')
+        # offsets of the trees found so far among the children of each node, and among the roots (key -1)
+        self._offsets: Dict[int, List[int]] = {-1: [1]}
+        # (parent, child number) -> node, for the nodes decoded so far; parent -1 for the roots
+        self._nodes: Dict[Tuple[int, int], int] = {}
+
+    def num_nodes(self) -> int:
+        return len(self.kinds)
+
+    def kind(self, node: int) -> int:
+        return self.kinds[node]
+
+    def num_loops(self, node: int) -> int:
+        return self.loops[node]
+
+    def num_children(self, node: int) -> int:
+        return self.children[node]
+
+    def root(self, idx: int) -> int:
+        return self._find(-1, idx, len(self._data))
+
+    def child(self, node: int, position: int, inner_position: int) -> int:
+        if self.kinds[node] == LoopTreeArray.ROLLED_OUT:
+            idx = (position - 1) * self.children[node] + inner_position
+        else:
+            idx = inner_position
+        return self._find(node, idx, self._end[node])
+
+    def _find(self, parent: int, idx: int, end: int) -> int:
+        node = self._nodes.get((parent, idx))
+        if node is not None:
+            return node
+        offsets = self._offsets.get(parent)
+        if offsets is None:
+            offsets = self._offsets[parent] = [self._body[parent]]
+        data = self._data
+        # skip the trees before it
+        while len(offsets) <= idx:
+            if offsets[-1] >= end:
+                if parent < 0:
+                    raise IndexError('No loop tree left to start')
+                raise ValueError('Loop tree size out of bounds')
+            size, pos = _read_uleb(data, offsets[-1], end)
+            offsets.append(pos + size)
+        if offsets[idx] >= end:
+            if parent < 0:
+                raise IndexError('No loop tree left to start')
+            raise ValueError('Loop tree size out of bounds')
+        node = self._decode(offsets[idx], end)
+        self._nodes[parent, idx] = node
+        return node
+
+    def _decode(self, pos: int, end: int) -> int:
+        if len(self.kinds) >= self._max_nodes:
+            raise ValueError('Too many loop tree nodes')
+        data = self._data
+        size, pos = _read_uleb(data, pos, end)
+        node_end = pos + size
+        if node_end > end:
+            raise ValueError('Loop tree size out of bounds')
+        if pos >= node_end:
+            raise ValueError('Unexpected end of loop trees')
+        kind = data[pos]
+        if kind > LoopTreeArray.CARTESIAN:
+            raise ValueError(f'Invalid loop tree kind {kind}')
+        num_loops, pos = _read_uleb(data, pos + 1, node_end)
+        num_children = 0
+        if kind != LoopTreeArray.LEAF:
+            num_children, pos = _read_uleb(data, pos, node_end)
+            if num_children > self._max_nodes:
+                raise ValueError('Too many loop tree nodes')
+        num_expected = num_loops * num_children if kind == LoopTreeArray.ROLLED_OUT else num_children
+        if not num_expected and pos != node_end:
+            raise ValueError('Trailing bytes in loop tree')
+        node = len(self.kinds)
+        self.kinds.append(kind)
+        self.loops.append(num_loops)
+        self.children.append(num_children)
+        self._body.append(pos)
+        self._end.append(node_end)
+        return node
+
+
+def load_loop_trees(data: Buffer) -> Union[LoopTreeArray, LazyLoopTreeArray]:
+    """
+    The loop trees of a witness for a LoopStack, decoded lazily if they are in the indexed encoding.
+    """
+    if data and data[0] == INDEXED:
+        return LazyLoopTreeArray(data)
+    return LoopTreeArray.decode(data)
+
+
+def _read_uleb(data: bytes, pos: int, end: int) -> Tuple[int, int]:
+    if pos >= end:
+        raise ValueError('Unexpected end of loop trees')
+    value = data[pos]
+    if value >= 0x80:
+        value, pos = _uleb_tail(data, pos + 1, value)
+        if pos > end:
+            raise ValueError('Unexpected end of loop trees')
+        return value, pos
+    return value, pos + 1
+
+
+def _uleb_tail(data: bytes, pos: int, first: int) -> Tuple[int, int]:
+    """
+    Decodes the rest of a LEB128 value whose first byte (>= 0x80) was first, returns it with the position after it.
+    """
+    value = first & 0x7f
+    shift = 0
+    b = first
+    while b >= 0x80:
+        shift += 7
+        if shift > 63:
+            raise ValueError('LEB128 value too large')
+        if pos >= len(data):
+            raise ValueError('Unexpected end of loop trees')
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+    if value >> 64:
+        raise ValueError('LEB128 value too large')
+    return value, pos
@@ -0,0 +1,134 @@
+"""
+Merkle trees of contract bytecode. An output commits to a tree of bytecodes by its root; an input spending it shows
+its bytecode with the path of sibling hashes from the bytecode's leaf up to the root.
+
+    leaf: SHA-256(0x00 || bytecode)
+    node: SHA-256(0x01 || left || right)
+
+A branch with side LEFT is the left sibling of the node on the path, RIGHT the right one. Trees with an odd number of
+nodes on a level carry the last one up unchanged, so it has no branch on that level.
+"""
+import hashlib
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from tx import MerkleBranch, MerkleSide
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def leaf_hash(bytecode: bytes) -> bytes:
+    state = hashlib.sha256(LEAF_PREFIX)
+    state.update(bytecode)
+    return state.digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def _parent(node: bytes, branch: MerkleBranch) -> bytes:
+    if branch.side is MerkleSide.LEFT:
+        return node_hash(bytes(branch.branch_hash), node)
+    return node_hash(node, bytes(branch.branch_hash))
+
+
+def merkle_levels(bytecodes: Sequence[bytes]) -> List[List[bytes]]:
+    """
+    The hashes of each level of the tree over bytecodes, from the leaves to the root.
+    """
+    if not bytecodes:
+        raise ValueError('Merkle tree without bytecode')
+    levels = [[leaf_hash(bytecode) for bytecode in bytecodes]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[idx], level[idx + 1]) for idx in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def merkle_root(bytecodes: Sequence[bytes]) -> bytes:
+    return merkle_levels(bytecodes)[-1][0]
+
+
+def merkle_path(levels: List[List[bytes]], leaf_idx: int) -> List[MerkleBranch]:
+    """
+    The path of the leaf at leaf_idx in the tree given by merkle_levels.
+    """
+    path = []
+    idx = leaf_idx
+    for level in levels[:-1]:
+        sibling = idx ^ 1
+        if sibling < len(level):
+            path.append(MerkleBranch(MerkleSide.LEFT if sibling < idx else MerkleSide.RIGHT, level[sibling]))
+        idx //= 2
+    return path
+
+
+class MerkleCacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+
+
+class MerkleCache:
+    """
+    Verifies merkle paths, remembering the (node hash, root) pairs of the paths that checked out: a node known to be
+    in the tree of a root proves every path reaching it, so verifying stops at the first remembered node. Inputs
+    spending the same contract tree only hash up to where their path joins one verified before.
+
+    Least recently used pairs are evicted beyond max_entries; max_entries=0 disables the cache.
+    """
+
+    def __init__(self, max_entries: Optional[int] = 65536) -> None:
+        self._max_entries = max_entries
+        self._entries: 'OrderedDict[Tuple[bytes, bytes], None]' = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def verify(self, bytecode: bytes, path: Sequence[MerkleBranch], root: bytes) -> None:
+        root = bytes(root)
+        entries = self._entries
+        node = leaf_hash(bytecode)
+        visited = []
+        for branch in path:
+            key = node, root
+            if key in entries:
+                entries.move_to_end(key)
+                self._hits += 1
+                break
+            visited.append(key)
+            node = _parent(node, branch)
+        else:
+            self._misses += 1
+            if node != root:
+                raise ValueError('Bytecode is not in the merkle tree of the spent output')
+        self._insert(visited)
+
+    def _insert(self, keys: List[Tuple[bytes, bytes]]) -> None:
+        if self._max_entries is not None and self._max_entries <= 0:
+            return
+        for key in keys:
+            self._entries[key] = None
+        while self._max_entries is not None and len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> MerkleCacheStats:
+        return MerkleCacheStats(
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+            entries=len(self._entries),
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
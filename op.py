@@ -1,16 +1,49 @@
 from abc import ABC, abstractmethod
-from typing import NamedTuple, Optional, List
+from enum import Enum
+from typing import NamedTuple, Optional, Callable, Sequence, Tuple
 
-from belt import Belt
+import flat
+from flat import Lowering
+from hooks import Hook
 from pretty import Pretty
 from vm import VM
 
+Runner = Callable[[VM], Optional['Break']]
+
 
 class Instruction(ABC):
     @abstractmethod
     def run(self, vm: VM) -> Optional['Break']:
         pass
 
+    def build(self) -> Runner:
+        """
+        Build a closure that runs this instruction, with its operands bound at build time. Instructions without a
+        specialized closure are run through run().
+        """
+        return self.run
+
+    def lower(self, lowering: Lowering) -> None:
+        """
+        Emit this instruction into flat code. Instructions that don't affect control flow become a single CALL of
+        their built closure.
+        """
+        lowering.emit_call(self)
+
+    def cost(self) -> int:
+        """
+        Cost charged before running this instruction in a metered VM. Work that depends on the operands (like the
+        bytes hashed, copied or searched) is charged by run() itself with VM.charge_bytes; the blocks of control flow
+        instructions charge for their own instructions.
+        """
+        return 1
+
+    def payload(self) -> tuple:
+        """
+        Constructor arguments of this instruction, as encoded by bytecode.py.
+        """
+        raise ValueError(f'{type(self).__name__} has no binary encoding')
+
 
 class Opcode(ABC):
     @abstractmethod
@@ -31,13 +64,70 @@ class Break(NamedTuple):
     is_continue: bool
 
 
+class Engine(Enum):
+    REFERENCE = 'reference'  # Block.run, interpreting the Instruction objects
+    CLOSURE = 'closure'  # Block.build, running closures built once per program
+    FLAT = 'flat'  # flat.lower, running linear code in a non-recursive dispatch loop
+
+
 class Block(Pretty):
-    def __init__(self, instructions: List[Instruction]) -> None:
-        self._instructions = instructions
+    def __init__(self, instructions: Sequence[Instruction]) -> None:
+        self._instructions: Tuple[Instruction, ...] = tuple(instructions)
+        self._costs: Tuple[int, ...] = tuple(ins.cost() for ins in self._instructions)
 
     def run(self, vm: VM) -> Optional['Break']:
+        hook = vm.hook()
+        if hook is not None:
+            return self._run_hooked(vm, hook)
+        if vm.metered():
+            return self._run_metered(vm)
         for ins in self._instructions:
             br = ins.run(vm)
-            print(ins, [vm.belt().get_num(i).value.expect_int() for i in range(Belt.SIZE)])
             if br is not None and br.depth > 0:
                 return Break(br.depth - 1, is_continue=br.is_continue)
+
+    def _run_metered(self, vm: VM) -> Optional['Break']:
+        charge = vm.charge
+        for ins, cost in zip(self._instructions, self._costs):
+            charge(cost)
+            br = ins.run(vm)
+            if br is not None and br.depth > 0:
+                return Break(br.depth - 1, is_continue=br.is_continue)
+
+    def _run_hooked(self, vm: VM, hook: Hook) -> Optional['Break']:
+        metered = vm.metered()
+        for ins, cost in zip(self._instructions, self._costs):
+            if metered:
+                vm.charge(cost)
+            hook.before_instruction(ins, vm)
+            br = ins.run(vm)
+            hook.after_instruction(ins, vm)
+            if br is not None and br.depth > 0:
+                return Break(br.depth - 1, is_continue=br.is_continue)
+
+    def build(self) -> Runner:
+        runners = tuple(ins.build() for ins in self._instructions)
+
+        def run(vm: VM) -> Optional[Break]:
+            for runner in runners:
+                br = runner(vm)
+                if br is not None and br.depth > 0:
+                    return Break(br.depth - 1, is_continue=br.is_continue)
+            return None
+        return run
+
+    def instructions(self) -> Tuple[Instruction, ...]:
+        return self._instructions
+
+    def lower(self, lowering: Lowering) -> None:
+        for ins in self._instructions:
+            ins.lower(lowering)
+
+    def runner(self, engine: Engine) -> Runner:
+        if engine == Engine.REFERENCE:
+            return self.run
+        elif engine == Engine.CLOSURE:
+            return self.build()
+        elif engine == Engine.FLAT:
+            return flat.lower(self).run
+        raise ValueError(f'Unknown engine {engine}')
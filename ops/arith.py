@@ -2,9 +2,9 @@ import functools
 from enum import Enum
 from typing import Optional, Callable, List
 
-from belt import BeltNum, Integer, DataType
+from belt import BeltNum, DataType
 from op import Break
-from op import Instruction
+from op import Instruction, Runner
 from pretty import Pretty
 from vm import VM
 
@@ -19,15 +19,32 @@ class InsRel(Instruction):
     def run(self, vm: VM) -> Optional['Break']:
         a_num = vm.belt().get_num(self._a_idx)
         b_num = vm.belt().get_num(self._b_idx)
-        a = a_num.to_signed(self._is_signed).to_int()
-        b = b_num.to_signed(self._is_signed).to_int()
+        a = a_num.to_signed(self._is_signed)
+        b = b_num.to_signed(self._is_signed)
         if a is None or b is None:
-            vm.belt().push(BeltNum(DataType.I8, Integer(None)))
+            vm.belt().push(DataType.I8.err_num)
         else:
             result = self._op(a, b)
-            vm.belt().push(BeltNum(DataType.I8, Integer(int(result))))
+            vm.belt().push(BeltNum.of(DataType.I8, int(result)))
         return None
 
+    def payload(self) -> tuple:
+        return self._a_idx, self._b_idx, self._is_signed, self._op
+
+    def build(self) -> Runner:
+        a_idx, b_idx, is_signed, op = self._a_idx, self._b_idx, self._is_signed, self._op
+        err, false, true = DataType.I8.err_num, BeltNum.of(DataType.I8, 0), BeltNum.of(DataType.I8, 1)
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            a = belt.get_num(a_idx).to_signed(is_signed)
+            b = belt.get_num(b_idx).to_signed(is_signed)
+            if a is None or b is None:
+                belt.push(err)
+            else:
+                belt.push(true if op(a, b) else false)
+        return run
+
 
 class InsRelVerify(Instruction):
     def __init__(self, a_idx: int, b_idx: int, is_signed: bool, op: Callable[[int, int], bool]) -> None:
@@ -39,12 +56,26 @@ class InsRelVerify(Instruction):
     def run(self, vm: VM) -> Optional['Break']:
         a_num = vm.belt().get_num(self._a_idx)
         b_num = vm.belt().get_num(self._b_idx)
-        a = a_num.to_signed(self._is_signed).to_int()
-        b = b_num.to_signed(self._is_signed).to_int()
+        a = a_num.to_signed(self._is_signed)
+        b = b_num.to_signed(self._is_signed)
         if a is None or b is None or not self._op(a, b):
             raise ValueError('Verify failed')
         return None
 
+    def payload(self) -> tuple:
+        return self._a_idx, self._b_idx, self._is_signed, self._op
+
+    def build(self) -> Runner:
+        a_idx, b_idx, is_signed, op = self._a_idx, self._b_idx, self._is_signed, self._op
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            a = belt.get_num(a_idx).to_signed(is_signed)
+            b = belt.get_num(b_idx).to_signed(is_signed)
+            if a is None or b is None or not op(a, b):
+                raise ValueError('Verify failed')
+        return run
+
 
 class InsNAryOp(Instruction):
     def __init__(self,
@@ -52,24 +83,57 @@ class InsNAryOp(Instruction):
                  is_signed: bool,
                  op: Callable[[DataType, int], List[Optional[int]]]
                  ) -> None:
-        self._param_indices = param_indices
+        self._param_indices = tuple(param_indices)
         self._is_signed = is_signed
         self._op = op
 
     def run(self, vm: VM) -> Optional['Break']:
         param_nums = [vm.belt().get_num(idx) for idx in self._param_indices]
-        params = [num.to_signed(self._is_signed).to_int() for num in param_nums]
+        params = [num.to_signed(self._is_signed) for num in param_nums]
         data_type = functools.reduce(DataType.promote, (param.data_type for param in param_nums))
         if any(param is None for param in params):
-            vm.belt().push(BeltNum(data_type, Integer(None)))
+            vm.belt().push(data_type.err_num)
         else:
             results = self._op(data_type, *params)
             for result in reversed(results):
                 vm.belt().push(
-                    BeltNum.from_signed(Integer(result), data_type, is_signed=self._is_signed)
+                    BeltNum.from_signed(result, data_type, is_signed=self._is_signed)
                 )
         return None
 
+    def payload(self) -> tuple:
+        return self._param_indices, self._is_signed, self._op
+
+    def build(self) -> Runner:
+        if len(self._param_indices) != 2:
+            return self.run
+        a_idx, b_idx = self._param_indices
+        is_signed, op = self._is_signed, self._op
+        from_signed = BeltNum.from_signed
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            a_num = belt.get_num(a_idx)
+            b_num = belt.get_num(b_idx)
+            data_type = a_num.data_type
+            if data_type is not b_num.data_type:
+                data_type = data_type.promote(b_num.data_type)
+            a = a_num.to_signed(is_signed)
+            b = b_num.to_signed(is_signed)
+            if a is None or b is None:
+                belt.push(data_type.err_num)
+                return
+            results = op(data_type, a, b)
+            for result in reversed(results):
+                belt.push(from_signed(result, data_type, is_signed))
+        return run
+
+
+def divmod_op(_data_type: DataType, a: int, b: int) -> List[Optional[int]]:
+    if b == 0:
+        return [None, None]
+    return list(divmod(a, b))
+
 
 class ArithMode(Enum):
     CHECKED = 0
@@ -83,25 +147,89 @@ class InsArith(InsNAryOp, Pretty):
                  arith_mode: ArithMode,
                  arith_op: Callable[[int], int],
                  ) -> None:
+        is_shl = arith_op is int.__lshift__
         if arith_mode == ArithMode.CHECKED:
             def op(data_type: DataType, *params) -> List[Optional[int]]:
+                if is_shl and params[0] and params[1] >= data_type.bits:
+                    # out of range whatever the shift is, don't build the huge int
+                    return [None]
                 result = arith_op(*params)
-                if result > data_type.max_value(is_signed) or result < data_type.min_value(is_signed):
+                if result > data_type.max_values[is_signed] or result < data_type.min_values[is_signed]:
                     return [None]
                 else:
                     return [result]
         elif arith_mode == ArithMode.WIDENING:
             def op(data_type: DataType, *params) -> List[Optional[int]]:
+                # split the double-width result into its high and low halves, both of data_type
+                if is_shl and params[0] and params[1] >= 2 * data_type.bits:
+                    # the high half doesn't fit, like from_signed raises on it
+                    raise OverflowError('int too big to convert')
                 result = arith_op(*params)
-                num_bytes = data_type.num_bytes()
-                wide_bytes = result.to_bytes(num_bytes, 'little', signed=is_signed)
-                return [
-                    int.from_bytes(wide_bytes[num_bytes:], 'little', signed=is_signed),
-                    int.from_bytes(wide_bytes[:num_bytes], 'little', signed=is_signed),
-                ]
+                low = result & data_type.mask
+                if is_signed and low & data_type.sign_bit:
+                    low -= data_type.modulus
+                return [result >> data_type.bits, low]
         else:
             raise NotImplemented
         super().__init__(param_indices, is_signed, op)
+        self._arith_mode = arith_mode
+        self._arith_op = arith_op
+
+    def payload(self) -> tuple:
+        return self._param_indices, self._is_signed, self._arith_mode, self._arith_op
+
+    def build(self) -> Runner:
+        if self._arith_mode != ArithMode.CHECKED or len(self._param_indices) != 2:
+            return super().build()
+        a_idx, b_idx = self._param_indices
+        arith_op = self._arith_op
+        is_shl = arith_op is int.__lshift__
+        of = BeltNum.of
+
+        if self._is_signed:
+            def run(vm: VM) -> None:
+                belt = vm.belt()
+                a_num = belt.get_num(a_idx)
+                b_num = belt.get_num(b_idx)
+                data_type = a_num.data_type
+                if data_type is not b_num.data_type:
+                    data_type = data_type.promote(b_num.data_type)
+                a = a_num.to_signed(True)
+                b = b_num.to_signed(True)
+                if a is None or b is None:
+                    belt.push(data_type.err_num)
+                    return
+                if is_shl and a and b >= data_type.bits:
+                    belt.push(data_type.err_num)
+                    return
+                result = arith_op(a, b)
+                if result > data_type.max_values[True] or result < data_type.min_values[True]:
+                    belt.push(data_type.err_num)
+                else:
+                    belt.push(of(data_type, result & data_type.mask))
+        else:
+            # unsigned numbers are stored as-is, so neither operands nor the result need converting
+            def run(vm: VM) -> None:
+                belt = vm.belt()
+                a_num = belt.get_num(a_idx)
+                b_num = belt.get_num(b_idx)
+                data_type = a_num.data_type
+                if data_type is not b_num.data_type:
+                    data_type = data_type.promote(b_num.data_type)
+                a = a_num.int_value
+                b = b_num.int_value
+                if a is None or b is None:
+                    belt.push(data_type.err_num)
+                    return
+                if is_shl and a and b >= data_type.bits:
+                    belt.push(data_type.err_num)
+                    return
+                result = arith_op(a, b)
+                if result > data_type.mask or result < 0:
+                    belt.push(data_type.err_num)
+                else:
+                    belt.push(of(data_type, result))
+        return run
 
 
 class InsConvert(Instruction):
@@ -120,3 +248,18 @@ class InsConvert(Instruction):
         item = vm.belt().get_num(self._item_idx)
         vm.belt().push(self._op(item, self._data_type, self._is_signed))
         return None
+
+    def payload(self) -> tuple:
+        return self._item_idx, self._data_type, self._is_signed, self._op
+
+    def build(self) -> Runner:
+        item_idx, data_type, is_signed, op = self._item_idx, self._data_type, self._is_signed, self._op
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            belt.push(op(belt.get_num(item_idx), data_type, is_signed))
+        return run
+
+
+def cast_wrap(num: BeltNum, data_type: DataType, _is_signed: bool) -> BeltNum:
+    return num.wrap(data_type)
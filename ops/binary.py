@@ -0,0 +1,298 @@
+"""
+Specialized two-operand instructions, one class per operator, signedness and mode. The operands are fixed belt
+indices and run() is straight-line code, unlike the generic InsArith/InsRel/InsNAryOp which handle any arity. The
+compiler emits these; the classes are looked up in CHECKED, COMPARE, WIDENING and DIVMOD below.
+"""
+from typing import Callable, Dict, Optional, Tuple, Type
+
+from belt import BeltNum, DataType
+from op import Break, Instruction, Runner
+from pretty import Pretty
+from vm import VM
+
+CHECKED_OPS: Dict[str, Callable[[int, int], int]] = {
+    'add': int.__add__,
+    'sub': int.__sub__,
+    'mul': int.__mul__,
+    'div': int.__floordiv__,
+    'mod': int.__mod__,
+    'shl': int.__lshift__,
+    'shr': int.__rshift__,
+    'and': int.__and__,
+    'or': int.__or__,
+    'xor': int.__xor__,
+}
+COMPARE_OPS: Dict[str, Callable[[int, int], bool]] = {
+    'eq': int.__eq__,
+    'ne': int.__ne__,
+    'lt': int.__lt__,
+    'le': int.__le__,
+    'gt': int.__gt__,
+    'ge': int.__ge__,
+}
+WIDENING_OPS: Dict[str, Callable[[int, int], int]] = {
+    'add': int.__add__,
+    'sub': int.__sub__,
+    'mul': int.__mul__,
+}
+
+
+class InsBinary(Instruction, Pretty):
+    """
+    Base of the specialized instructions; op and is_signed are set per class.
+    """
+    op: Callable[[int, int], int]
+    is_signed: bool
+
+    def __init__(self, a_idx: int, b_idx: int) -> None:
+        self._a_idx = a_idx
+        self._b_idx = b_idx
+
+    def payload(self) -> tuple:
+        return self._a_idx, self._b_idx
+
+
+class InsCheckedUnsigned(InsBinary):
+    is_signed = False
+
+    def run(self, vm: VM) -> Optional[Break]:
+        belt = vm.belt()
+        a_num = belt.get_num(self._a_idx)
+        b_num = belt.get_num(self._b_idx)
+        data_type = a_num.data_type
+        if data_type is not b_num.data_type:
+            data_type = data_type.promotions[b_num.data_type.index]
+        a = a_num.int_value
+        b = b_num.int_value
+        if a is None or b is None:
+            belt.push(data_type.err_num)
+            return None
+        if self.op is int.__lshift__ and a and b >= data_type.bits:
+            # out of range whatever b is, don't build the huge int
+            belt.push(data_type.err_num)
+            return None
+        result = self.op(a, b)
+        if result > data_type.mask or result < 0:
+            belt.push(data_type.err_num)
+        else:
+            belt.push(BeltNum.of(data_type, result))
+        return None
+
+    def build(self) -> Runner:
+        a_idx, b_idx, op, of = self._a_idx, self._b_idx, self.op, BeltNum.of
+        is_shl = op is int.__lshift__
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            a_num = belt.get_num(a_idx)
+            b_num = belt.get_num(b_idx)
+            data_type = a_num.data_type
+            if data_type is not b_num.data_type:
+                data_type = data_type.promotions[b_num.data_type.index]
+            a = a_num.int_value
+            b = b_num.int_value
+            if a is None or b is None:
+                belt.push(data_type.err_num)
+                return
+            if is_shl and a and b >= data_type.bits:
+                belt.push(data_type.err_num)
+                return
+            result = op(a, b)
+            if result > data_type.mask or result < 0:
+                belt.push(data_type.err_num)
+            else:
+                belt.push(of(data_type, result))
+        return run
+
+
+class InsCheckedSigned(InsBinary):
+    is_signed = True
+
+    def run(self, vm: VM) -> Optional[Break]:
+        belt = vm.belt()
+        a_num = belt.get_num(self._a_idx)
+        b_num = belt.get_num(self._b_idx)
+        data_type = a_num.data_type
+        if data_type is not b_num.data_type:
+            data_type = data_type.promotions[b_num.data_type.index]
+        a = a_num.to_signed(True)
+        b = b_num.to_signed(True)
+        if a is None or b is None:
+            belt.push(data_type.err_num)
+            return None
+        if self.op is int.__lshift__ and a and b >= data_type.bits:
+            belt.push(data_type.err_num)
+            return None
+        result = self.op(a, b)
+        if result > data_type.max_values[True] or result < data_type.min_values[True]:
+            belt.push(data_type.err_num)
+        else:
+            belt.push(BeltNum.of(data_type, result & data_type.mask))
+        return None
+
+    def build(self) -> Runner:
+        a_idx, b_idx, op, of = self._a_idx, self._b_idx, self.op, BeltNum.of
+        is_shl = op is int.__lshift__
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            a_num = belt.get_num(a_idx)
+            b_num = belt.get_num(b_idx)
+            data_type = a_num.data_type
+            if data_type is not b_num.data_type:
+                data_type = data_type.promotions[b_num.data_type.index]
+            a = a_num.to_signed(True)
+            b = b_num.to_signed(True)
+            if a is None or b is None:
+                belt.push(data_type.err_num)
+                return
+            if is_shl and a and b >= data_type.bits:
+                belt.push(data_type.err_num)
+                return
+            result = op(a, b)
+            if result > data_type.max_values[True] or result < data_type.min_values[True]:
+                belt.push(data_type.err_num)
+            else:
+                belt.push(of(data_type, result & data_type.mask))
+        return run
+
+
+class InsCompare(InsBinary):
+    """
+    Relational compare, pushes an I8 0 or 1 (Err if an operand is Err).
+    """
+
+    def run(self, vm: VM) -> Optional[Break]:
+        belt = vm.belt()
+        a = belt.get_num(self._a_idx).to_signed(self.is_signed)
+        b = belt.get_num(self._b_idx).to_signed(self.is_signed)
+        if a is None or b is None:
+            belt.push(DataType.I8.err_num)
+        else:
+            belt.push(DataType.I8.interned_nums[self.op(a, b)])
+        return None
+
+    def build(self) -> Runner:
+        a_idx, b_idx, is_signed, op = self._a_idx, self._b_idx, self.is_signed, self.op
+        err, nums = DataType.I8.err_num, DataType.I8.interned_nums
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            a = belt.get_num(a_idx).to_signed(is_signed)
+            b = belt.get_num(b_idx).to_signed(is_signed)
+            if a is None or b is None:
+                belt.push(err)
+            else:
+                belt.push(nums[op(a, b)])
+        return run
+
+
+class InsWidening(InsBinary):
+    """
+    Widening op, pushes the low half of the double-width result and then the high half, both of the operand type.
+    """
+
+    def run(self, vm: VM) -> Optional[Break]:
+        belt = vm.belt()
+        a_num = belt.get_num(self._a_idx)
+        b_num = belt.get_num(self._b_idx)
+        data_type = a_num.data_type
+        if data_type is not b_num.data_type:
+            data_type = data_type.promotions[b_num.data_type.index]
+        a = a_num.to_signed(self.is_signed)
+        b = b_num.to_signed(self.is_signed)
+        if a is None or b is None:
+            belt.push(data_type.err_num)
+            return None
+        result = self.op(a, b)
+        high = BeltNum.from_signed(result >> data_type.bits, data_type, self.is_signed)
+        belt.push(BeltNum.of(data_type, result & data_type.mask))
+        belt.push(high)
+        return None
+
+    def build(self) -> Runner:
+        a_idx, b_idx, is_signed, op = self._a_idx, self._b_idx, self.is_signed, self.op
+        of, from_signed = BeltNum.of, BeltNum.from_signed
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            a_num = belt.get_num(a_idx)
+            b_num = belt.get_num(b_idx)
+            data_type = a_num.data_type
+            if data_type is not b_num.data_type:
+                data_type = data_type.promotions[b_num.data_type.index]
+            a = a_num.to_signed(is_signed)
+            b = b_num.to_signed(is_signed)
+            if a is None or b is None:
+                belt.push(data_type.err_num)
+                return
+            result = op(a, b)
+            high = from_signed(result >> data_type.bits, data_type, is_signed)
+            belt.push(of(data_type, result & data_type.mask))
+            belt.push(high)
+        return run
+
+
+class InsDivMod(InsBinary):
+    """
+    Pushes the remainder and then the quotient; both are Err for a zero divisor, a single Err is pushed if an operand
+    is Err.
+    """
+    op = staticmethod(divmod)
+
+    def run(self, vm: VM) -> Optional[Break]:
+        belt = vm.belt()
+        a_num = belt.get_num(self._a_idx)
+        b_num = belt.get_num(self._b_idx)
+        data_type = a_num.data_type
+        if data_type is not b_num.data_type:
+            data_type = data_type.promotions[b_num.data_type.index]
+        a = a_num.to_signed(self.is_signed)
+        b = b_num.to_signed(self.is_signed)
+        if a is None or b is None:
+            belt.push(data_type.err_num)
+        elif b == 0:
+            belt.push(data_type.err_num)
+            belt.push(data_type.err_num)
+        else:
+            div, mod = divmod(a, b)
+            # the signed minimum divided by -1 doesn't fit, from_signed raises on it
+            div_num = BeltNum.from_signed(div, data_type, self.is_signed)
+            belt.push(BeltNum.from_signed(mod, data_type, self.is_signed))
+            belt.push(div_num)
+        return None
+
+
+class InsDivModUnsigned(InsDivMod):
+    is_signed = False
+
+
+class InsDivModSigned(InsDivMod):
+    is_signed = True
+
+
+def _specialize(name: str, base: Type[InsBinary], op: Callable, is_signed: bool) -> Type[InsBinary]:
+    return type(name, (base,), {'op': staticmethod(op), 'is_signed': is_signed, '__module__': __name__})
+
+
+def _class_name(prefix: str, name: str, is_signed: bool) -> str:
+    return f'Ins{prefix}{name.capitalize()}{"Signed" if is_signed else "Unsigned"}'
+
+
+CHECKED: Dict[Tuple[Callable, bool], Type[InsBinary]] = {
+    (op, is_signed): _specialize(_class_name('', name, is_signed),
+                                 InsCheckedSigned if is_signed else InsCheckedUnsigned, op, is_signed)
+    for name, op in CHECKED_OPS.items() for is_signed in (False, True)
+}
+COMPARE: Dict[Tuple[Callable, bool], Type[InsBinary]] = {
+    (op, is_signed): _specialize(_class_name('', name, is_signed), InsCompare, op, is_signed)
+    for name, op in COMPARE_OPS.items() for is_signed in (False, True)
+}
+WIDENING: Dict[Tuple[Callable, bool], Type[InsBinary]] = {
+    (op, is_signed): _specialize(_class_name('Widening', name, is_signed), InsWidening, op, is_signed)
+    for name, op in WIDENING_OPS.items() for is_signed in (False, True)
+}
+DIVMOD: Dict[bool, Type[InsBinary]] = {False: InsDivModUnsigned, True: InsDivModSigned}
+
+# make the generated classes importable by name, e.g. for pickling
+globals().update({cls.__name__: cls for table in (CHECKED, COMPARE, WIDENING) for cls in table.values()})
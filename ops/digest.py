@@ -0,0 +1,222 @@
+"""
+Hashing instructions: SHA-256 and RIPEMD-160 over slices, running the native hashlib implementations. The digest is
+written to the start of a writable slice (RAM), which must be large enough for it.
+
+Large inputs can be hashed in chunks: hash_init pushes a handle (I32) of a hash state kept by the VM, hash_update
+feeds a slice to it and hash_final writes the digest and closes the state.
+
+In a metered VM, hashing a slice is also charged by its length (VM.charge_bytes). The pure-Python RIPEMD-160
+fallback is charged Ripemd160.COST_FACTOR times that, and for the padding its digest compresses.
+"""
+import hashlib
+import struct
+from typing import Any, Callable, List, Optional
+
+from belt import BeltNum, BeltSlice, DataType
+from op import Break, Instruction
+from pretty import Pretty
+from vm import VM
+
+
+def sha256() -> Any:
+    return hashlib.sha256()
+
+
+def ripemd160() -> Any:
+    try:
+        return hashlib.new('ripemd160')
+    except ValueError:
+        # OpenSSL 3 builds without the legacy provider don't have it, verification must not depend on that
+        return Ripemd160()
+
+
+# by bytecode table index
+HASHES: List[Callable[[], Any]] = [sha256, ripemd160]
+
+
+def _charge(vm: VM, state: Any, num_bytes: int, digest: bool = False) -> None:
+    """
+    Charges vm for hashing num_bytes with state, and for its digest if digest is set.
+    """
+    if isinstance(state, Ripemd160):
+        # the digest compresses up to two padding blocks
+        vm.charge_bytes((num_bytes + (2 * state.block_size if digest else 0)) * state.COST_FACTOR)
+    else:
+        vm.charge_bytes(num_bytes)
+
+
+class InsDigest(Instruction, Pretty):
+    """
+    Hashes the slice at src_idx with hash (sha256 or ripemd160) and writes the digest to the slice at dst_idx.
+    """
+
+    def __init__(self, dst_idx: int, src_idx: int, hash: Callable[[], Any]) -> None:
+        self._dst_idx = dst_idx
+        self._src_idx = src_idx
+        self._hash = hash
+
+    def run(self, vm: VM) -> Optional['Break']:
+        belt = vm.belt()
+        data = belt.get_slice(self._src_idx).view()
+        state = self._hash()
+        _charge(vm, state, len(data), digest=True)
+        state.update(data)
+        belt.get_slice(self._dst_idx).copy_from(BeltSlice.over(state.digest()))
+        return None
+
+    def payload(self) -> tuple:
+        return self._dst_idx, self._src_idx, self._hash
+
+
+class InsHashInit(Instruction, Pretty):
+    """
+    Starts an incremental hash, pushes its handle (I32).
+    """
+
+    def __init__(self, hash: Callable[[], Any]) -> None:
+        self._hash = hash
+
+    def run(self, vm: VM) -> Optional['Break']:
+        vm.belt().push(BeltNum.of(DataType.I32, vm.open_hash(self._hash())))
+        return None
+
+    def payload(self) -> tuple:
+        return self._hash,
+
+
+class InsHashUpdate(Instruction, Pretty):
+    """
+    Feeds the slice at src_idx to the incremental hash whose handle is at handle_idx.
+    """
+
+    def __init__(self, handle_idx: int, src_idx: int) -> None:
+        self._handle_idx = handle_idx
+        self._src_idx = src_idx
+
+    def run(self, vm: VM) -> Optional['Break']:
+        belt = vm.belt()
+        state = vm.hash_state(belt.get_num(self._handle_idx).expect_int())
+        data = belt.get_slice(self._src_idx).view()
+        _charge(vm, state, len(data))
+        state.update(data)
+        return None
+
+    def payload(self) -> tuple:
+        return self._handle_idx, self._src_idx
+
+
+class InsHashFinal(Instruction, Pretty):
+    """
+    Writes the digest of the incremental hash whose handle is at handle_idx to the slice at dst_idx and closes it.
+    """
+
+    def __init__(self, handle_idx: int, dst_idx: int) -> None:
+        self._handle_idx = handle_idx
+        self._dst_idx = dst_idx
+
+    def run(self, vm: VM) -> Optional['Break']:
+        belt = vm.belt()
+        handle = belt.get_num(self._handle_idx).expect_int()
+        state = vm.hash_state(handle)
+        _charge(vm, state, 0, digest=True)
+        belt.get_slice(self._dst_idx).copy_from(BeltSlice.over(state.digest()))
+        vm.close_hash(handle)
+        return None
+
+    def payload(self) -> tuple:
+        return self._handle_idx, self._dst_idx
+
+
+def _rol(x: int, n: int) -> int:
+    return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+
+class Ripemd160:
+    """
+    Pure Python RIPEMD-160 with the interface of the hashlib objects, for when hashlib doesn't provide it.
+    """
+    digest_size = 20
+    block_size = 64
+    # cost of hashing relative to hashlib: a block takes ~300µs here, about as long as ~200 instructions
+    COST_FACTOR = 256
+
+    # message word and rotation of each step, left and right line
+    _WORDS_L = [
+        0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+        3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12, 1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+        4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13,
+    ]
+    _WORDS_R = [
+        5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12, 6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+        15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13, 8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+        12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11,
+    ]
+    _ROTATIONS_L = [
+        11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8, 7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+        11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5, 11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+        9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6,
+    ]
+    _ROTATIONS_R = [
+        8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6, 9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+        9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5, 15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+        8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11,
+    ]
+    _CONSTANTS_L = [0x00000000, 0x5a827999, 0x6ed9eba1, 0x8f1bbcdc, 0xa953fd4e]
+    _CONSTANTS_R = [0x50a28be6, 0x5c4dd124, 0x6d703ef3, 0x7a6d76e9, 0x00000000]
+    _BLOCK = struct.Struct('<16I')
+
+    def __init__(self, data: bytes = b'') -> None:
+        self._state = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0]
+        self._pending = b''
+        self._length = 0
+        self.update(data)
+
+    @staticmethod
+    def _f(round_idx: int, x: int, y: int, z: int) -> int:
+        if round_idx == 0:
+            return x ^ y ^ z
+        elif round_idx == 1:
+            return (x & y) | (~x & z)
+        elif round_idx == 2:
+            return (x | ~y) ^ z
+        elif round_idx == 3:
+            return (x & z) | (y & ~z)
+        return x ^ (y | ~z)
+
+    def _compress(self, block: bytes) -> None:
+        words = self._BLOCK.unpack(block)
+        al, bl, cl, dl, el = self._state
+        ar, br, cr, dr, er = self._state
+        f = self._f
+        for step in range(80):
+            round_idx = step >> 4
+            t = _rol((al + f(round_idx, bl, cl, dl) + words[self._WORDS_L[step]] + self._CONSTANTS_L[round_idx])
+                     & 0xffffffff, self._ROTATIONS_L[step]) + el
+            al, bl, cl, dl, el = el, t & 0xffffffff, bl, _rol(cl, 10), dl
+            t = _rol((ar + f(4 - round_idx, br, cr, dr) + words[self._WORDS_R[step]] + self._CONSTANTS_R[round_idx])
+                     & 0xffffffff, self._ROTATIONS_R[step]) + er
+            ar, br, cr, dr, er = er, t & 0xffffffff, br, _rol(cr, 10), dr
+        h0, h1, h2, h3, h4 = self._state
+        self._state = [(h1 + cl + dr) & 0xffffffff, (h2 + dl + er) & 0xffffffff, (h3 + el + ar) & 0xffffffff,
+                       (h4 + al + br) & 0xffffffff, (h0 + bl + cr) & 0xffffffff]
+
+    def update(self, data) -> None:
+        data = self._pending + bytes(data)
+        self._length += len(data) - len(self._pending)
+        end = len(data) - len(data) % 64
+        for offset in range(0, end, 64):
+            self._compress(data[offset:offset + 64])
+        self._pending = data[end:]
+
+    def copy(self) -> 'Ripemd160':
+        other = Ripemd160()
+        other._state, other._pending, other._length = list(self._state), self._pending, self._length
+        return other
+
+    def digest(self) -> bytes:
+        final = self.copy()
+        final.update(b'\x80' + bytes((55 - self._length) % 64) + struct.pack('<Q', (self._length * 8) & (2 ** 64 - 1)))
+        return struct.pack('<5I', *final._state)
+
+    def hexdigest(self) -> str:
+        return self.digest().hex()
@@ -1,19 +1,38 @@
 from typing import List, Optional
 
-from op import Instruction, Break, Block
+import flat
+from flat import Lowering, FrameKind
+from op import Instruction, Break, Block, Runner
 from pretty import Pretty
 from vm import VM
 
+# charged per iteration of a loop in a metered VM, on top of the instructions of its body
+LOOP_ITERATION_COST = 1
+
 
 class InsNop(Instruction):
     def run(self, vm: VM) -> Optional[Break]:
         pass
 
+    def payload(self) -> tuple:
+        return ()
+
+    def build(self) -> Runner:
+        def run(_vm: VM) -> None:
+            pass
+        return run
+
+    def lower(self, lowering: Lowering) -> None:
+        pass
+
 
 class InsUnreachable(Instruction):
     def run(self, vm: VM) -> Optional[Break]:
         raise ValueError('Reached unreachable code')
 
+    def payload(self) -> tuple:
+        return ()
+
 
 class InsAlignBlock(Instruction):
     def __init__(self, alignment: int, block: Block) -> None:
@@ -27,16 +46,45 @@ class InsAlignBlock(Instruction):
         vm.set_alignment(previous_alignment)
         return br
 
+    def build(self) -> Runner:
+        alignment, block = self._alignment, self._block.build()
+
+        def run(vm: VM) -> Optional[Break]:
+            previous_alignment = vm.alignment()
+            vm.set_alignment(alignment)
+            br = block(vm)
+            vm.set_alignment(previous_alignment)
+            return br
+        return run
+
+    def lower(self, lowering: Lowering) -> None:
+        end = lowering.label()
+        lowering.emit(flat.SET_ALIGN, self._alignment)
+        with lowering.frame(FrameKind.ALIGN, end):
+            self._block.lower(lowering)
+        lowering.emit(flat.RESTORE_ALIGN)
+        lowering.place(end)
+
+    def payload(self) -> tuple:
+        return self._alignment, self._block
+
 
 class InsLoopSpecified(Instruction, Pretty):
     def __init__(self, block: Block) -> None:
         self._block = block
 
     def run(self, vm: VM) -> Optional[Break]:
+        hook = vm.hook()
+        metered = vm.metered()
         vm.loop_stack().start_loop()
         while True:
             if vm.loop_stack().next():
                 return None
+            if metered:
+                # an empty body must not make iterating free
+                vm.charge(LOOP_ITERATION_COST)
+            if hook is not None:
+                hook.loop_iteration(self, vm)
             br = self._block.run(vm)
             if br is not None:
                 if br.depth == 0 and br.is_continue:
@@ -45,6 +93,37 @@ class InsLoopSpecified(Instruction, Pretty):
                 vm.loop_stack().break_loop()
                 return br
 
+    def build(self) -> Runner:
+        block = self._block.build()
+
+        def run(vm: VM) -> Optional[Break]:
+            loop_stack = vm.loop_stack()
+            loop_stack.start_loop()
+            next_iteration = loop_stack.next
+            while not next_iteration():
+                br = block(vm)
+                if br is not None:
+                    if br.depth == 0 and br.is_continue:
+                        loop_stack.continue_loop()
+                        continue
+                    loop_stack.break_loop()
+                    return br
+            return None
+        return run
+
+    def lower(self, lowering: Lowering) -> None:
+        head, end = lowering.label(), lowering.label()
+        lowering.emit(flat.LOOP_START)
+        lowering.place(head)
+        lowering.emit_jump(flat.LOOP_NEXT, target=end)
+        with lowering.frame(FrameKind.LOOP, end, head):
+            self._block.lower(lowering)
+        lowering.emit_jump(flat.JUMP, target=head)
+        lowering.place(end)
+
+    def payload(self) -> tuple:
+        return self._block,
+
 
 class InsLoopFixed(Instruction, Pretty):
     def __init__(self, num_loops: int, block: Block) -> None:
@@ -52,7 +131,10 @@ class InsLoopFixed(Instruction, Pretty):
         self._block = block
 
     def run(self, vm: VM) -> Optional[Break]:
+        metered = vm.metered()
         for _ in range(self._num_loops):
+            if metered:
+                vm.charge(LOOP_ITERATION_COST)
             br = self._block.run(vm)
             if br is not None:
                 if br.depth == 0 and br.is_continue:
@@ -78,7 +160,7 @@ class InsIfUnspecified(Instruction, Pretty):
         self._else_block = else_block
 
     def run(self, vm: VM) -> Optional['Break']:
-        if vm.belt().get_num(self._condition_idx).value.expect_int():
+        if vm.belt().get_num(self._condition_idx).expect_int():
             block = self._then_block
         else:
             block = self._else_block
@@ -87,6 +169,33 @@ class InsIfUnspecified(Instruction, Pretty):
             raise ValueError('Cannot continue if/else/end block')
         return br
 
+    def build(self) -> Runner:
+        condition_idx, then_block, else_block = self._condition_idx, self._then_block.build(), self._else_block.build()
+
+        def run(vm: VM) -> Optional[Break]:
+            if vm.belt().get_num(condition_idx).expect_int():
+                br = then_block(vm)
+            else:
+                br = else_block(vm)
+            if br is not None and br.depth == 0 and br.is_continue:
+                raise ValueError('Cannot continue if/else/end block')
+            return br
+        return run
+
+    def lower(self, lowering: Lowering) -> None:
+        else_label, end = lowering.label(), lowering.label()
+        lowering.emit_jump(flat.JUMP_IF_ZERO, self._condition_idx, target=else_label)
+        with lowering.frame(FrameKind.IF, end):
+            self._then_block.lower(lowering)
+        lowering.emit_jump(flat.JUMP, target=end)
+        lowering.place(else_label)
+        with lowering.frame(FrameKind.IF, end):
+            self._else_block.lower(lowering)
+        lowering.place(end)
+
+    def payload(self) -> tuple:
+        return self._condition_idx, self._then_block, self._else_block
+
 
 class InsBr(Instruction):
     def __init__(self, br_depth: int):
@@ -95,6 +204,19 @@ class InsBr(Instruction):
     def run(self, vm: VM) -> Optional['Break']:
         return Break(self._br_depth, is_continue=False)
 
+    def build(self) -> Runner:
+        br = Break(self._br_depth, is_continue=False)
+
+        def run(_vm: VM) -> Break:
+            return br
+        return run
+
+    def lower(self, lowering: Lowering) -> None:
+        lowering.emit_break(self._br_depth, is_continue=False)
+
+    def payload(self) -> tuple:
+        return self._br_depth,
+
 
 class InsBrIf(Instruction):
     def __init__(self, condition_idx: int, br_depth: int):
@@ -102,9 +224,27 @@ class InsBrIf(Instruction):
         self._br_depth = br_depth
 
     def run(self, vm: VM) -> Optional['Break']:
-        if vm.belt().get_num(self._condition_idx).value.expect_int():
+        if vm.belt().get_num(self._condition_idx).expect_int():
             return Break(self._br_depth, is_continue=False)
 
+    def build(self) -> Runner:
+        condition_idx, br = self._condition_idx, Break(self._br_depth, is_continue=False)
+
+        def run(vm: VM) -> Optional[Break]:
+            if vm.belt().get_num(condition_idx).expect_int():
+                return br
+            return None
+        return run
+
+    def lower(self, lowering: Lowering) -> None:
+        skip = lowering.label()
+        lowering.emit_jump(flat.JUMP_IF_ZERO, self._condition_idx, target=skip)
+        lowering.emit_break(self._br_depth, is_continue=False)
+        lowering.place(skip)
+
+    def payload(self) -> tuple:
+        return self._condition_idx, self._br_depth
+
 
 class InsBrContinue(Instruction):
     def __init__(self, br_depth: int):
@@ -112,3 +252,16 @@ class InsBrContinue(Instruction):
 
     def run(self, vm: VM) -> Optional['Break']:
         return Break(self._br_depth, is_continue=True)
+
+    def build(self) -> Runner:
+        br = Break(self._br_depth, is_continue=True)
+
+        def run(_vm: VM) -> Break:
+            return br
+        return run
+
+    def lower(self, lowering: Lowering) -> None:
+        lowering.emit_break(self._br_depth, is_continue=True)
+
+    def payload(self) -> tuple:
+        return self._br_depth,
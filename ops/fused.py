@@ -0,0 +1,195 @@
+"""
+Superinstructions: two adjacent instructions that run with a single dispatch. fuse.py rewrites instruction trees into
+them, for the pairs its corpus counts showed to pay off. They only exist at execution time and have no binary
+encoding; run() interprets the pair, build() and lower() run both in one closure.
+"""
+from typing import Callable, Optional, Tuple
+
+from belt import BeltNum, DataType
+from flat import Lowering
+from op import Break, Instruction, Runner
+from ops.binary import InsCheckedSigned, InsCheckedUnsigned, InsCompare
+from ops.flow import InsBrIf
+from ops.misc import InsConst, InsLoad, InsLocalGet
+from pretty import Pretty
+from vm import VM
+
+PUSHES = (InsConst, InsLocalGet, InsLoad)
+BINARIES = (InsCheckedUnsigned, InsCheckedSigned, InsCompare)
+
+
+class InsFused(Instruction, Pretty):
+    """
+    Base of the superinstructions, runs like its first instruction followed by its second one.
+    """
+
+    def __init__(self, first: Instruction, second: Instruction) -> None:
+        self._first = first
+        self._second = second
+
+    def pair(self) -> Tuple[Instruction, Instruction]:
+        return self._first, self._second
+
+    def cost(self) -> int:
+        # fusing doesn't change what a program costs
+        return self._first.cost() + self._second.cost()
+
+    def run(self, vm: VM) -> Optional[Break]:
+        self._first.run(vm)
+        return self._second.run(vm)
+
+
+class InsPushBinary(InsFused):
+    """
+    A push (InsConst, InsLocalGet or InsLoad) followed by a checked op or compare, e.g. load-and-add. Constants and
+    locals are pushed inline, constants also read without going through the belt; loads run their closure.
+    """
+
+    def build(self) -> Runner:
+        first, second = self._first, self._second
+        const = first.payload()[0] if isinstance(first, InsConst) else None
+        local_idx = first.payload()[0] if isinstance(first, InsLocalGet) else None
+        push = first.build()
+        a_idx, b_idx = second.payload()
+        a_const, b_const = const is not None and a_idx == 0, const is not None and b_idx == 0
+        op, is_signed, of = second.op, second.is_signed, BeltNum.of
+        is_shl = op is int.__lshift__
+        if isinstance(second, InsCompare):
+            err, nums = DataType.I8.err_num, DataType.I8.interned_nums
+
+            def run_compare(vm: VM) -> None:
+                belt = vm.belt()
+                if const is not None:
+                    belt.push(const)
+                elif local_idx is not None:
+                    belt.push(vm.local(local_idx))
+                else:
+                    push(vm)
+                a = (const if a_const else belt.get_num(a_idx)).to_signed(is_signed)
+                b = (const if b_const else belt.get_num(b_idx)).to_signed(is_signed)
+                if a is None or b is None:
+                    belt.push(err)
+                else:
+                    belt.push(nums[op(a, b)])
+            return run_compare
+        elif not is_signed:
+            def run_unsigned(vm: VM) -> None:
+                belt = vm.belt()
+                if const is not None:
+                    belt.push(const)
+                elif local_idx is not None:
+                    belt.push(vm.local(local_idx))
+                else:
+                    push(vm)
+                a_num = const if a_const else belt.get_num(a_idx)
+                b_num = const if b_const else belt.get_num(b_idx)
+                data_type = a_num.data_type
+                if data_type is not b_num.data_type:
+                    data_type = data_type.promotions[b_num.data_type.index]
+                a = a_num.int_value
+                b = b_num.int_value
+                if a is None or b is None:
+                    belt.push(data_type.err_num)
+                    return
+                if is_shl and a and b >= data_type.bits:
+                    belt.push(data_type.err_num)
+                    return
+                result = op(a, b)
+                if result > data_type.mask or result < 0:
+                    belt.push(data_type.err_num)
+                else:
+                    belt.push(of(data_type, result))
+            return run_unsigned
+
+        def run_signed(vm: VM) -> None:
+            belt = vm.belt()
+            if const is not None:
+                belt.push(const)
+            elif local_idx is not None:
+                belt.push(vm.local(local_idx))
+            else:
+                push(vm)
+            a_num = const if a_const else belt.get_num(a_idx)
+            b_num = const if b_const else belt.get_num(b_idx)
+            data_type = a_num.data_type
+            if data_type is not b_num.data_type:
+                data_type = data_type.promotions[b_num.data_type.index]
+            a = a_num.to_signed(True)
+            b = b_num.to_signed(True)
+            if a is None or b is None:
+                belt.push(data_type.err_num)
+                return
+            if is_shl and a and b >= data_type.bits:
+                belt.push(data_type.err_num)
+                return
+            result = op(a, b)
+            if result > data_type.max_values[True] or result < data_type.min_values[True]:
+                belt.push(data_type.err_num)
+            else:
+                belt.push(of(data_type, result & data_type.mask))
+        return run_signed
+
+
+class InsCompareBrIf(InsFused):
+    """
+    A compare followed by a br_if on its result (belt index 0): compare-and-branch. The compare result is still
+    pushed; an Err result raises like br_if does.
+    """
+
+    def build(self) -> Runner:
+        a_idx, b_idx = self._first.payload()
+        op, is_signed = self._first.op, self._first.is_signed
+        _, br_depth = self._second.payload()
+        err, nums, br = DataType.I8.err_num, DataType.I8.interned_nums, Break(br_depth, is_continue=False)
+
+        def run(vm: VM) -> Optional[Break]:
+            belt = vm.belt()
+            a = belt.get_num(a_idx).to_signed(is_signed)
+            b = belt.get_num(b_idx).to_signed(is_signed)
+            if a is None or b is None:
+                belt.push(err)
+                raise ValueError('Expected int, got Err')
+            if op(a, b):
+                belt.push(nums[1])
+                return br
+            belt.push(nums[0])
+            return None
+        return run
+
+    def condition(self) -> Callable[[VM], int]:
+        """
+        Closure running the compare and returning its result, for flat code to branch on.
+        """
+        a_idx, b_idx = self._first.payload()
+        op, is_signed = self._first.op, self._first.is_signed
+        err, nums = DataType.I8.err_num, DataType.I8.interned_nums
+
+        def run(vm: VM) -> int:
+            belt = vm.belt()
+            a = belt.get_num(a_idx).to_signed(is_signed)
+            b = belt.get_num(b_idx).to_signed(is_signed)
+            if a is None or b is None:
+                belt.push(err)
+                raise ValueError('Expected int, got Err')
+            result = op(a, b)
+            belt.push(nums[result])
+            return result
+        return run
+
+    def lower(self, lowering: Lowering) -> None:
+        _, br_depth = self._second.payload()
+        skip = lowering.label()
+        lowering.emit_call_jump(self, self.condition(), target=skip)
+        lowering.emit_break(br_depth, is_continue=False)
+        lowering.place(skip)
+
+
+def superinstruction(first: Instruction, second: Instruction) -> Optional[InsFused]:
+    """
+    The superinstruction running first and then second, None if there is none for the pair.
+    """
+    if isinstance(first, PUSHES) and isinstance(second, BINARIES):
+        return InsPushBinary(first, second)
+    if isinstance(first, InsCompare) and isinstance(second, InsBrIf) and second.payload()[0] == 0:
+        return InsCompareBrIf(first, second)
+    return None
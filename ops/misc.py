@@ -1,8 +1,8 @@
 from typing import Optional
 
-from belt import BeltNum, DataType, Integer
+from belt import BeltNum, DataType
 from op import Break
-from op import Instruction
+from op import Instruction, Runner
 from pretty import Pretty
 from vm import VM
 
@@ -15,6 +15,16 @@ class InsConst(Instruction, Pretty):
         vm.belt().push(self._belt_num)
         return None
 
+    def build(self) -> Runner:
+        belt_num = self._belt_num
+
+        def run(vm: VM) -> None:
+            vm.belt().push(belt_num)
+        return run
+
+    def payload(self) -> tuple:
+        return self._belt_num,
+
 
 class InsLocalGet(Instruction, Pretty):
     def __init__(self, local_idx: int) -> None:
@@ -24,6 +34,16 @@ class InsLocalGet(Instruction, Pretty):
         vm.belt().push(vm.local(self._local_idx))
         return None
 
+    def build(self) -> Runner:
+        local_idx = self._local_idx
+
+        def run(vm: VM) -> None:
+            vm.belt().push(vm.local(local_idx))
+        return run
+
+    def payload(self) -> tuple:
+        return self._local_idx,
+
 
 class InsLocalSet(Instruction, Pretty):
     def __init__(self, local_idx: int) -> None:
@@ -33,6 +53,16 @@ class InsLocalSet(Instruction, Pretty):
         vm.set_local(self._local_idx, vm.belt()[0])
         return None
 
+    def build(self) -> Runner:
+        local_idx = self._local_idx
+
+        def run(vm: VM) -> None:
+            vm.set_local(local_idx, vm.belt()[0])
+        return run
+
+    def payload(self) -> tuple:
+        return self._local_idx,
+
 
 class InsIsErr(Instruction, Pretty):
     def __init__(self, item_idx: int) -> None:
@@ -40,11 +70,20 @@ class InsIsErr(Instruction, Pretty):
 
     def run(self, vm: VM) -> Optional['Break']:
         num = vm.belt().get_num(self._item_idx)
-        vm.belt().push(BeltNum(DataType.I8, Integer(
-            1 if num.value.to_int() is None else 0
-        )))
+        vm.belt().push(BeltNum.of(DataType.I8, 1 if num.int_value is None else 0))
         return None
 
+    def build(self) -> Runner:
+        item_idx, false, true = self._item_idx, BeltNum.of(DataType.I8, 0), BeltNum.of(DataType.I8, 1)
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            belt.push(true if belt.get_num(item_idx).int_value is None else false)
+        return run
+
+    def payload(self) -> tuple:
+        return self._item_idx,
+
 
 class InsVerify(Instruction, Pretty):
     def __init__(self, item_idx: int) -> None:
@@ -52,10 +91,21 @@ class InsVerify(Instruction, Pretty):
 
     def run(self, vm: VM) -> Optional['Break']:
         num = vm.belt().get_num(self._item_idx)
-        if num.value.to_int() is None or num.value.to_int() == 0:
+        if num.int_value is None or num.int_value == 0:
             raise ValueError('Verify failed')
         return None
 
+    def build(self) -> Runner:
+        item_idx = self._item_idx
+
+        def run(vm: VM) -> None:
+            if not vm.belt().get_num(item_idx).int_value:
+                raise ValueError('Verify failed')
+        return run
+
+    def payload(self) -> tuple:
+        return self._item_idx,
+
 
 class InsVerifyOk(Instruction, Pretty):
     def __init__(self, item_idx: int) -> None:
@@ -63,10 +113,21 @@ class InsVerifyOk(Instruction, Pretty):
 
     def run(self, vm: VM) -> Optional['Break']:
         num = vm.belt().get_num(self._item_idx)
-        if num.value.to_int() is None:
+        if num.int_value is None:
             raise ValueError('Verify failed')
         return None
 
+    def build(self) -> Runner:
+        item_idx = self._item_idx
+
+        def run(vm: VM) -> None:
+            if vm.belt().get_num(item_idx).int_value is None:
+                raise ValueError('Verify failed')
+        return run
+
+    def payload(self) -> tuple:
+        return self._item_idx,
+
 
 class InsSliceLen(Instruction, Pretty):
     def __init__(self, slice_idx: int) -> None:
@@ -74,9 +135,12 @@ class InsSliceLen(Instruction, Pretty):
 
     def run(self, vm: VM) -> Optional['Break']:
         slc = vm.belt().get_slice(self._slice_idx)
-        vm.belt().push(BeltNum(DataType.I32, Integer(slc.length)))
+        vm.belt().push(BeltNum.of(DataType.I32, slc.length))
         return None
 
+    def payload(self) -> tuple:
+        return self._slice_idx,
+
 
 class InsSliceOp(Instruction, Pretty):
     def __init__(self, slice_idx: int, num_bytes_idx: int, op) -> None:
@@ -86,10 +150,13 @@ class InsSliceOp(Instruction, Pretty):
 
     def run(self, vm: VM) -> Optional['Break']:
         slc = vm.belt().get_slice(self._slice_idx)
-        num_bytes = vm.belt().get_num(self._num_bytes_idx).value.expect_int()
+        num_bytes = vm.belt().get_num(self._num_bytes_idx).expect_int()
         vm.belt().push(self._op(slc, num_bytes))
         return None
 
+    def payload(self) -> tuple:
+        return self._slice_idx, self._num_bytes_idx, self._op
+
 
 class InsSubSlice(Instruction, Pretty):
     def __init__(self, slice_idx: int, start_idx: int, length_idx: int) -> None:
@@ -99,11 +166,14 @@ class InsSubSlice(Instruction, Pretty):
 
     def run(self, vm: VM) -> Optional['Break']:
         slc = vm.belt().get_slice(self._slice_idx)
-        start = vm.belt().get_num(self._start_idx).value.expect_int()
-        length = vm.belt().get_num(self._length_idx).value.expect_int()
+        start = vm.belt().get_num(self._start_idx).expect_int()
+        length = vm.belt().get_num(self._length_idx).expect_int()
         vm.belt().push(slc.subslice(start, length))
         return None
 
+    def payload(self) -> tuple:
+        return self._slice_idx, self._start_idx, self._length_idx
+
 
 class InsLoad(Instruction, Pretty):
     def __init__(self, data_type: DataType, slice_idx: int, offset: int) -> None:
@@ -116,6 +186,17 @@ class InsLoad(Instruction, Pretty):
         vm.belt().push(slc.load(self._data_type, self._offset))
         return None
 
+    def build(self) -> Runner:
+        data_type, slice_idx, offset = self._data_type, self._slice_idx, self._offset
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            belt.push(belt.get_slice(slice_idx).load(data_type, offset))
+        return run
+
+    def payload(self) -> tuple:
+        return self._data_type, self._slice_idx, self._offset
+
 
 class InsStore(Instruction, Pretty):
     def __init__(self, item_idx: int, slice_idx: int, offset: int) -> None:
@@ -128,3 +209,116 @@ class InsStore(Instruction, Pretty):
         num = vm.belt().get_num(self._item_idx)
         slc.store(self._offset, num)
         return None
+
+    def build(self) -> Runner:
+        item_idx, slice_idx, offset = self._item_idx, self._slice_idx, self._offset
+
+        def run(vm: VM) -> None:
+            belt = vm.belt()
+            belt.get_slice(slice_idx).store(offset, belt.get_num(item_idx))
+        return run
+
+    def payload(self) -> tuple:
+        return self._item_idx, self._slice_idx, self._offset
+
+
+def _byte(num: BeltNum) -> int:
+    if num.data_type is not DataType.I8:
+        raise ValueError('Expected 8 bit number')
+    return num.expect_int()
+
+
+class InsRam(Instruction, Pretty):
+    """
+    Pushes the RAM of the VM, the slice bulk ops can write to.
+    """
+
+    def run(self, vm: VM) -> Optional['Break']:
+        vm.belt().push(vm.ram())
+        return None
+
+    def payload(self) -> tuple:
+        return ()
+
+
+class InsSliceCopy(Instruction, Pretty):
+    """
+    Copies the slice at src_idx to the start of the slice at dst_idx, which must be writable and large enough.
+    """
+
+    def __init__(self, dst_idx: int, src_idx: int) -> None:
+        self._dst_idx = dst_idx
+        self._src_idx = src_idx
+
+    def run(self, vm: VM) -> Optional['Break']:
+        belt = vm.belt()
+        src = belt.get_slice(self._src_idx)
+        vm.charge_bytes(src.length)
+        belt.get_slice(self._dst_idx).copy_from(src)
+        return None
+
+    def payload(self) -> tuple:
+        return self._dst_idx, self._src_idx
+
+
+class InsSliceFill(Instruction, Pretty):
+    """
+    Sets every byte of the slice at dst_idx to the 8 bit number at value_idx.
+    """
+
+    def __init__(self, dst_idx: int, value_idx: int) -> None:
+        self._dst_idx = dst_idx
+        self._value_idx = value_idx
+
+    def run(self, vm: VM) -> Optional['Break']:
+        belt = vm.belt()
+        dst = belt.get_slice(self._dst_idx)
+        vm.charge_bytes(dst.length)
+        dst.fill(_byte(belt.get_num(self._value_idx)))
+        return None
+
+    def payload(self) -> tuple:
+        return self._dst_idx, self._value_idx
+
+
+class InsSliceRel(Instruction, Pretty):
+    """
+    Compares the bytes of two slices with op (BeltSlice.compare or BeltSlice.equals), pushes the result as I8.
+    """
+
+    def __init__(self, a_idx: int, b_idx: int, op) -> None:
+        self._a_idx = a_idx
+        self._b_idx = b_idx
+        self._op = op
+
+    def run(self, vm: VM) -> Optional['Break']:
+        belt = vm.belt()
+        a, b = belt.get_slice(self._a_idx), belt.get_slice(self._b_idx)
+        vm.charge_bytes(a.length + b.length)
+        result = self._op(a, b)
+        belt.push(BeltNum.from_signed(result, DataType.I8, True))
+        return None
+
+    def payload(self) -> tuple:
+        return self._a_idx, self._b_idx, self._op
+
+
+class InsSliceFind(Instruction, Pretty):
+    """
+    Pushes the offset (I32) of the first byte in the slice equal to the 8 bit number at value_idx, Err if none is.
+    """
+
+    def __init__(self, slice_idx: int, value_idx: int) -> None:
+        self._slice_idx = slice_idx
+        self._value_idx = value_idx
+
+    def run(self, vm: VM) -> Optional['Break']:
+        belt = vm.belt()
+        slc = belt.get_slice(self._slice_idx)
+        vm.charge_bytes(slc.length)
+        offset = slc.find(_byte(belt.get_num(self._value_idx)))
+        belt.push(BeltNum.of(DataType.I32, offset))
+        return None
+
+    def payload(self) -> tuple:
+        return self._slice_idx, self._value_idx
@@ -0,0 +1,284 @@
+"""
+Optimization pass over compiled instruction trees:
+
+- folds instructions whose operands are constants, running the instruction itself on them so the result has the
+  exact checked/widening/Err semantics of the engines. Instructions that raise on their constants are kept to raise
+  at runtime, verifications that pass are dropped;
+- resolves ifs with a constant condition, inlining the taken block unless it breaks out of itself;
+- removes pushes of the top level block that nothing reads.
+
+Every instruction sees the same items at its belt indices as before: a folded instruction becomes one InsConst per
+item it pushed, and removing a push rewrites the indices of the later reads of older items. Pushes inside loops
+and ifs are kept, removing them would change how far the belt moves per iteration or branch.
+"""
+from typing import Callable, Dict, FrozenSet, List, Optional, Sequence, Set, Tuple
+
+from belt import Belt, BeltItem, BeltNum, BeltSlice
+from bytecode import BELT_IDX, BELT_INDICES, BLOCK, OPCODES_BY_TYPE, InsOpcode
+from lang.parse import CompileResult
+from loop_stack import LoopStack
+from op import Block, Break, Instruction
+from ops.arith import ArithMode, InsArith, InsConvert, InsNAryOp, InsRel, InsRelVerify
+from ops.binary import InsCheckedSigned, InsCheckedUnsigned, InsCompare, InsDivMod, InsWidening
+from ops.flow import InsAlignBlock, InsBr, InsBrContinue, InsBrIf, InsIfUnspecified, InsLoopSpecified, \
+    InsUnreachable
+from ops.digest import InsHashInit
+from ops.misc import InsConst, InsIsErr, InsLoad, InsLocalGet, InsLocalSet, InsRam, InsSliceFind, InsSliceLen, \
+    InsSliceOp, InsSliceRel, InsSubSlice, InsVerify, InsVerifyOk
+from vm import VM
+
+# known constants on the belt, by belt index; None if unknown
+Consts = List[Optional[BeltItem]]
+# possible numbers of pushes since a removed push, capped at Belt.SIZE (from there on it's off the belt)
+Depths = FrozenSet[int]
+
+FOLDABLE = (InsNAryOp, InsRel, InsRelVerify, InsConvert, InsIsErr, InsVerify, InsVerifyOk, InsCheckedUnsigned,
+            InsCheckedSigned, InsCompare, InsWidening, InsDivMod)
+REMOVABLE = (InsConst, InsLocalGet)  # pushes that can't raise
+
+
+def optimize(result: CompileResult) -> CompileResult:
+    instructions, _ = _fold(result.instructions, _unknown())
+    return CompileResult(_remove_unread(instructions), result.num_locals)
+
+
+def _opcode(ins: Instruction) -> InsOpcode:
+    opcode = OPCODES_BY_TYPE.get(type(ins))
+    if opcode is None:
+        raise ValueError(f'{type(ins).__name__} cannot be optimized')
+    return opcode
+
+
+def _belt_reads(ins: Instruction) -> List[int]:
+    reads = []
+    for operand, value in zip(_opcode(ins).operands(), ins.payload()):
+        if operand is BELT_IDX:
+            reads.append(value)
+        elif operand is BELT_INDICES:
+            reads.extend(value)
+    return reads
+
+
+def _rebuild(ins: Instruction, map_read: Callable[[int, int], int], map_block: Callable[[Block], Block]) -> Instruction:
+    """
+    Copy of ins with its belt indices and blocks mapped; map_read gets the number of the read and the index.
+    """
+    opcode = _opcode(ins)
+    payload = []
+    num_reads = 0
+    for operand, value in zip(opcode.operands(), ins.payload()):
+        if operand is BELT_IDX:
+            value = map_read(num_reads, value)
+            num_reads += 1
+        elif operand is BELT_INDICES:
+            value = [map_read(num_reads + n, idx) for n, idx in enumerate(value)]
+            num_reads += len(value)
+        elif operand is BLOCK:
+            value = map_block(value)
+        payload.append(value)
+    return opcode.instruction(payload)
+
+
+def _pushes(ins: Instruction) -> FrozenSet[int]:
+    """
+    Possible numbers of items ins pushes. Widening ops and divmod push a single Err if an operand is Err.
+    """
+    if isinstance(ins, (InsWidening, InsDivMod)):
+        return frozenset({1, 2})
+    elif isinstance(ins, InsArith):
+        return frozenset({1} if ins.payload()[2] == ArithMode.CHECKED else {1, 2})
+    elif isinstance(ins, InsNAryOp):
+        return frozenset({1, 2})
+    elif isinstance(ins, (InsConst, InsLocalGet, InsIsErr, InsSliceLen, InsSliceOp, InsSubSlice, InsLoad, InsRel,
+                          InsConvert, InsCheckedUnsigned, InsCheckedSigned, InsCompare, InsRam, InsSliceRel,
+                          InsSliceFind, InsHashInit)):
+        return frozenset({1})
+    return frozenset({0})
+
+
+def _unknown() -> Consts:
+    return [None] * Belt.SIZE
+
+
+def _push(belt: Consts, item: Optional[BeltItem]) -> None:
+    belt.insert(0, item)
+    del belt[Belt.SIZE:]
+
+
+def _evaluate(ins: Instruction, belt: Consts) -> Optional[List[BeltItem]]:
+    """
+    Runs ins on the constants it reads, returns the items it pushed in push order. None if it reads unknown items
+    or raises.
+    """
+    reads = set(_belt_reads(ins))
+    if len(reads) >= Belt.SIZE or any(belt[idx] is None for idx in reads):
+        return None
+    vm = VM(LoopStack([]), num_locals=0, ram_size=0)
+    # unread positions get distinct markers, the pushed items are the ones in front of the first marker
+    markers = [BeltSlice.over(bytearray()) for _ in range(Belt.SIZE)]
+    for idx in reversed(range(Belt.SIZE)):
+        vm.belt().push(belt[idx] if idx in reads else markers[idx])
+    try:
+        ins.run(vm)
+    except (ValueError, ArithmeticError):
+        return None
+    marker_idx = min(set(range(Belt.SIZE)) - reads)
+    num_pushed = next(n for n in range(Belt.SIZE - marker_idx) if vm.belt()[marker_idx + n] is markers[marker_idx])
+    return [vm.belt()[n] for n in reversed(range(num_pushed))]
+
+
+def _fold(instructions: Sequence[Instruction], belt: Consts) -> Tuple[List[Instruction], Consts]:
+    """
+    Folds the instructions of a block, given the constants on the belt when it starts.
+    """
+    code = []
+    pending = list(reversed(instructions))
+    while pending:
+        ins = pending.pop()
+        if isinstance(ins, InsIfUnspecified):
+            condition_idx, then_block, else_block = ins.payload()
+            condition = belt[condition_idx]
+            if isinstance(condition, BeltNum) and condition.int_value is not None:
+                taken = then_block if condition.int_value else else_block
+                if not _exits(taken.instructions()):
+                    pending.extend(reversed(taken.instructions()))
+                    continue
+                then_block, else_block = (taken, Block([])) if condition.int_value else (Block([]), taken)
+            then_code, _ = _fold(then_block.instructions(), list(belt))
+            else_code, _ = _fold(else_block.instructions(), list(belt))
+            code.append(InsIfUnspecified(condition_idx, Block(then_code), Block(else_code)))
+            belt = _unknown()
+        elif isinstance(ins, InsLoopSpecified):
+            body, = ins.payload()
+            body_code, _ = _fold(body.instructions(), _unknown())
+            code.append(InsLoopSpecified(Block(body_code)))
+            belt = _unknown()
+        elif isinstance(ins, InsAlignBlock):
+            alignment, block = ins.payload()
+            block_code, _ = _fold(block.instructions(), list(belt))
+            code.append(InsAlignBlock(alignment, Block(block_code)))
+            belt = _unknown()
+        else:
+            pushed = _evaluate(ins, belt) if isinstance(ins, FOLDABLE) else None
+            if pushed is not None:
+                for item in pushed:
+                    code.append(InsConst(item))
+                    _push(belt, item)
+                continue
+            code.append(ins)
+            pushes = _pushes(ins)
+            if isinstance(ins, InsConst):
+                _push(belt, ins.payload()[0])
+            elif len(pushes) == 1:
+                num_pushes, = pushes
+                for _ in range(num_pushes):
+                    _push(belt, None)
+            else:
+                belt = _unknown()
+    return code, belt
+
+
+class _Walk:
+    """
+    Follows all paths through a block, recording the possible push depths at each belt read. Breaks are followed to
+    where they continue, like Block.run and the loop and if instructions do.
+    """
+
+    def __init__(self) -> None:
+        # (id of the instruction, number of the read) -> (belt index, depths)
+        self.reads: Dict[Tuple[int, int], Tuple[int, Set[int]]] = {}
+        # depths at implicit reads of the front item, which can't be rewritten
+        self.front_reads: Set[int] = set()
+
+    def block(self, instructions: Sequence[Instruction], depths: Depths) -> Tuple[Depths, List[Tuple[Break, Depths]]]:
+        exits = []
+        for ins in instructions:
+            depths, returned = self.instruction(ins, depths)
+            for br, br_depths in returned:
+                if br.depth > 0:
+                    exits.append((Break(br.depth - 1, br.is_continue), br_depths))
+                else:
+                    depths |= br_depths
+        return depths, exits
+
+    def instruction(self, ins: Instruction, depths: Depths) -> Tuple[Depths, List[Tuple[Break, Depths]]]:
+        for n, idx in enumerate(_belt_reads(ins)):
+            self.reads.setdefault((id(ins), n), (idx, set()))[1].update(depths)
+        if isinstance(ins, InsLocalSet):
+            self.front_reads.update(depths)
+        if isinstance(ins, InsBr):
+            br_depth, = ins.payload()
+            return frozenset(), [(Break(br_depth, is_continue=False), depths)]
+        elif isinstance(ins, InsBrContinue):
+            br_depth, = ins.payload()
+            return frozenset(), [(Break(br_depth, is_continue=True), depths)]
+        elif isinstance(ins, InsBrIf):
+            _, br_depth = ins.payload()
+            return depths, [(Break(br_depth, is_continue=False), depths)]
+        elif isinstance(ins, InsUnreachable):
+            return frozenset(), []
+        elif isinstance(ins, InsIfUnspecified):
+            _, then_block, else_block = ins.payload()
+            then_depths, then_exits = self.block(then_block.instructions(), depths)
+            else_depths, else_exits = self.block(else_block.instructions(), depths)
+            # continuing an if raises
+            returned = [(br, br_depths) for br, br_depths in then_exits + else_exits
+                        if br.depth > 0 or not br.is_continue]
+            return then_depths | else_depths, returned
+        elif isinstance(ins, InsAlignBlock):
+            _, block = ins.payload()
+            return self.block(block.instructions(), depths)
+        elif isinstance(ins, InsLoopSpecified):
+            body, = ins.payload()
+            head = depths
+            while True:
+                end, exits = self.block(body.instructions(), head)
+                next_head = head | end
+                for br, br_depths in exits:
+                    if br.depth == 0 and br.is_continue:
+                        next_head |= br_depths
+                if next_head == head:
+                    break
+                head = next_head
+            return head, [(br, br_depths) for br, br_depths in exits if br.depth > 0 or not br.is_continue]
+        return frozenset(min(depth + num, Belt.SIZE) for depth in depths for num in _pushes(ins)), []
+
+
+def _exits(instructions: Sequence[Instruction]) -> bool:
+    _, exits = _Walk().block(instructions, frozenset({0}))
+    return bool(exits)
+
+
+def _remove_unread(instructions: List[Instruction]) -> List[Instruction]:
+    for removed_idx in reversed(range(len(instructions))):
+        if not isinstance(instructions[removed_idx], REMOVABLE):
+            continue
+        rest = _without_push(instructions[removed_idx + 1:])
+        if rest is not None:
+            instructions = instructions[:removed_idx] + rest
+    return instructions
+
+
+def _without_push(rest: List[Instruction]) -> Optional[List[Instruction]]:
+    """
+    The instructions following an unread push, rewritten for the push being removed. None if the push is read or
+    some read can't be rewritten for all paths.
+    """
+    walk = _Walk()
+    walk.block(rest, frozenset({0}))
+    if 0 in walk.front_reads:
+        return None
+    older = set()
+    for key, (idx, depths) in walk.reads.items():
+        if idx in depths:
+            return None
+        if depths and all(idx > depth for depth in depths):
+            older.add(key)
+        elif not all(idx < depth for depth in depths):
+            return None
+
+    def rewrite(ins: Instruction) -> Instruction:
+        return _rebuild(ins,
+                        lambda n, idx: idx - 1 if (id(ins), n) in older else idx,
+                        lambda block: Block([rewrite(child) for child in block.instructions()]))
+    return [rewrite(ins) for ins in rest]
@@ -0,0 +1,90 @@
+"""
+Content-addressed cache of loaded programs, so contracts that show up again and again across transactions are only
+compiled or decoded once per process.
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional, Tuple
+
+from lang.parse import CompileResult
+from op import Block
+
+
+class CachedProgram(NamedTuple):
+    """
+    A loaded program. It is immutable (Blocks hold tuples and instructions keep no run state), so one instance is
+    shared by all VMs running it.
+    """
+    compile_result: CompileResult
+    block: Block
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    size_bytes: int
+
+
+class ProgramCache:
+    """
+    LRU cache keyed by the SHA-256 of the bytecode. Entries are accounted by the length of their bytecode; the cache
+    evicts least recently used programs when it would hold more than max_entries programs or max_bytes bytes.
+    """
+
+    def __init__(self, max_entries: Optional[int] = 1024, max_bytes: Optional[int] = None) -> None:
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries: 'OrderedDict[bytes, Tuple[CachedProgram, int]]' = OrderedDict()
+        self._size_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def key(bytecode: bytes) -> bytes:
+        return hashlib.sha256(bytecode).digest()
+
+    def get(self, bytecode: bytes, load: Callable[[bytes], CompileResult]) -> CachedProgram:
+        key = self.key(bytecode)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+        self._misses += 1
+        compile_result = load(bytecode)
+        block = Block(compile_result.instructions)
+        program = CachedProgram(CompileResult(block.instructions(), compile_result.num_locals), block)
+        self._insert(key, program, len(bytecode))
+        return program
+
+    def _insert(self, key: bytes, program: CachedProgram, size: int) -> None:
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+        if self._max_entries is not None and self._max_entries <= 0:
+            return
+        self._entries[key] = (program, size)
+        self._size_bytes += size
+        while (self._max_entries is not None and len(self._entries) > self._max_entries) or \
+                (self._max_bytes is not None and self._size_bytes > self._max_bytes):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._size_bytes -= evicted_size
+            self._evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size_bytes = 0
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+            entries=len(self._entries),
+            size_bytes=self._size_bytes,
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,119 @@
+"""
+Example CashAssembly programs, shared by tests and benchmarks.
+"""
+
+IF_ELSE = """
+    version 0.0.1;
+    a = 3i32;
+    b = 2i32;
+    c = 1i8;
+    if c {
+        a = a + b;
+        b = a + c;
+        c = 1i8;
+    }
+    x = a + b;
+"""
+
+FIB = """
+    version 0.0.1;
+    z = 0u64;
+    x = 0u64;
+    y = 1u64;
+    loop fib {
+        s = x + y;
+        z = z | z;
+        x = y | z;
+        y = s | z;
+    }
+    q, r = divmod(y, x);
+    w = cast_wrap8(q);
+    e = is_err(w);
+    verify_eq(q, q);
+    hi, lo = y _*_ y;
+"""
+
+NESTED_BREAK = """
+    version 0.0.1;
+    limit = 20i32;
+    $limit = limit;
+    one = 1i32;
+    n = 0i32;
+    loop outer {
+        loop inner {
+            n = n + one;
+            limit = $limit;
+            done = n >= limit;
+            one = one | one;
+            n = n | n;
+            br_if(done, outer);
+        }
+        n = n + one;
+        one = one | one;
+        n = n | n;
+    }
+    m = cast_extend64(n);
+    verify_ok(m);
+"""
+
+COUNT_TO = """
+    version 0.0.1;
+    limit = 50u32;
+    $limit = limit;
+    sum = 0u32;
+    n = 0u32;
+    loop count {
+        step = 1u32;
+        n = n + step;
+        sum = sum + n;
+        limit = $limit;
+        done = n >= limit;
+        br_if(done, count);
+        sum = sum | sum;
+        n = n | n;
+    }
+    verify_ok(sum);
+"""
+
+# needs 64 bytes of RAM
+SLICES = """
+    version 0.0.1;
+    ram = ram();
+    zero = 0u32;
+    size = 32u32;
+    hash = ram[zero..size];
+    dst = ram[size..size];
+    marker = 171u8;
+    fill(hash, marker);
+    hash[4] = zero;
+    copy(dst, hash);
+    same = equal(dst, hash);
+    order = compare(hash, ram);
+    nul = 0u8;
+    at = find(dst, nul);
+"""
+
+# hashes 64 bytes of RAM in one go and in two chunks, then compares the digests; needs 128 bytes of RAM
+HASHES = """
+    version 0.0.1;
+    ram = ram();
+    zero = 0u32;
+    half = 32u32;
+    size = 64u32;
+    end = 96u32;
+    data = ram[zero..size];
+    first = ram[zero..half];
+    second = ram[half..half];
+    digest = ram[size..half];
+    chunked = ram[end..half];
+    marker = 97u8;
+    fill(data, marker);
+    sha256(digest, data);
+    h = sha256_init();
+    hash_update(h, first);
+    hash_update(h, second);
+    hash_final(h, chunked);
+    same = equal(digest, chunked);
+"""
+
+ALL = [IF_ELSE, FIB, NESTED_BREAK]
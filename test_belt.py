@@ -1,6 +1,10 @@
 import pytest
+from hypothesis import given, strategies as st
 
-from belt import DataType
+from belt import BeltNum, BeltSlice, DataType
+from loop_stack import LoopStack
+from ops.arith import InsArith, ArithMode
+from vm import VM
 
 
 @pytest.mark.parametrize(
@@ -35,3 +39,198 @@ def test_data_type_max(data_type: DataType, is_signed: bool, expected: int):
 )
 def test_data_type_min(data_type: DataType, is_signed: bool, expected: int):
     assert data_type.min_value(is_signed) == expected
+
+
+# reference implementations the mask-based fast paths have to agree with
+def _reference_to_signed(num: BeltNum, is_signed: bool):
+    if is_signed and num.int_value is not None:
+        int_bytes = num.int_value.to_bytes(num.data_type.value // 8, 'little', signed=False)
+        return int.from_bytes(int_bytes, 'little', signed=True)
+    return num.int_value
+
+
+def _reference_from_signed(val: int, data_type: DataType, is_signed: bool) -> int:
+    int_bytes = val.to_bytes(data_type.value // 8, 'little', signed=is_signed)
+    return int.from_bytes(int_bytes, 'little', signed=False)
+
+
+data_types = st.sampled_from(list(DataType))
+
+
+@st.composite
+def belt_nums(draw):
+    data_type = draw(data_types)
+    return BeltNum.of(data_type, draw(st.none() | st.integers(0, (1 << data_type.value) - 1)))
+
+
+@given(belt_nums(), st.booleans())
+def test_to_signed(num: BeltNum, is_signed: bool):
+    assert num.to_signed(is_signed) == _reference_to_signed(num, is_signed)
+
+
+@given(data_types, st.booleans(), st.integers(-(1 << 65), 1 << 65))
+def test_from_signed(data_type: DataType, is_signed: bool, val: int):
+    try:
+        expected = _reference_from_signed(val, data_type, is_signed)
+    except OverflowError as ex:
+        with pytest.raises(OverflowError, match=str(ex)):
+            BeltNum.from_signed(val, data_type, is_signed)
+        return
+    assert BeltNum.from_signed(val, data_type, is_signed) == BeltNum.of(data_type, expected)
+
+
+@given(data_types, data_types, st.booleans())
+def test_data_type_tables(a: DataType, b: DataType, is_signed: bool):
+    assert a.promote(b) == DataType(max(a.value, b.value))
+    assert a.mod_value(is_signed) == 1 << (a.value - is_signed)
+    assert a.num_bytes() == a.value // 8
+
+
+def _widening(op, a: int, b: int, data_type: DataType, is_signed: bool) -> list:
+    vm = VM(LoopStack([]), num_locals=0, ram_size=0)
+    vm.belt().push(BeltNum.from_signed(b, data_type, is_signed))
+    vm.belt().push(BeltNum.from_signed(a, data_type, is_signed))
+    InsArith([0, 1], is_signed, ArithMode.WIDENING, op).run(vm)
+    return vm.belt().items()[:2]
+
+
+# widening arith pushes the high and low half of the double width result; the high half used to be always 0, and
+# results wider than the type raised OverflowError
+@pytest.mark.parametrize(
+    "data_type,is_signed,op,a,b,high,low",
+    [
+        (DataType.I8, False, int.__add__, 200, 100, 1, 44),
+        (DataType.I8, False, int.__mul__, 0xff, 0xff, 0xfe, 0x01),
+        (DataType.I8, True, int.__mul__, -128, -128, 64, 0),
+        (DataType.I8, True, int.__mul__, -1, 1, -1, -1),
+        (DataType.I8, True, int.__sub__, -128, 1, -1, 127),
+        (DataType.I16, False, int.__mul__, 0xffff, 0xffff, 0xfffe, 0x0001),
+        (DataType.I64, True, int.__mul__, 1 << 62, 4, 1, 0),
+    ]
+)
+def test_widening_halves(data_type: DataType, is_signed: bool, op, a: int, b: int, high: int, low: int):
+    assert _widening(op, a, b, data_type, is_signed) == [BeltNum.from_signed(high, data_type, is_signed),
+                                                         BeltNum.from_signed(low, data_type, is_signed)]
+
+
+@given(data_types, st.booleans(), st.sampled_from([int.__add__, int.__sub__, int.__mul__]), st.data())
+def test_widening_split(data_type: DataType, is_signed: bool, op, data):
+    value = st.integers(data_type.min_value(is_signed), data_type.max_value(is_signed))
+    a, b = data.draw(value), data.draw(value)
+    if not is_signed and op(a, b) < 0:
+        # an unsigned borrow has no unsigned high half
+        with pytest.raises(OverflowError):
+            _widening(op, a, b, data_type, is_signed)
+        return
+    high, low = _widening(op, a, b, data_type, is_signed)
+    # the low half holds the low bits, the high half the rest of the result, with its sign
+    assert (high.to_signed(is_signed) << data_type.value) + low.int_value == op(a, b)
+
+
+@given(data_types, st.binary(min_size=0, max_size=24), st.integers(0, 12), st.integers(0, 12), st.integers(-1, 24))
+def test_slice_load(data_type: DataType, data: bytes, start: int, length: int, offset: int):
+    start = min(start, len(data))
+    slc = BeltSlice.over(data).subslice(start, min(length, len(data) - start))
+    if offset < 0:
+        with pytest.raises(ValueError, match='Offset is negative'):
+            slc.load(data_type, offset)
+        return
+    num_bytes = data_type.num_bytes()
+    if offset + num_bytes > slc.length:
+        assert slc.load(data_type, offset) is data_type.err_num
+        return
+    i = slc.start + offset
+    assert slc.load(data_type, offset) == BeltNum.of(data_type, int.from_bytes(data[i:i + num_bytes], 'little'))
+
+
+@given(data_types, st.integers(0, 12), st.integers(-1, 16), st.data())
+def test_slice_store(data_type: DataType, start: int, offset: int, data):
+    ram = bytearray(range(24))
+    slc = BeltSlice.over(ram).subslice(start, 10)
+    num = BeltNum.of(data_type, data.draw(st.none() | st.integers(0, data_type.mask)))
+    expected = bytearray(ram)
+    if offset < 0:
+        with pytest.raises(ValueError, match='Offset is negative'):
+            slc.store(offset, num)
+    elif num.int_value is None:
+        slc.store(offset, num)
+    elif offset + data_type.num_bytes() > slc.length:
+        with pytest.raises(ValueError, match='Tried writing value out of bounds'):
+            slc.store(offset, num)
+    else:
+        slc.store(offset, num)
+        i = start + offset
+        expected[i:i + data_type.num_bytes()] = num.int_value.to_bytes(data_type.num_bytes(), 'little')
+        assert slc.load(data_type, offset) == num
+    assert ram == expected
+
+
+def test_slice_store_read_only():
+    slc = BeltSlice.over(bytes(8))
+    with pytest.raises(ValueError, match='Cannot store in write-only slice'):
+        slc.store(0, BeltNum.of(DataType.I32, 1))
+    # Err is never stored, not even checked against the slice
+    slc.store(100, DataType.I32.err_num)
+
+
+def _slices(draw, buffer):
+    start = draw(st.integers(0, len(buffer)))
+    return BeltSlice.over(buffer).subslice(start, draw(st.integers(0, len(buffer) - start)))
+
+
+@given(st.binary(max_size=16), st.data())
+def test_slice_copy(src_bytes: bytes, data):
+    ram = bytearray(range(32))
+    dst = _slices(data.draw, ram)
+    # the source is either input data or RAM itself, possibly overlapping the destination
+    src = _slices(data.draw, ram if data.draw(st.booleans()) else src_bytes)
+    expected = bytearray(ram)
+    src_data = bytes(src.view())
+    if src.length > dst.length:
+        with pytest.raises(ValueError, match='Tried writing value out of bounds'):
+            dst.copy_from(src)
+    else:
+        dst.copy_from(src)
+        expected[dst.start:dst.start + src.length] = src_data
+    assert ram == expected
+    with pytest.raises(ValueError, match='Cannot store in write-only slice'):
+        BeltSlice.over(src_bytes).copy_from(src)
+
+
+@given(st.integers(0, 255), st.data())
+def test_slice_fill(value: int, data):
+    ram = bytearray(range(32))
+    dst = _slices(data.draw, ram)
+    dst.fill(value)
+    assert ram == bytearray(range(dst.start)) + bytes([value]) * dst.length + \
+        bytearray(range(dst.start + dst.length, 32))
+
+
+@given(st.binary(max_size=12), st.binary(max_size=12), st.integers(0, 255), st.data())
+def test_slice_compare_and_find(a_bytes: bytes, b_bytes: bytes, value: int, data):
+    a, b = _slices(data.draw, a_bytes), _slices(data.draw, bytearray(b_bytes))
+    a_data, b_data = bytes(a.view()), bytes(b.view())
+    assert a.compare(b) == (a_data > b_data) - (a_data < b_data)
+    assert a.equals(b) == (a_data == b_data)
+    assert a.find(value) == (a_data.index(value) if value in a_data else None)
+    assert b.find(value) == (b_data.index(value) if value in b_data else None)
+
+
+def test_slice_find_in_sliced_view():
+    # like the bytes fields of a decoded transaction, a view into the middle of a larger buffer
+    slc = BeltSlice(memoryview(b'\x07\x07\x01\x02\x03')[2:], 0, 3)
+    assert slc.find(7) is None
+    assert slc.find(3) == 2
+    assert slc.subslice(1, 2).find(2) == 0
+
+
+@pytest.mark.parametrize('length', [4095, 4096, 4097, 3 * 4096 + 5])
+def test_slice_compare_chunks(length: int):
+    data = bytes(range(256)) * (length // 256 + 1)
+    a = BeltSlice.over(data[:length])
+    assert a.compare(BeltSlice.over(data[:length])) == 0
+    assert a.compare(BeltSlice.over(data[:length - 1])) == 1
+    assert a.compare(BeltSlice.over(data[:length] + b'\x00')) == -1
+    changed = bytearray(data[:length])
+    changed[-1] ^= 0xff
+    assert a.compare(BeltSlice.over(changed)) == (data[length - 1] > changed[-1]) - (data[length - 1] < changed[-1])
@@ -0,0 +1,114 @@
+import pytest
+
+import programs
+from belt import BeltNum, DataType, Integer
+from bytecode import encode, decode, is_binary, MAGIC, VERSION
+from lang.parse import Compiler, CompileResult
+from loop_stack import LoopStack
+from loop_tree import LoopTree
+from op import Block
+from ops.arith import InsArith, ArithMode
+from ops.misc import InsConst, InsLocalGet, InsLoad, InsStore
+from vm import VM
+
+
+def _run(result: CompileResult, loop_trees):
+    vm = VM(LoopStack(loop_trees), result.num_locals, ram_size=0)
+    Block(result.instructions).run(vm)
+    return [item.int_value for item in vm.belt().items()]
+
+
+@pytest.mark.parametrize(
+    "src,loop_trees",
+    [
+        (programs.IF_ELSE, []),
+        (programs.FIB, [LoopTree.LEAF(30)]),
+        (programs.NESTED_BREAK, [LoopTree.CARTESIAN(5, [LoopTree.LEAF(6)])]),
+    ]
+)
+def test_round_trip(src: str, loop_trees):
+    result = Compiler().compile(src)
+    bytecode = encode(result)
+    assert is_binary(bytecode)
+    decoded = decode(memoryview(bytecode))
+    assert decoded.num_locals == result.num_locals
+    assert encode(decoded) == bytecode
+    assert _run(decoded, loop_trees) == _run(result, loop_trees)
+
+
+def test_encoding():
+    result = CompileResult([
+        InsConst(BeltNum(DataType.I16, Integer(300))),
+        InsConst(DataType.I8.err_num),
+        InsLocalGet(0),
+        InsLoad(DataType.I32, 1, 200),
+        InsStore(0, 2, 3),
+    ], num_locals=1)
+    assert encode(result) == MAGIC + bytes([VERSION]) + bytes.fromhex(
+        '01'  # num_locals
+        '05'  # instructions
+        '10' '01' 'ac02'
+        '10' '80'
+        '11' '00'
+        '19' '02' '01' 'c801'
+        '1a' '00' '02' '03'
+    )
+
+
+def test_encode_unknown_op():
+    result = CompileResult([InsArith([0], False, ArithMode.CHECKED, lambda n: n + 1)], num_locals=0)
+    with pytest.raises(ValueError):
+        encode(result)
+
+
+def test_encode_wrong_arity():
+    result = CompileResult([InsArith([0], False, ArithMode.CHECKED, int.__add__)], num_locals=0)
+    with pytest.raises(ValueError, match='arith takes 2 belt indices, got 1'):
+        encode(result)
+
+
+@pytest.mark.parametrize(
+    "payload,message",
+    [
+        ('0210' '00' '05', 'Unexpected end of bytecode'),
+        ('01ff', 'Unknown opcode prefix 0xff'),
+        ('0113' '10', 'Belt index 16 out of range'),
+        ('0111' '00', 'Local index 0 out of range'),
+        ('0110' '00' 'ff03', 'Constant 511 out of range'),
+        ('0110' '04', 'Invalid data type 4'),
+        ('0121' '00' '01' '02' '00', 'Invalid flag 2'),
+        ('0100' '00', 'Trailing bytes after program'),
+        ('01' + '0201' * 64 + '00', 'Blocks nested too deeply'),
+        ('0120' '01' '00' '00' '00' '00', 'arith takes 2 belt indices, got 1'),
+        ('0123' '03' '00' '01' '02' '00' '00', 'nary takes 2 belt indices, got 3'),
+    ]
+)
+def test_decode_invalid(payload: str, message: str):
+    with pytest.raises(ValueError) as ex:
+        decode(MAGIC + bytes([VERSION, 0]) + bytes.fromhex(payload))
+    assert message in str(ex.value)
+
+
+def test_decode_too_many_locals():
+    decode(MAGIC + bytes([VERSION]) + bytes.fromhex('808004' '00'))
+    with pytest.raises(ValueError, match='Too many locals: 33554432'):
+        decode(MAGIC + bytes([VERSION]) + bytes.fromhex('80808010' '00'))
+
+
+def test_decode_source_fails():
+    assert not is_binary(programs.FIB.encode('ascii'))
+    with pytest.raises(ValueError) as ex:
+        decode(programs.FIB.encode('ascii'))
+    assert 'Not a binary program' == str(ex.value)
+
+
+@pytest.mark.parametrize('src, ram_size', [(programs.SLICES, 64), (programs.HASHES, 128)])
+def test_round_trip_slice_ops(src: str, ram_size: int):
+    result = Compiler().compile(src)
+    bytecode = encode(result)
+    assert encode(decode(bytecode)) == bytecode
+    vms = [VM(LoopStack([]), result.num_locals, ram_size=ram_size) for _ in range(2)]
+    Block(result.instructions).run(vms[0])
+    Block(decode(bytecode).instructions).run(vms[1])
+    assert vms[0].belt().items() == vms[1].belt().items()
+    assert bytes(vms[0].ram().data) == bytes(vms[1].ram().data)
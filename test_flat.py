@@ -0,0 +1,138 @@
+import pytest
+
+from belt import BeltNum, DataType, Integer
+from flat import lower
+from loop_stack import LoopStack
+from loop_tree import LoopTree
+from op import Block, Engine
+from ops.arith import InsArith, ArithMode, InsRel
+from ops.flow import InsLoopSpecified, InsBrIf, InsBr, InsBrContinue, InsIfUnspecified, InsAlignBlock
+from ops.misc import InsConst
+from vm import VM
+
+
+def _const(n: int) -> InsConst:
+    return InsConst(BeltNum(DataType.I32, Integer(n)))
+
+
+def _inc(idx: int = 0) -> InsArith:
+    return InsArith([idx], False, ArithMode.CHECKED, lambda n: n + 1)
+
+
+def _run_engines(block: Block, loop_trees):
+    belts = []
+    for engine in Engine:
+        vm = VM(LoopStack(loop_trees()), num_locals=0, ram_size=0)
+        block.runner(engine)(vm)
+        belts.append([vm.belt().get_num(i).value.to_int() for i in range(16)])
+    for belt in belts[1:]:
+        assert belt == belts[0]
+    return belts[0]
+
+
+def test_continue_loop():
+    block = Block([
+        _const(0),
+        InsLoopSpecified(Block([
+            InsLoopSpecified(Block([
+                _inc(),
+                InsBrContinue(1),
+                _const(99),
+            ])),
+            _const(5),
+        ])),
+    ])
+    belt = _run_engines(block, lambda: [LoopTree.CARTESIAN(2, [LoopTree.LEAF(3)])])
+    assert belt[:9] == [5, 8, 7, 6, 5, 3, 2, 1, 0]
+
+
+def test_continue_outer_loop():
+    block = Block([
+        _const(0),
+        InsLoopSpecified(Block([
+            InsLoopSpecified(Block([
+                _inc(),
+                InsBrContinue(2),
+            ])),
+            _const(5),
+        ])),
+    ])
+    belt = _run_engines(block, lambda: [LoopTree.CARTESIAN(2, [LoopTree.LEAF(3)])])
+    assert belt[:3] == [2, 1, 0]
+
+
+def test_br_through_if():
+    block = Block([
+        _const(0),
+        _const(0),
+        _const(0),
+        InsLoopSpecified(Block([
+            _inc(2),
+            _const(3),
+            InsRel(1, 0, False, int.__eq__),
+            InsIfUnspecified(0, Block([
+                InsBr(2),
+            ]), Block([])),
+        ])),
+        _const(100),
+    ])
+    belt = _run_engines(block, lambda: [LoopTree.LEAF(10)])
+    assert belt[:7] == [100, 1, 3, 3, 0, 3, 2]
+
+
+def test_br_out_of_program():
+    block = Block([
+        _const(1),
+        InsLoopSpecified(Block([
+            _inc(),
+            InsBr(3),
+        ])),
+        _const(100),
+    ])
+    belt = _run_engines(block, lambda: [LoopTree.LEAF(10)])
+    assert belt[:2] == [2, 1]
+
+
+def test_br_out_of_align():
+    block = Block([
+        InsAlignBlock(4, Block([
+            _const(1),
+            InsBr(1),
+            _const(2),
+        ])),
+        _const(3),
+    ])
+    for engine in Engine:
+        vm = VM(LoopStack([]), num_locals=0, ram_size=0)
+        block.runner(engine)(vm)
+        assert vm.alignment() == 0
+        assert vm.belt().get_num(0).expect_int() == 3
+        assert vm.belt().get_num(1).expect_int() == 1
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+def test_continue_if_fails(engine: Engine):
+    block = Block([
+        _const(1),
+        InsIfUnspecified(0, Block([
+            InsBrContinue(1),
+        ]), Block([])),
+    ])
+    vm = VM(LoopStack([]), num_locals=0, ram_size=0)
+    with pytest.raises(ValueError) as ex:
+        block.runner(engine)(vm)
+    assert 'Cannot continue if/else/end block' == str(ex.value)
+
+
+def test_deep_nesting_is_flat():
+    depth = 200
+    block = Block([_inc()])
+    for _ in range(depth):
+        block = Block([InsLoopSpecified(block)])
+    tree = LoopTree.LEAF(1)
+    for _ in range(depth - 1):
+        tree = LoopTree.CARTESIAN(1, [tree])
+    program = lower(block)
+    vm = VM(LoopStack([tree]), num_locals=0, ram_size=0)
+    program.run(vm)
+    assert vm.belt().get_num(0).expect_int() == 1
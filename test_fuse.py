@@ -0,0 +1,158 @@
+import io
+
+import pytest
+from hypothesis import given, settings, strategies as st
+
+import flat
+import programs
+from belt import BeltNum, DataType
+from bytecode import encode
+from fuse import count_pairs, fusable_pairs, fuse, speedup, trace
+from hooks import TraceHook
+from lanes import run_lanes
+from lang.parse import Compiler, CompileResult
+from loop_stack import LoopStack
+from loop_tree import LoopTree
+from op import Block, Engine
+from ops.binary import CHECKED, COMPARE
+from ops.flow import InsBrIf, InsLoopSpecified
+from ops.fused import InsCompareBrIf, InsPushBinary
+from ops.misc import InsConst, InsLocalGet, InsLocalSet
+from vm import VM
+
+SOURCES = programs.ALL + [programs.COUNT_TO]
+LOOP_TREES = [
+    [LoopTree.LEAF(0)], [LoopTree.LEAF(3)], [LoopTree.LEAF(100)], [LoopTree.CARTESIAN(4, [LoopTree.LEAF(30)])],
+]
+
+
+def _outcome(instructions, num_locals: int, loop_trees, engine: Engine, seed=()):
+    vm = VM(LoopStack(list(loop_trees)), num_locals=num_locals, ram_size=0)
+    for num in seed:
+        vm.belt().push(num)
+    try:
+        Block(instructions).runner(engine)(vm)
+        error = None
+    except Exception as ex:
+        error = type(ex), str(ex)
+    return error, vm.belt().items(), [vm.local(idx) for idx in range(num_locals)]
+
+
+def _all_pairs(result: CompileResult):
+    return set(fusable_pairs([result]))
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('src', SOURCES)
+@pytest.mark.parametrize('loop_trees', LOOP_TREES)
+def test_same_outcome(engine: Engine, src: str, loop_trees):
+    result = Compiler().compile(src)
+    fused = fuse(result.instructions, _all_pairs(result))
+    assert _outcome(fused, result.num_locals, loop_trees, engine) == \
+        _outcome(result.instructions, result.num_locals, loop_trees, engine)
+
+
+def test_fuses_default_pairs():
+    result = Compiler().compile(programs.COUNT_TO)
+    loop = next(ins for ins in fuse(result.instructions) if isinstance(ins, InsLoopSpecified))
+    body = [type(ins) for ins in loop.payload()[0].instructions()]
+    assert body.count(InsPushBinary) == 1
+    assert body.count(InsCompareBrIf) == 1
+    assert len(body) == len(next(ins for ins in result.instructions if isinstance(ins, InsLoopSpecified))
+                            .payload()[0].instructions()) - 2
+    # only listed pairs are fused
+    unfused = CompileResult(fuse(result.instructions, frozenset()), result.num_locals)
+    assert encode(unfused) == encode(result)
+
+
+@st.composite
+def belt_nums(draw):
+    data_type = draw(st.sampled_from(list(DataType)))
+    bits = data_type.value
+    special = st.sampled_from([0, 1, (1 << bits) - 1, 1 << (bits - 1), (1 << (bits - 1)) - 1])
+    return BeltNum.of(data_type, draw(st.none() | special | st.integers(0, (1 << bits) - 1)))
+
+
+BINARIES = list(CHECKED.values()) + list(COMPARE.values())
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('binary', BINARIES, ids=lambda cls: cls.__name__)
+@settings(max_examples=10, deadline=None)
+@given(pushed=belt_nums(), seed=st.lists(belt_nums(), min_size=2, max_size=2),
+       a_idx=st.integers(0, 2), b_idx=st.integers(0, 2), from_local=st.booleans(), br_if=st.booleans())
+def test_superinstructions(engine: Engine, binary: type, pushed: BeltNum, seed, a_idx: int, b_idx: int,
+                           from_local: bool, br_if: bool):
+    if binary.op in (int.__lshift__, int.__rshift__):
+        seed = [BeltNum.of(num.data_type, None if num.int_value is None else num.int_value % 70) for num in seed]
+        pushed = BeltNum.of(pushed.data_type, None if pushed.int_value is None else pushed.int_value % 70)
+    push = InsLocalGet(0) if from_local else InsConst(pushed)
+    body = [push, binary(a_idx, b_idx)]
+    if br_if:
+        body.append(InsBrIf(0, 1))
+    # runs twice to see br_if leave the loop; the local is set to the pushed number first
+    instructions = [InsConst(pushed), InsLocalSet(0), InsLoopSpecified(Block(body))]
+    pairs = {(type(first).__name__, type(second).__name__) for first, second in zip(body, body[1:])}
+    fused = fuse(instructions, pairs)
+    fused_body = fused[2].payload()[0].instructions()
+    assert isinstance(fused_body[0], InsPushBinary)
+    assert _outcome(fused, 1, [LoopTree.LEAF(2)], engine, seed) == \
+        _outcome(instructions, 1, [LoopTree.LEAF(2)], engine, seed)
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('is_signed', [False, True])
+def test_shl_out_of_range(engine: Engine, is_signed: bool):
+    instructions = [InsConst(BeltNum.of(DataType.I64, 1)), CHECKED[int.__lshift__, is_signed](0, 1)]
+    fused = fuse(instructions, {('InsConst', CHECKED[int.__lshift__, is_signed].__name__)})
+    assert isinstance(fused[0], InsPushBinary)
+    seed = [BeltNum.of(DataType.I64, 1 << 40)]
+    assert _outcome(fused, 0, [], engine, seed)[1][0] == DataType.I64.err_num
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('condition', [BeltNum.of(DataType.I32, 7), DataType.I32.err_num])
+def test_compare_and_branch(engine: Engine, condition: BeltNum):
+    compare = COMPARE[int.__lt__, False](0, 1)
+    instructions = [InsLoopSpecified(Block([compare, InsBrIf(0, 1), InsConst(condition)]))]
+    fused = fuse(instructions, {('InsLtUnsigned', 'InsBrIf')})
+    assert isinstance(fused[0].payload()[0].instructions()[0], InsCompareBrIf)
+    seed = [BeltNum.of(DataType.I32, 9), condition]
+    assert _outcome(fused, 0, [LoopTree.LEAF(5)], engine, seed) == \
+        _outcome(instructions, 0, [LoopTree.LEAF(5)], engine, seed)
+
+
+@pytest.mark.parametrize('same_trees', [False, True])
+def test_lanes(same_trees: bool):
+    result = Compiler().compile(programs.COUNT_TO)
+    program = flat.lower(Block(fuse(result.instructions)))
+    assert any(isinstance(program.call(pc), InsCompareBrIf) for pc in range(len(program.code())))
+
+    def vms():
+        return [VM(LoopStack([LoopTree.LEAF(70 if same_trees else lane * 5)]), num_locals=result.num_locals,
+                   ram_size=0) for lane in range(16)]
+    lane_vms, scalar_vms = vms(), vms()
+    errors = run_lanes(program, lane_vms)
+    for lane_vm, scalar_vm, error in zip(lane_vms, scalar_vms, errors):
+        program.run(scalar_vm)
+        assert error is None
+        assert lane_vm.belt().items() == scalar_vm.belt().items()
+
+
+def test_count_pairs():
+    out = io.StringIO()
+    vm = VM(LoopStack([]), num_locals=0, ram_size=0, hook=TraceHook(out))
+    Block([InsConst(BeltNum.of(DataType.I8, 1)), InsConst(BeltNum.of(DataType.I8, 2)),
+           CHECKED[int.__add__, False](0, 1), InsConst(BeltNum.of(DataType.I8, 3))]).run(vm)
+    assert count_pairs(out.getvalue().splitlines()) == {
+        ('InsConst', 'InsConst'): 1, ('InsConst', 'InsAddUnsigned'): 1, ('InsAddUnsigned', 'InsConst'): 1,
+    }
+    counts = count_pairs(trace(Compiler().compile(programs.COUNT_TO), [LoopTree.LEAF(100)]))
+    # the loop breaks in its 50th iteration
+    assert counts['InsGeUnsigned', 'InsBrIf'] == 50
+    assert counts['InsBrIf', 'InsOrUnsigned'] == 49
+
+
+def test_speedup_runs():
+    samples = [(Compiler().compile(programs.COUNT_TO), [LoopTree.LEAF(10)])]
+    assert speedup(samples, Engine.FLAT, {('InsGeUnsigned', 'InsBrIf')}, rounds=1) > -1
@@ -0,0 +1,97 @@
+import io
+import itertools
+
+import pytest
+
+from belt import BeltNum, DataType, Integer
+from hooks import OpcodeCountHook, LoopIterationHook, InstructionTimeHook, TraceHook, MultiHook
+from loop_stack import LoopStack
+from loop_tree import LoopTree
+from op import Block
+from ops.arith import InsArith, ArithMode
+from ops.flow import InsLoopSpecified, InsUnreachable
+from ops.misc import InsConst, InsLocalGet
+from vm import VM
+
+
+def _nested_program():
+    inner1 = InsLoopSpecified(Block([
+        InsArith([0], True, ArithMode.CHECKED, lambda n: n - 1),
+    ]))
+    inner2 = InsLoopSpecified(Block([
+        InsArith([0], True, ArithMode.CHECKED, lambda n: n + 1),
+    ]))
+    outer = InsLoopSpecified(Block([inner1, inner2]))
+    return Block([outer]), outer, inner1, inner2
+
+
+def _vm(hook) -> VM:
+    return VM(
+        LoopStack([
+            LoopTree.CARTESIAN(3, [
+                LoopTree.LEAF(3),
+                LoopTree.LEAF(5),
+            ]),
+        ]),
+        num_locals=0,
+        ram_size=0,
+        hook=hook,
+    )
+
+
+def test_opcode_counts():
+    hook = OpcodeCountHook()
+    block, *_ = _nested_program()
+    block.run(_vm(hook))
+    assert hook.counts == {
+        'InsLoopSpecified': 1 + 3 * 2,
+        'InsArith': 3 * (3 + 5),
+    }
+
+
+def test_loop_iterations():
+    hook = LoopIterationHook()
+    block, outer, inner1, inner2 = _nested_program()
+    block.run(_vm(hook))
+    assert hook.iterations == {outer: 3, inner1: 9, inner2: 15}
+
+
+def test_instruction_times_and_multi_hook():
+    times = InstructionTimeHook()
+    counts = OpcodeCountHook()
+    block, *_ = _nested_program()
+    block.run(_vm(MultiHook([times, counts])))
+    assert set(times.times_ns) == {'InsLoopSpecified', 'InsArith'}
+    assert times.times_ns['InsLoopSpecified'] >= times.times_ns['InsArith']
+    assert sum(counts.counts.values()) == 31
+
+
+def test_instruction_times_after_raise(monkeypatch):
+    clock = itertools.count(0, 10)
+    monkeypatch.setattr('hooks.time.perf_counter_ns', lambda: next(clock))
+    times = InstructionTimeHook()
+    inner = Block([InsConst(BeltNum(DataType.I8, Integer(1))), InsUnreachable()])
+    outer = InsLoopSpecified(inner)
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            Block([outer]).run(VM(LoopStack([LoopTree.LEAF(1)]), num_locals=0, ram_size=0, hook=times))
+    assert times.times_ns == {'InsConst': 30}
+    times.times_ns.clear()
+    # the loop runs again after raising, its time starts where it does now
+    Block([outer]).run(VM(LoopStack([LoopTree.LEAF(0)]), num_locals=0, ram_size=0, hook=times))
+    Block([InsConst(BeltNum(DataType.I8, Integer(1)))]).run(VM(LoopStack([]), num_locals=0, ram_size=0, hook=times))
+    assert times.times_ns == {'InsLoopSpecified': 10, 'InsConst': 10}
+
+
+def test_trace_with_slice():
+    out = io.StringIO()
+    vm = VM(LoopStack([]), num_locals=1, ram_size=4, hook=TraceHook(out))
+    vm.set_local(0, vm.ram())
+    Block([
+        InsLocalGet(0),
+        InsConst(BeltNum(DataType.I8, Integer(7))),
+    ]).run(vm)
+    assert out.getvalue().splitlines() == [
+        'InsLocalGet [0..+4] ' + ' '.join(['0'] * 15),
+        'InsConst 7 [0..+4] ' + ' '.join(['0'] * 14),
+    ]
@@ -0,0 +1,119 @@
+import random
+
+import pytest
+
+import flat
+import programs
+from belt import BeltNum, DataType
+from lanes import run_lanes
+from lang.parse import Compiler
+from loop_stack import LoopStack
+from loop_tree import LoopTree
+from op import Block
+from ops.arith import InsArith, ArithMode, InsRel, InsRelVerify, InsNAryOp, InsConvert, divmod_op, cast_wrap
+from ops.flow import InsIfUnspecified
+from ops.misc import InsConst, InsIsErr, InsVerify, InsLocalSet, InsLocalGet
+from vm import VM
+
+
+def _random_num(rng: random.Random, data_type: DataType) -> BeltNum:
+    bits = data_type.value
+    value = rng.choice([None, 0, 1, (1 << bits) - 1, 1 << (bits - 1), rng.getrandbits(bits), rng.getrandbits(4)])
+    return BeltNum.of(data_type, value)
+
+
+def _vm(loop_trees=(), seed=None, num_locals=1) -> VM:
+    vm = VM(LoopStack(list(loop_trees)), num_locals=num_locals, ram_size=0)
+    for num in seed or []:
+        vm.belt().push(num)
+    return vm
+
+
+def _error(ex):
+    return None if ex is None else (type(ex), str(ex))
+
+
+def _compare(block: Block, make_vms):
+    program = flat.lower(block)
+    lane_vms, scalar_vms = make_vms(), make_vms()
+    errors = run_lanes(program, lane_vms)
+    for lane_vm, scalar_vm, error in zip(lane_vms, scalar_vms, errors):
+        try:
+            program.run(scalar_vm)
+            expected = None
+        except Exception as ex:
+            expected = ex
+        assert _error(error) == _error(expected)
+        if expected is None:
+            assert lane_vm.belt().items() == scalar_vm.belt().items()
+            assert lane_vm.local(0) == scalar_vm.local(0)
+
+
+def _seeded_vms(types, n=64, seed=0):
+    def make():
+        rng = random.Random(seed)
+        return [_vm(seed=[_random_num(rng, data_type) for data_type in types]) for _ in range(n)]
+    return make
+
+
+ARITH_OPS = [int.__add__, int.__sub__, int.__mul__, int.__floordiv__, int.__mod__, int.__lshift__, int.__rshift__,
+             int.__and__, int.__or__, int.__xor__]
+REL_OPS = [int.__eq__, int.__ne__, int.__lt__, int.__le__, int.__gt__, int.__ge__]
+
+
+@pytest.mark.parametrize("data_type", list(DataType))
+@pytest.mark.parametrize("is_signed", [False, True])
+@pytest.mark.parametrize("op", ARITH_OPS)
+def test_arith(data_type: DataType, is_signed: bool, op):
+    block = Block([
+        InsArith([0, 1], is_signed, ArithMode.CHECKED, op),
+        InsArith([0, 2], is_signed, ArithMode.CHECKED, op),
+    ])
+    _compare(block, _seeded_vms([DataType.I8, data_type]))
+
+
+@pytest.mark.parametrize("data_type", list(DataType))
+@pytest.mark.parametrize("is_signed", [False, True])
+def test_rel_and_divmod(data_type: DataType, is_signed: bool):
+    block = Block(
+        [InsRel(0, 1, is_signed, op) for op in REL_OPS] +
+        [InsNAryOp([6, 7], is_signed, divmod_op), InsIsErr(0), InsRelVerify(8, 9, is_signed, int.__le__)]
+    )
+    _compare(block, _seeded_vms([data_type, data_type]))
+
+
+def test_divmod_overflow():
+    block = Block([InsNAryOp([0, 1], True, divmod_op)])
+    _compare(block, lambda: [_vm(seed=[BeltNum.of(DataType.I8, 0xff), BeltNum.of(DataType.I8, a)]) for a in [0x80, 3]])
+
+
+@pytest.mark.parametrize("is_signed", [False, True])
+def test_convert(is_signed: bool):
+    block = Block([
+        InsConvert(0, DataType.I64, is_signed, BeltNum.extend),
+        InsConvert(1, DataType.I8, is_signed, cast_wrap),
+        InsConvert(2, DataType.I8, is_signed, BeltNum.cast_sat),
+        InsConvert(3, DataType.I16, is_signed, BeltNum.cast_checked),
+        InsLocalSet(0),
+        InsVerify(3),
+    ])
+    _compare(block, _seeded_vms([DataType.I32]))
+
+
+def test_divergent_if():
+    block = Block([
+        InsIfUnspecified(0, Block([InsConst(BeltNum.of(DataType.I8, 1))]), Block([InsLocalGet(0)])),
+        InsIsErr(0),
+    ])
+    _compare(block, _seeded_vms([DataType.I8]))
+
+
+@pytest.mark.parametrize("same_trees", [False, True])
+def test_programs(same_trees: bool):
+    fib = Block(Compiler().compile(programs.FIB).instructions)
+    _compare(fib, lambda: [_vm([LoopTree.LEAF(30 if same_trees else lane % 40)]) for lane in range(16)])
+    nested = Compiler().compile(programs.NESTED_BREAK)
+    _compare(Block(nested.instructions), lambda: [
+        _vm([LoopTree.CARTESIAN(5 if same_trees else lane % 7, [LoopTree.LEAF(6)])], num_locals=nested.num_locals)
+        for lane in range(16)
+    ])
@@ -1,7 +1,7 @@
 import pytest
 
 from loop_stack import LoopStack
-from loop_tree import LoopTree
+from loop_tree import LoopTree, encode_loop_trees, load_loop_trees
 
 
 def test_loop_stack_leaf():
@@ -145,3 +145,54 @@ def test_loop_stack_complex_no_break():
     with pytest.raises(ValueError) as ex:
         stack.next()
     assert 'No current loop' == str(ex.value)
+
+
+def test_loop_stack_errors():
+    stack = LoopStack([LoopTree.CARTESIAN(1, [LoopTree.LEAF(1)]), LoopTree.LEAF(2)])
+    for method in [stack.next, stack.break_loop, stack.continue_loop]:
+        with pytest.raises(ValueError, match='No current loop'):
+            method()
+    stack.start_loop()
+    with pytest.raises(ValueError, match='Tried starting loop within loop before any iteration'):
+        stack.start_loop()
+    assert not stack.next()
+    stack.start_loop()
+    assert not stack.next()
+    with pytest.raises(ValueError, match='Cannot start loop in leaf'):
+        stack.start_loop()
+    # break moves the parent's inner position past the child, which started none
+    stack.break_loop()
+    with pytest.raises(ValueError, match='Tried starting a non-existing loop in a rolled out loop'):
+        stack.start_loop()
+    stack.continue_loop()
+    stack.start_loop()
+    assert not stack.next()
+    assert stack.next()
+    assert stack.next()
+    stack.start_loop()
+    assert not stack.next()
+    assert not stack.next()
+    assert stack.next()
+    with pytest.raises(IndexError):
+        stack.start_loop()
+
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_loop_stack_from_array(indexed: bool):
+    data = encode_loop_trees([LoopTree.ROLLED_OUT([[LoopTree.LEAF(2)], [LoopTree.LEAF(1)]])], indexed)
+    stack = LoopStack(load_loop_trees(data))
+    stack.start_loop()
+    for num_loops in [2, 1]:
+        assert not stack.next()
+        stack.start_loop()
+        for _ in range(num_loops):
+            assert not stack.next()
+        assert stack.next()
+    assert stack.next()
+    with pytest.raises(ValueError, match='Tried starting a non-existing loop in a rolled out loop'):
+        stack = LoopStack(load_loop_trees(data))
+        stack.start_loop()
+        stack.next()
+        stack.start_loop()
+        stack.break_loop()
+        stack.start_loop()
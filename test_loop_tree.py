@@ -1,7 +1,11 @@
+import io
+
 import leb128
+import pytest
+from hypothesis import given, strategies as st
 
-from loop_tree import parse_loop_trees, LoopTree
-import io
+from loop_tree import LazyLoopTreeArray, LoopTree, LoopTreeArray, decode_loop_trees, encode_loop_trees, \
+    load_loop_trees, parse_loop_trees
 
 
 def test_parse_empty():
@@ -52,3 +56,166 @@ def test_parse_complex_tree():
             [LoopTree.LEAF(2)],
         ]),
     ]
+
+
+@st.composite
+def loop_trees(draw, depth: int = 3):
+    kind = draw(st.integers(0, 2 if depth else 0))
+    if kind == 0:
+        return LoopTree.LEAF(draw(st.integers(0, 1 << 40)))
+    num_children = draw(st.integers(0, 3))
+    if kind == 1:
+        return LoopTree.ROLLED_OUT(draw(st.lists(st.lists(loop_trees(depth - 1), min_size=num_children,
+                                                          max_size=num_children), max_size=3)))
+    return LoopTree.CARTESIAN(draw(st.integers(0, 300)),
+                              draw(st.lists(loop_trees(depth - 1), min_size=num_children, max_size=num_children)))
+
+
+@given(trees=st.lists(loop_trees(), max_size=4))
+def test_round_trip(trees):
+    data = encode_loop_trees(trees)
+    assert decode_loop_trees(data) == trees
+    assert decode_loop_trees(memoryview(data)) == trees
+    assert parse_loop_trees(io.BytesIO(data)) == trees
+
+
+@given(trees=st.lists(loop_trees(), max_size=4))
+def test_array_from_trees(trees):
+    array = LoopTreeArray.from_trees(trees)
+    assert array.to_trees() == trees
+    decoded = LoopTreeArray.decode(encode_loop_trees(trees))
+    assert decoded.to_trees() == trees
+    for root, tree in zip(array.roots, trees):
+        assert (array.num_loops(root), array.num_children(root)) == (tree.num_loops(), tree.num_children())
+
+
+def test_array_nodes():
+    trees = decode_loop_trees(bytes.fromhex('020403' '0009' '010302' '000800010000000500070002' '020601' '0003'
+                                            '010201' '000a' '0002'))
+    array = LoopTreeArray.from_trees(trees)
+    cartesian, rolled_out = array.roots
+    assert array.kind(cartesian) == LoopTreeArray.CARTESIAN
+    assert (array.num_loops(cartesian), array.num_children(cartesian)) == (4, 3)
+    nested = array.child(cartesian, 1, 1)
+    assert array.child(cartesian, 3, 1) == nested
+    assert (array.kind(nested), array.num_loops(nested), array.num_children(nested)) == (LoopTreeArray.ROLLED_OUT, 3, 2)
+    # second row, second column
+    assert array.num_loops(array.child(nested, 2, 1)) == 5
+    assert array.num_loops(array.child(rolled_out, 2, 0)) == 2
+    assert array.num_nodes() == 14
+
+
+def test_array_is_compact():
+    rows = 5000
+    data = encode_loop_trees([LoopTree.ROLLED_OUT([[LoopTree.LEAF(idx)] for idx in range(rows)])])
+    array = LoopTreeArray.decode(data, max_nodes=3 * rows)
+    columns = [array.kinds, array.loops, array.children, array.first_child]
+    assert sum(column.itemsize * len(column) for column in columns) == 20 * (rows + 1)
+    assert array.num_loops(array.child(0, rows, 0)) == rows - 1
+
+
+def _assert_same_nodes(array, node, lazy, lazy_node):
+    assert (lazy.kind(lazy_node), lazy.num_loops(lazy_node), lazy.num_children(lazy_node)) == \
+           (array.kind(node), array.num_loops(node), array.num_children(node))
+    kind = array.kind(node)
+    positions = range(1, array.num_loops(node) + 1) if kind == LoopTreeArray.ROLLED_OUT else [1]
+    if kind == LoopTreeArray.LEAF:
+        positions = []
+    for position in positions:
+        for inner_position in range(array.num_children(node)):
+            _assert_same_nodes(array, array.child(node, position, inner_position),
+                               lazy, lazy.child(lazy_node, position, inner_position))
+
+
+@given(trees=st.lists(loop_trees(), max_size=4))
+def test_lazy_array(trees):
+    data = encode_loop_trees(trees, indexed=True)
+    lazy = load_loop_trees(data)
+    assert isinstance(lazy, LazyLoopTreeArray)
+    array = LoopTreeArray.from_trees(trees)
+    for idx, root in enumerate(array.roots):
+        _assert_same_nodes(array, root, lazy, lazy.root(idx))
+    assert lazy.num_nodes() == array.num_nodes()
+    with pytest.raises(IndexError, match='No loop tree left to start'):
+        lazy.root(len(trees))
+    assert isinstance(load_loop_trees(encode_loop_trees(trees)), LoopTreeArray)
+
+
+def test_lazy_array_decodes_entered_nodes():
+    rows = 100_000
+    data = bytearray(encode_loop_trees([LoopTree.ROLLED_OUT([[LoopTree.CARTESIAN(2, [LoopTree.LEAF(idx)])]
+                                                             for idx in range(rows)])], indexed=True))
+    # corrupt the leaf of the first row, which isn't entered
+    leaf = data.index(bytes.fromhex('020000'))
+    data[leaf + 1] = 3
+    lazy = LazyLoopTreeArray(bytes(data))
+    root = lazy.root(0)
+    row = lazy.child(root, rows - 1, 0)
+    assert lazy.num_loops(lazy.child(row, 1, 0)) == rows - 2
+    assert lazy.child(row, 2, 0) == lazy.child(row, 1, 0)
+    assert lazy.num_nodes() == 3
+    with pytest.raises(ValueError, match='Invalid loop tree kind 3'):
+        lazy.child(lazy.child(root, 1, 0), 1, 0)
+
+
+@pytest.mark.parametrize('data, path, message', [
+    ('ff', [], 'No loop tree left to start'),
+    ('ff00', [], 'Unexpected end of loop trees'),
+    ('ff050003', [], 'Loop tree size out of bounds'),
+    ('ff03000300', [], 'Trailing bytes in loop tree'),
+    ('ff020300', [], 'Invalid loop tree kind 3'),
+    ('ff0302ff01', [], 'Unexpected end of loop trees'),
+    ('ff0502010103000b', [(1, 0)], 'Loop tree size out of bounds'),
+    ('ff0502010102000b', [(1, 0)], 'Loop tree size out of bounds'),
+    ('ff04020101', [(1, 0)], 'Loop tree size out of bounds'),
+    ('ff08' '0100' '808080808020', [], 'Too many loop tree nodes'),
+])
+def test_lazy_array_errors(data: str, path: list, message: str):
+    lazy = LazyLoopTreeArray(bytes.fromhex(data))
+    with pytest.raises((ValueError, IndexError), match=message):
+        node = lazy.root(0)
+        for position, inner_position in path:
+            node = lazy.child(node, position, inner_position)
+
+
+def test_lazy_array_node_limit():
+    data = encode_loop_trees([LoopTree.CARTESIAN(1, [LoopTree.LEAF(1)] * 3)], indexed=True)
+    lazy = LazyLoopTreeArray(data, max_nodes=3)
+    root = lazy.root(0)
+    lazy.child(root, 1, 0)
+    lazy.child(root, 1, 1)
+    lazy.child(root, 1, 1)
+    with pytest.raises(ValueError, match='Too many loop tree nodes'):
+        lazy.child(root, 1, 2)
+
+
+def test_decode_deep_tree():
+    # far deeper than the recursive parser could go
+    depth = 20_000
+    data = bytes.fromhex('020101') * depth + bytes.fromhex('0005')
+    tree, = decode_loop_trees(data, max_nodes=depth + 1, max_depth=depth)
+    for _ in range(depth):
+        assert tree.num_loops() == 1
+        tree, = tree.match(LEAF=None, ROLLED_OUT=None, CARTESIAN=lambda _, children: children)
+    assert tree == LoopTree.LEAF(5)
+
+
+@pytest.mark.parametrize('data, message', [
+    ('01', 'Unexpected end of loop trees'),
+    ('0080', 'Unexpected end of loop trees'),
+    ('020102', 'Unexpected end of loop trees'),
+    ('0300', 'Invalid loop tree kind 3'),
+    ('00' + 'ff' * 10 + '01', 'LEB128 value too large'),
+    ('020101' * 65 + '0000', 'Loop trees nested too deeply'),
+    ('0100ff', 'Unexpected end of loop trees'),
+    ('01ffffffffffffffff7f02', 'Too many loop tree nodes'),
+    ('02008080040000', 'Too many loop tree nodes'),
+    ('00000000' * 40_000, 'Too many loop tree nodes'),
+    # children reserved by the parents count before they are decoded
+    ('0201e8fb03' * 64, 'Too many loop tree nodes'),
+    ('0100' '8080808080' '20', 'Too many loop tree nodes'),
+    ('0200' '8080808080' '20', 'Too many loop tree nodes'),
+])
+def test_decode_errors(data: str, message: str):
+    with pytest.raises(ValueError, match=message):
+        decode_loop_trees(bytes.fromhex(data))
@@ -0,0 +1,73 @@
+import pytest
+from hypothesis import given, strategies as st
+
+from merkle import MerkleCache, merkle_levels, merkle_path, merkle_root, node_hash, leaf_hash
+from tx import MerkleBranch, MerkleSide
+
+
+def _bytecodes(num: int):
+    return [b'contract %d' % idx for idx in range(num)]
+
+
+@given(num_leaves=st.integers(1, 40), data=st.data())
+def test_paths_verify(num_leaves: int, data):
+    bytecodes = _bytecodes(num_leaves)
+    levels = merkle_levels(bytecodes)
+    root = merkle_root(bytecodes)
+    leaf_idx = data.draw(st.integers(0, num_leaves - 1))
+    path = merkle_path(levels, leaf_idx)
+    for cache in [MerkleCache(), MerkleCache(max_entries=0)]:
+        cache.verify(bytecodes[leaf_idx], path, root)
+        with pytest.raises(ValueError, match='Bytecode is not in the merkle tree of the spent output'):
+            cache.verify(b'other', path, root)
+    if path:
+        with pytest.raises(ValueError, match='Bytecode is not in the merkle tree'):
+            MerkleCache().verify(bytecodes[leaf_idx], path[:-1], root)
+
+
+def test_small_tree():
+    a, b, c = _bytecodes(3)
+    assert merkle_root([a]) == leaf_hash(a)
+    assert merkle_root([a, b, c]) == node_hash(node_hash(leaf_hash(a), leaf_hash(b)), leaf_hash(c))
+    levels = merkle_levels([a, b, c])
+    assert merkle_path(levels, 1) == [MerkleBranch(MerkleSide.LEFT, leaf_hash(a)),
+                                      MerkleBranch(MerkleSide.RIGHT, leaf_hash(c))]
+    # c is carried up, it only has a branch on the level of the root
+    assert merkle_path(levels, 2) == [MerkleBranch(MerkleSide.LEFT, node_hash(leaf_hash(a), leaf_hash(b)))]
+    with pytest.raises(ValueError, match='Merkle tree without bytecode'):
+        merkle_root([])
+
+
+def test_cache_stops_at_verified_nodes():
+    bytecodes = _bytecodes(16)
+    levels = merkle_levels(bytecodes)
+    root = levels[-1][0]
+    cache = MerkleCache()
+    cache.verify(bytecodes[0], merkle_path(levels, 0), root)
+    assert cache.stats() == (0, 1, 0, 4)
+    # the path of leaf 1 joins the one of leaf 0 right above the leaves, the same leaf is known already
+    cache.verify(bytecodes[1], merkle_path(levels, 1), root)
+    cache.verify(bytecodes[0], merkle_path(levels, 0), root)
+    assert cache.stats() == (2, 1, 0, 5)
+    # a wrong branch hash can't reach a verified node
+    path = merkle_path(levels, 2)
+    path[0] = MerkleBranch(MerkleSide.RIGHT, bytes(32))
+    with pytest.raises(ValueError):
+        cache.verify(bytecodes[2], path, root)
+    # nor is anything remembered for another root
+    with pytest.raises(ValueError):
+        cache.verify(bytecodes[1], merkle_path(levels, 1), bytes(32))
+    assert len(cache) == 5
+
+
+def test_cache_is_bounded():
+    bytecodes = _bytecodes(64)
+    levels = merkle_levels(bytecodes)
+    cache = MerkleCache(max_entries=10)
+    for idx in range(64):
+        cache.verify(bytecodes[idx], merkle_path(levels, idx), levels[-1][0])
+    stats = cache.stats()
+    assert stats.entries == 10
+    assert stats.evictions > 0
+    cache.clear()
+    assert len(cache) == 0
@@ -1,16 +1,29 @@
+from typing import Union
+
 import pytest
 
-from belt import BeltNum, DataType, Integer, Belt
+from belt import BeltNum, BeltSlice, DataType, Integer, Belt
 from loop_stack import LoopStack
 from loop_tree import LoopTree
-from op import Block
+from op import Block, Engine, Instruction
 from ops.arith import InsArith, ArithMode, InsRel
 from ops.flow import InsLoopSpecified, InsBrIf
-from ops.misc import InsConst, InsLocalSet, InsLocalGet
-from vm import VM
+from ops.misc import InsConst, InsLocalSet, InsLocalGet, InsRam, InsSliceCopy, InsSliceFill, InsSliceFind, \
+    InsSliceRel
+from hooks import OpcodeCountHook
+from vm import VM, CostLimitExceeded
+
+
+def _run(ins: Union[Instruction, Block], vm: VM, engine: Engine) -> None:
+    if engine == Engine.REFERENCE:
+        ins.run(vm)
+    else:
+        block = ins if isinstance(ins, Block) else Block([ins])
+        block.runner(engine)(vm)
 
 
-def test_simple_loop():
+@pytest.mark.parametrize('engine', list(Engine))
+def test_simple_loop(engine: Engine):
     vm = VM(
         LoopStack([
             LoopTree.LEAF(8),
@@ -21,12 +34,13 @@ def test_simple_loop():
     ins = InsLoopSpecified(Block([
         InsArith([0], False, ArithMode.CHECKED, lambda n: n + 1),
     ]))
-    ins.run(vm)
+    _run(ins, vm, engine)
     result = vm.belt().get_num(0).value.expect_int()
     assert result == 8
 
 
-def test_fib_loop():
+@pytest.mark.parametrize('engine', list(Engine))
+def test_fib_loop(engine: Engine):
     vm = VM(
         LoopStack([
             LoopTree.LEAF(16),
@@ -40,12 +54,13 @@ def test_fib_loop():
             InsArith([0, 1], False, ArithMode.CHECKED, int.__add__),
         ])),
     ])
-    ins.run(vm)
+    _run(ins, vm, engine)
     belt = [vm.belt().get_num(i).value.expect_int() for i in range(Belt.SIZE)]
     assert belt == [1597, 987, 610, 377, 233, 144, 89, 55, 34, 21, 13, 8, 5, 3, 2, 1]
 
 
-def test_nested_loop():
+@pytest.mark.parametrize('engine', list(Engine))
+def test_nested_loop(engine: Engine):
     vm = VM(
         LoopStack([
             LoopTree.CARTESIAN(3, [
@@ -65,12 +80,13 @@ def test_nested_loop():
         ])),
         InsArith([0], True, ArithMode.CHECKED, lambda n: n * 2),
     ]))
-    ins.run(vm)
+    _run(ins, vm, engine)
     result = vm.belt().get_num(0).value.expect_int()
     assert result == 28
 
 
-def test_simple_loop_break():
+@pytest.mark.parametrize('engine', list(Engine))
+def test_simple_loop_break(engine: Engine):
     vm = VM(
         LoopStack([
             LoopTree.LEAF(8),
@@ -84,7 +100,7 @@ def test_simple_loop_break():
         InsConst(BeltNum(DataType.I8, Integer(3))),
         InsRel(a_idx=0, b_idx=1, is_signed=False, op=lambda a, b: a < b),
     ]))
-    ins.run(vm)
+    _run(ins, vm, engine)
     belt = [vm.belt().get_num(i).value.expect_int() for i in range(Belt.SIZE)]
     assert belt == [1, 3, 4,
                     0, 3, 3,
@@ -93,7 +109,8 @@ def test_simple_loop_break():
                     0, 0, 0, 0]
 
 
-def test_two_simple_loops_break():
+@pytest.mark.parametrize('engine', list(Engine))
+def test_two_simple_loops_break(engine: Engine):
     vm = VM(
         LoopStack([
             LoopTree.LEAF(16),
@@ -120,7 +137,7 @@ def test_two_simple_loops_break():
             InsLocalGet(0),
         ])),
     ])
-    ins.run(vm)
+    _run(ins, vm, engine)
     belt = [vm.belt().get_num(i).value.expect_int() for i in range(Belt.SIZE)]
     assert belt == [1, 7, 8, 7,
                     0, 7, 7, 6,
@@ -129,7 +146,8 @@ def test_two_simple_loops_break():
     assert vm.local(0).value.expect_int() == 8
 
 
-def test_nested_loop_break():
+@pytest.mark.parametrize('engine', list(Engine))
+def test_nested_loop_break(engine: Engine):
     vm = VM(
         LoopStack([
             LoopTree.CARTESIAN(3, [
@@ -164,7 +182,7 @@ def test_nested_loop_break():
             InsArith([0], True, ArithMode.CHECKED, lambda n: n + 2),
         ])),
     ])
-    ins.run(vm)
+    _run(ins, vm, engine)
     belt = [vm.belt().get_num(i).value.expect_int() for i in range(Belt.SIZE)]
     assert belt == [15, 13,  # 2 times  +2
                     11,  # local get
@@ -173,3 +191,79 @@ def test_nested_loop_break():
                     9, 10, 11,  # decrementing loop
                     12,  # *2
                     6, 0]  # local get, rel
+
+
+def _metered_loop(num_loops: int, budget: int) -> VM:
+    vm = VM(LoopStack([LoopTree.LEAF(num_loops)]), num_locals=0, ram_size=0, budget=budget)
+    # 2 + 8 * (1 iteration + 1 instruction)
+    Block([
+        InsConst(BeltNum(DataType.I8, Integer(0))),
+        InsLoopSpecified(Block([
+            InsArith([0], False, ArithMode.CHECKED, lambda n: n + 1),
+        ])),
+    ]).run(vm)
+    return vm
+
+
+def test_metered_cost():
+    assert _metered_loop(8, budget=18).cost() == 18
+    assert _metered_loop(0, budget=18).cost() == 2
+    unmetered = VM(LoopStack([LoopTree.LEAF(8)]), num_locals=0, ram_size=0)
+    InsLoopSpecified(Block([])).run(unmetered)
+    assert unmetered.cost() == 0
+    unlimited = VM(LoopStack([LoopTree.LEAF(8)]), num_locals=0, ram_size=0, metered=True)
+    InsLoopSpecified(Block([])).run(unlimited)
+    assert unlimited.cost() == 8
+    with pytest.raises(CostLimitExceeded, match='Execution cost exceeds the budget of 17'):
+        _metered_loop(8, budget=17)
+
+
+def test_metered_empty_loop():
+    vm = VM(LoopStack([LoopTree.LEAF(1 << 60)]), num_locals=0, ram_size=0, budget=1000)
+    with pytest.raises(CostLimitExceeded):
+        InsLoopSpecified(Block([])).run(vm)
+    assert vm.cost() == 1001
+
+
+def test_metered_hooked():
+    vm = VM(LoopStack([LoopTree.LEAF(8)]), num_locals=0, ram_size=0, hook=OpcodeCountHook(), budget=100)
+    Block([
+        InsConst(BeltNum(DataType.I8, Integer(0))),
+        InsLoopSpecified(Block([
+            InsArith([0], False, ArithMode.CHECKED, lambda n: n + 1),
+        ])),
+    ]).run(vm)
+    assert vm.cost() == _metered_loop(8, budget=100).cost()
+
+
+def test_metered_ram_and_locals():
+    assert VM(LoopStack([]), num_locals=0, ram_size=65, budget=2).cost() == 2
+    with pytest.raises(CostLimitExceeded):
+        VM(LoopStack([]), num_locals=0, ram_size=1 << 40, budget=1000)
+    # 8 bytes per local
+    assert VM(LoopStack([]), num_locals=9, ram_size=0, budget=2).cost() == 2
+    with pytest.raises(CostLimitExceeded):
+        VM(LoopStack([]), num_locals=1 << 40, ram_size=0, budget=1000)
+
+
+@pytest.mark.parametrize('ins, num_bytes', [
+    # run after pushing ram and a constant byte
+    (InsSliceFill(1, 0), 1 << 14),
+    (InsSliceCopy(1, 1), 1 << 14),
+    (InsSliceRel(1, 1, BeltSlice.equals), 2 << 14),
+    (InsSliceFind(1, 0), 1 << 14),
+])
+def test_metered_bulk_ops(ins: Instruction, num_bytes: int):
+    program = Block([
+        InsLoopSpecified(Block([InsRam(), InsConst(BeltNum(DataType.I8, Integer(7))), ins])),
+    ])
+    ram_size = 1 << 14
+    vm = VM(LoopStack([LoopTree.LEAF(3)]), num_locals=0, ram_size=ram_size, metered=True)
+    program.run(vm)
+    # RAM, the loop and 3 iterations of the pushes, the op and its bytes
+    assert vm.cost() == ram_size // 64 + 1 + 3 * (1 + 3 + num_bytes // 64)
+    # a long loop over a large slice is cut off by the budget, like the loop itself
+    vm = VM(LoopStack([LoopTree.LEAF(1 << 40)]), num_locals=0, ram_size=ram_size, budget=100_000)
+    with pytest.raises(CostLimitExceeded):
+        program.run(vm)
+    assert vm.cost() <= 100_000 + 1 + num_bytes // 64
@@ -0,0 +1,74 @@
+import pytest
+from hypothesis import given, settings, strategies as st
+
+from belt import BeltNum, DataType
+from loop_stack import LoopStack
+from op import Block, Engine, Instruction
+from ops.arith import InsArith, ArithMode, InsRel, InsNAryOp, divmod_op
+from ops.binary import CHECKED, COMPARE, WIDENING, DIVMOD
+from vm import VM
+
+
+def _generic(cls: type, is_signed: bool) -> Instruction:
+    op = cls.op
+    if cls in CHECKED.values():
+        return InsArith([0, 1], is_signed, ArithMode.CHECKED, op)
+    elif cls in COMPARE.values():
+        return InsRel(0, 1, is_signed, op)
+    elif cls in WIDENING.values():
+        return InsArith([0, 1], is_signed, ArithMode.WIDENING, op)
+    else:
+        return InsNAryOp([0, 1], is_signed, divmod_op)
+
+
+SPECIALIZED = [
+    (cls, is_signed)
+    for table in (CHECKED, COMPARE, WIDENING) for (_, is_signed), cls in table.items()
+] + [(cls, is_signed) for is_signed, cls in DIVMOD.items()]
+
+
+def _run(ins: Instruction, engine: Engine, a: BeltNum, b: BeltNum):
+    vm = VM(LoopStack([]), num_locals=0, ram_size=0)
+    vm.belt().push(b)
+    vm.belt().push(a)
+    try:
+        if engine == Engine.REFERENCE:
+            ins.run(vm)
+        else:
+            Block([ins]).runner(engine)(vm)
+    except Exception as ex:
+        return type(ex), str(ex)
+    return vm.belt().items()
+
+
+@st.composite
+def belt_nums(draw, data_type: DataType):
+    bits = data_type.value
+    special = st.sampled_from([0, 1, (1 << bits) - 1, 1 << (bits - 1), (1 << (bits - 1)) - 1])
+    return BeltNum.of(data_type, draw(st.none() | special | st.integers(0, (1 << bits) - 1)))
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('cls, is_signed', SPECIALIZED, ids=lambda param: getattr(param, '__name__', str(param)))
+@settings(max_examples=25, deadline=None)
+@given(data=st.data())
+def test_matches_generic(engine: Engine, cls: type, is_signed: bool, data):
+    a_type, b_type = data.draw(st.sampled_from(list(DataType))), data.draw(st.sampled_from(list(DataType)))
+    a, b = data.draw(belt_nums(a_type)), data.draw(belt_nums(b_type))
+    if cls.op in (int.__lshift__, int.__rshift__) and b.int_value is not None:
+        # huge shift amounts only make huge ints, keep them small
+        b = BeltNum.of(b_type, b.int_value % 200)
+    assert cls.is_signed == is_signed
+    assert _run(cls(0, 1), engine, a, b) == _run(_generic(cls, is_signed), engine, a, b)
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('is_signed', [False, True])
+@pytest.mark.parametrize('generic', [False, True])
+def test_shl_out_of_range(engine: Engine, is_signed: bool, generic: bool):
+    cls = CHECKED[int.__lshift__, is_signed]
+    ins = _generic(cls, is_signed) if generic else cls(0, 1)
+    huge = BeltNum.of(DataType.I64, 1 << 40)
+    # a shift this large would need a 2**40-bit int
+    assert _run(ins, engine, BeltNum.of(DataType.I64, 1), huge)[0] == DataType.I64.err_num
+    assert _run(ins, engine, BeltNum.of(DataType.I64, 0), huge)[0] == BeltNum.of(DataType.I64, 0)
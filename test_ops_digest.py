@@ -0,0 +1,111 @@
+import hashlib
+
+import pytest
+from hypothesis import given, settings, strategies as st
+
+from belt import BeltNum, BeltSlice, DataType
+from loop_stack import LoopStack
+from op import Block, Engine
+from ops.digest import HASHES, InsDigest, InsHashFinal, InsHashInit, InsHashUpdate, Ripemd160, ripemd160, sha256
+from vm import VM
+
+NATIVE = {sha256: 'sha256', ripemd160: 'ripemd160'}
+
+
+def _vm(ram_size: int) -> VM:
+    return VM(LoopStack([]), num_locals=0, ram_size=ram_size)
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('hash', HASHES, ids=lambda hash: hash.__name__)
+@settings(max_examples=20, deadline=None)
+@given(data=st.binary(max_size=300))
+def test_digest(engine: Engine, hash, data: bytes):
+    vm = _vm(ram_size=40)
+    vm.belt().push(BeltSlice.over(data))
+    vm.belt().push(vm.ram())
+    Block([InsDigest(0, 1, hash)]).runner(engine)(vm)
+    digest = hashlib.new(NATIVE[hash], data).digest()
+    assert bytes(vm.ram().data) == digest + bytes(40 - len(digest))
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('hash', HASHES, ids=lambda hash: hash.__name__)
+@settings(max_examples=20, deadline=None)
+@given(data=st.binary(max_size=300), cuts=st.lists(st.integers(0, 300), max_size=4))
+def test_incremental(engine: Engine, hash, data: bytes, cuts):
+    vm = _vm(ram_size=32)
+    Block([InsHashInit(hash)]).runner(engine)(vm)
+    handle = vm.belt().get_num(0)
+    assert handle.data_type is DataType.I32
+    bounds = [0] + sorted(min(cut, len(data)) for cut in cuts) + [len(data)]
+    for num_chunks, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        vm.belt().push(BeltSlice(memoryview(data), start, end - start))
+        # the handle is behind the chunks pushed so far
+        Block([InsHashUpdate(num_chunks + 1, 0)]).runner(engine)(vm)
+    vm.belt().push(vm.ram())
+    Block([InsHashFinal(len(bounds), 0)]).runner(engine)(vm)
+    digest = hashlib.new(NATIVE[hash], data).digest()
+    assert bytes(vm.ram().data)[:len(digest)] == digest
+    # final closes the hash
+    vm.belt().push(handle)
+    with pytest.raises(ValueError, match='Invalid hash handle'):
+        Block([InsHashUpdate(0, 1)]).runner(engine)(vm)
+
+
+@pytest.mark.parametrize('ins, message', [
+    (InsDigest(0, 0, sha256), 'Cannot store in write-only slice'),
+    (InsDigest(1, 0, sha256), 'Tried writing value out of bounds'),
+    (InsDigest(2, 0, ripemd160), 'Expected slice, got num'),
+    (InsHashUpdate(2, 0), 'Invalid hash handle'),
+    (InsHashFinal(0, 1), 'Expected num, got slice'),
+])
+def test_errors(ins, message: str):
+    vm = _vm(ram_size=16)
+    vm.belt().push(BeltNum.of(DataType.I32, 5))
+    vm.belt().push(vm.ram())
+    vm.belt().push(BeltSlice.over(b'read only'))
+    with pytest.raises(ValueError, match=message):
+        ins.run(vm)
+
+
+def test_digest_cost():
+    vm = VM(LoopStack([]), num_locals=0, ram_size=32, budget=100)
+    vm.belt().push(BeltSlice.over(bytes(129)))
+    vm.belt().push(vm.ram())
+    Block([InsDigest(0, 1, sha256)]).run(vm)
+    # RAM, instruction and 3 blocks
+    assert vm.cost() == 1 + 1 + 3
+
+
+def test_ripemd160_fallback_cost():
+    vm = VM(LoopStack([]), num_locals=0, ram_size=32, metered=True)
+    vm.belt().push(BeltSlice.over(bytes(128)))
+    vm.belt().push(vm.ram())
+    Block([InsDigest(0, 1, Ripemd160), InsHashInit(Ripemd160), InsHashUpdate(0, 2), InsHashFinal(0, 1)]).run(vm)
+    # RAM, 4 instructions, 2 blocks of data and 2 of padding per digest
+    assert vm.cost() == 1 + 4 + 2 * (2 + 2) * Ripemd160.COST_FACTOR
+
+
+def test_open_hashes_limit():
+    vm = _vm(ram_size=32)
+    for _ in range(VM.MAX_OPEN_HASHES):
+        InsHashInit(sha256).run(vm)
+    with pytest.raises(ValueError, match='Too many open hashes'):
+        InsHashInit(sha256).run(vm)
+    vm.belt().push(vm.ram())
+    InsHashFinal(1, 0).run(vm)
+    InsHashInit(sha256).run(vm)
+    # handles aren't reused
+    assert vm.belt().get_num(0).int_value == VM.MAX_OPEN_HASHES
+
+
+@settings(max_examples=50, deadline=None)
+@given(data=st.binary(max_size=300), cut=st.integers(0, 300))
+def test_ripemd160_fallback(data: bytes, cut: int):
+    state = Ripemd160(data[:cut])
+    copy = state.copy()
+    state.update(data[cut:])
+    assert state.digest() == hashlib.new('ripemd160', data).digest()
+    assert copy.digest() == hashlib.new('ripemd160', data[:cut]).digest()
+    assert Ripemd160(b'abc').hexdigest() == '8eb208f7e05d987a9b044a8e98c6b087f15a0bfc'
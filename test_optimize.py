@@ -0,0 +1,193 @@
+import pytest
+from hypothesis import given, settings, strategies as st
+
+import programs
+from belt import BeltNum, DataType
+from lang.parse import Compiler, CompileResult
+from loop_stack import LoopStack
+from loop_tree import LoopTree
+from op import Block, Engine
+from ops.arith import InsArith, ArithMode, InsConvert, InsNAryOp, InsRel, divmod_op, cast_wrap
+from ops.binary import CHECKED, COMPARE, WIDENING, DIVMOD
+from ops.flow import InsIfUnspecified, InsLoopSpecified, InsBr
+from ops.misc import InsConst, InsLocalSet
+from optimize import optimize
+from vm import VM
+
+# x is read from a local so it isn't constant; `unused` can be removed, later reads of x are rewritten
+REWRITE = """
+    version 0.0.1;
+    seed = 3u8;
+    $x = seed;
+    x = $x;
+    unused = 2u8;
+    y = x + x;
+    $y = y;
+    if y {
+        z = y * x;
+    } else {
+        z = y + x;
+    }
+    $z = z;
+    loop l {
+        z = z + z;
+        $z = z;
+    }
+"""
+
+# the first iteration reads x, which is older than `unused`, but later ones read the x pushed by the loop, so no
+# index is right for both when `unused` goes
+LOOP_READS_OLDER = """
+    version 0.0.1;
+    seed = 3u8;
+    $x = seed;
+    x = $x;
+    unused = 2u8;
+    loop l {
+        x = x + x;
+        u = 1u8;
+    }
+"""
+
+# the loop pushes nothing, so the read of x, older than `unused`, is rewritten the same for every iteration
+LOOP_PUSHES_NOTHING = """
+    version 0.0.1;
+    seed = 3u8;
+    $x = seed;
+    x = $x;
+    unused = 2u8;
+    loop l {
+        verify_ok(x);
+    }
+"""
+
+CONSTANT_IF = """
+    version 0.0.1;
+    seed = 5u16;
+    $x = seed;
+    x = $x;
+    c = 1i8;
+    d = c + c;
+    if d {
+        y = x * x;
+        $y = y;
+    } else {
+        y = x + x;
+        $y = y;
+    }
+"""
+
+SOURCES = programs.ALL + [REWRITE, LOOP_READS_OLDER, LOOP_PUSHES_NOTHING, CONSTANT_IF]
+
+
+def _outcome(result: CompileResult, loop_trees, engine: Engine):
+    vm = VM(LoopStack(list(loop_trees)), num_locals=result.num_locals, ram_size=0)
+    try:
+        Block(result.instructions).runner(engine)(vm)
+        error = None
+    except Exception as ex:
+        error = type(ex), str(ex)
+    return error, [vm.local(idx) for idx in range(result.num_locals)]
+
+
+def _count(instructions) -> int:
+    return sum(1 + sum(_count(block.instructions()) for block in ins.payload() if isinstance(block, Block))
+               for ins in instructions)
+
+
+@pytest.mark.parametrize('engine', list(Engine))
+@pytest.mark.parametrize('src', SOURCES)
+@pytest.mark.parametrize('loop_trees', [
+    [LoopTree.LEAF(0)], [LoopTree.LEAF(1)], [LoopTree.LEAF(3)], [LoopTree.LEAF(30)],
+    [LoopTree.CARTESIAN(2, [LoopTree.LEAF(9)])], [LoopTree.CARTESIAN(4, [LoopTree.LEAF(30)])],
+])
+def test_same_outcome(engine: Engine, src: str, loop_trees):
+    result = Compiler().compile(src)
+    assert _outcome(optimize(result), loop_trees, engine) == _outcome(result, loop_trees, engine)
+
+
+def test_folds_constant_program():
+    assert optimize(Compiler().compile(programs.IF_ELSE)).instructions == []
+
+
+def test_removes_unread_pushes():
+    result = Compiler().compile(REWRITE)
+    optimized = optimize(result)
+    # only `unused` goes, `seed` is read by $x = seed
+    assert _count(optimized.instructions) == _count(result.instructions) - 1
+    assert [type(ins) for ins in optimized.instructions[:3]] == [InsConst, InsLocalSet, type(result.instructions[2])]
+
+
+def test_keeps_pushes_older_items_depend_on():
+    result = Compiler().compile(LOOP_READS_OLDER)
+    assert _count(optimize(result).instructions) == _count(result.instructions)
+    result = Compiler().compile(LOOP_PUSHES_NOTHING)
+    assert _count(optimize(result).instructions) == _count(result.instructions) - 1
+
+
+def test_resolves_constant_if():
+    optimized = optimize(Compiler().compile(CONSTANT_IF)).instructions
+    assert not any(isinstance(ins, InsIfUnspecified) for ins in optimized)
+    assert type(optimized[-2]) is CHECKED[int.__mul__, False]
+
+
+def test_keeps_if_that_breaks():
+    loop = InsLoopSpecified(Block([
+        InsConst(BeltNum.of(DataType.I8, 1)),
+        InsIfUnspecified(0, Block([InsBr(2)]), Block([InsConst(BeltNum.of(DataType.I8, 2)), InsLocalSet(0)])),
+    ]))
+    optimized, = optimize(CompileResult([loop], 1)).instructions
+    body = optimized.payload()[0].instructions()
+    assert isinstance(body[1], InsIfUnspecified)
+    assert body[1].payload()[2].instructions() == ()
+
+
+def _generic(ins_type: type, is_signed: bool):
+    if ins_type in CHECKED.values():
+        return InsArith([0, 1], is_signed, ArithMode.CHECKED, ins_type.op)
+    elif ins_type in COMPARE.values():
+        return InsRel(0, 1, is_signed, ins_type.op)
+    elif ins_type in WIDENING.values():
+        return InsArith([0, 1], is_signed, ArithMode.WIDENING, ins_type.op)
+    return InsNAryOp([0, 1], is_signed, divmod_op)
+
+
+BINARY = [(ins_type, is_signed) for table in (CHECKED, COMPARE, WIDENING)
+          for (_, is_signed), ins_type in table.items()] + [(ins_type, is_signed) for is_signed, ins_type in DIVMOD.items()]
+
+
+@st.composite
+def belt_nums(draw):
+    data_type = draw(st.sampled_from(list(DataType)))
+    bits = data_type.value
+    special = st.sampled_from([0, 1, 2, (1 << bits) - 1, 1 << (bits - 1), (1 << (bits - 1)) - 1])
+    return BeltNum.of(data_type, draw(st.none() | special | st.integers(0, (1 << bits) - 1)))
+
+
+@pytest.mark.parametrize('ins_type, is_signed', BINARY, ids=lambda param: getattr(param, '__name__', str(param)))
+@settings(max_examples=25, deadline=None)
+@given(a=belt_nums(), b=belt_nums(), generic=st.booleans())
+def test_folding_is_exact(ins_type: type, is_signed: bool, a: BeltNum, b: BeltNum, generic: bool):
+    if ins_type.op in (int.__lshift__, int.__rshift__) and b.int_value is not None:
+        b = BeltNum.of(b.data_type, b.int_value % 70)
+    ins = _generic(ins_type, is_signed) if generic else ins_type(0, 1)
+    result = CompileResult([InsConst(b), InsConst(a), ins, InsLocalSet(0)], 1)
+    optimized = optimize(result)
+    outcome = _outcome(result, [], Engine.REFERENCE)
+    assert _outcome(optimized, [], Engine.REFERENCE) == outcome
+    if outcome[0] is None:
+        assert all(isinstance(ins, (InsConst, InsLocalSet)) for ins in optimized.instructions)
+
+
+def test_folds_shl_out_of_range():
+    shl = CHECKED[int.__lshift__, False](0, 1)
+    huge, one = BeltNum.of(DataType.I64, 1 << 40), BeltNum.of(DataType.I64, 1)
+    optimized = optimize(CompileResult([InsConst(huge), InsConst(one), shl, InsLocalSet(0)], 1)).instructions
+    assert optimized[0].payload() == (DataType.I64.err_num,)
+
+
+@given(num=belt_nums(), data_type=st.sampled_from(list(DataType)), is_signed=st.booleans(),
+       op=st.sampled_from([BeltNum.extend, cast_wrap, BeltNum.cast_sat, BeltNum.cast_checked]))
+def test_folding_conversions(num: BeltNum, data_type: DataType, is_signed: bool, op):
+    result = CompileResult([InsConst(num), InsConvert(0, data_type, is_signed, op), InsLocalSet(0)], 1)
+    assert _outcome(optimize(result), [], Engine.REFERENCE) == _outcome(result, [], Engine.REFERENCE)
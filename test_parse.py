@@ -0,0 +1,127 @@
+import hashlib
+import re
+
+import pytest
+from lark import Lark
+
+import programs
+from belt import DataType
+from bytecode import encode
+from lang.parse import Compiler, grammar, parser
+from loop_stack import LoopStack
+from op import Block
+from vm import VM
+
+
+SYNTAX = """
+    version 0.0.1;
+    x = s[0] as u8;
+    s[4] = x;
+    y = s[a..b];
+    z = s[..b];
+    w = s[a..];
+    a, b = c _+_ d;
+    f();
+    g(a,);
+    g(a, b);
+    x = 1i8;
+    y = -2_000u64;
+    x1i8 = a + b;
+    $l = x;
+    y = $l;
+    loop outer {
+        if c { br(outer); } else { nop(); }
+    }
+"""
+
+
+@pytest.mark.parametrize("src", programs.ALL + [programs.SLICES, programs.HASHES, SYNTAX])
+def test_lalr_matches_earley(src: str):
+    assert parser.parse(src) == Lark(grammar).parse(src)
+
+
+def test_compiler_is_reusable():
+    compiler = Compiler()
+    expected = [encode(Compiler().compile(src)) for src in programs.ALL]
+    for _ in range(3):
+        assert [encode(compiler.compile(src)) for src in programs.ALL] == expected
+
+
+def test_compiler_resets_after_error():
+    compiler = Compiler()
+    with pytest.raises(ValueError):
+        compiler.compile("version 0.0.1; a = 1i8; $a = a; b = c + a;")
+    assert encode(compiler.compile(programs.FIB)) == encode(Compiler().compile(programs.FIB))
+
+
+def test_infers_data_types():
+    compiler = Compiler()
+    compiler.compile(programs.IF_ELSE)
+    assert (compiler._belt[0].name, compiler._belt[0].data_type) == ('x', DataType.I32)
+    compiler.compile(programs.FIB)
+    assert [(item.name, item.data_type) for item in compiler._belt[:6]] == [
+        ('hi', DataType.I64), ('lo', DataType.I64), ('e', DataType.I8), ('w', DataType.I8), ('q', DataType.I64),
+        ('r', DataType.I64),
+    ]
+
+
+def test_skips_no_op_conversions():
+    instructions = Compiler().compile("version 0.0.1; a = 3u8; b = cast_wrap8(a); c = cast_sat8(b); d = a + c;")
+    assert len(instructions.instructions) == 2
+    assert instructions.instructions[1].payload() == (0, 0)
+    # an older b in front of a would shadow the alias, so the conversion is kept
+    instructions = Compiler().compile("version 0.0.1; a = 3u8; b = 1u8; b = cast_wrap8(a); c = b + b;")
+    assert len(instructions.instructions) == 4
+
+
+@pytest.mark.parametrize("src, message", [
+    ("a = 1u8; b = cast_wrap16(a);", 'Cannot use cast_wrap16 on a of type u8'),
+    ("a = 1i32; b = cast_extend16(a);", 'Cannot use cast_extend16 on a of type i32'),
+    ("x = 1u8; loop l { x = cast_extend16(x); }", 'loop variable x changes its type from u8 to u16'),
+    ("a = 1u8; $l = a; b = 1u16; $l = b;", 'Cannot assign b of type u16 to local $l of type u8'),
+])
+def test_type_errors(src: str, message: str):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        Compiler().compile(f"version 0.0.1; {src}")
+
+
+def test_slice_calls():
+    result = Compiler().compile(programs.SLICES)
+    vm = VM(LoopStack([]), result.num_locals, ram_size=64)
+    Block(result.instructions).run(vm)
+    at, _, order, same = vm.belt().items()[:4]
+    assert (at.int_value, order.to_signed(True), same.int_value) == (4, -1, 1)
+    hash_bytes = bytes([171] * 4 + [0] * 4 + [171] * 24)
+    assert bytes(vm.ram().data) == hash_bytes * 2
+
+
+@pytest.mark.parametrize("src, message", [
+    ("r = ram(); x = 1u32; fill(r, x);", 'fill takes an 8 bit number, got x of type u32'),
+    ("r = ram(); x = 1i16; i = find(r, x);", 'find takes an 8 bit number, got x of type i16'),
+    ("r = ram(); x = 1u8; c = compare(r, x);", 'Invalid type: x is a number'),
+    ("r = ram(); x = 1u8; copy(x, r);", 'Invalid type: x is a number'),
+])
+def test_slice_call_errors(src: str, message: str):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        Compiler().compile('version 0.0.1; ' + src)
+
+
+def test_hash_calls():
+    result = Compiler().compile(programs.HASHES)
+    vm = VM(LoopStack([]), result.num_locals, ram_size=128)
+    Block(result.instructions).run(vm)
+    assert vm.belt()[0].int_value == 1
+    digest = hashlib.sha256(b'a' * 64).digest()
+    assert bytes(vm.ram().data) == b'a' * 64 + digest * 2
+
+
+@pytest.mark.parametrize("src, message", [
+    ("r = ram(); x = 1u32; sha256(r, x);", 'Invalid type: x is a number'),
+    ("r = ram(); ripemd160(r);", 'ripemd160 takes exactly 2 arguments'),
+    ("r = ram(); h = 1u16; hash_update(h, r);", 'hash_update takes a hash handle, got h of type u16'),
+    ("r = ram(); h = sha256_init(); hash_final(r, h);", 'Invalid type: r is a slice'),
+    ("h = sha256_init(h);", 'sha256_init takes no arguments'),
+])
+def test_hash_call_errors(src: str, message: str):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        Compiler().compile('version 0.0.1; ' + src)
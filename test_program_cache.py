@@ -0,0 +1,64 @@
+import programs
+from bytecode import encode, decode
+from lang.parse import Compiler
+from loop_stack import LoopStack
+from loop_tree import LoopTree
+from program_cache import ProgramCache
+from vm import VM
+
+
+def _binaries():
+    return [encode(Compiler().compile(src)) for src in programs.ALL]
+
+
+def test_hit_and_miss():
+    cache = ProgramCache()
+    binary, *_ = _binaries()
+    program = cache.get(binary, decode)
+    assert cache.get(bytes(binary), decode) is program
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.evictions, stats.entries, stats.size_bytes) == (1, 1, 0, 1, len(binary))
+
+
+def test_evict_by_entries():
+    cache = ProgramCache(max_entries=2)
+    a, b, c = _binaries()
+    cache.get(a, decode)
+    cache.get(b, decode)
+    cache.get(a, decode)
+    cache.get(c, decode)  # evicts b, the least recently used
+    assert cache.stats().evictions == 1
+    cache.get(a, decode)
+    cache.get(c, decode)
+    assert cache.stats().misses == 3
+    cache.get(b, decode)
+    assert cache.stats().misses == 4
+    assert len(cache) == 2
+
+
+def test_evict_by_bytes():
+    a, b, c = _binaries()
+    cache = ProgramCache(max_entries=None, max_bytes=len(b) + len(c))
+    cache.get(a, decode)
+    cache.get(b, decode)
+    cache.get(c, decode)
+    stats = cache.stats()
+    assert stats.size_bytes <= len(b) + len(c)
+    assert stats.evictions >= 1
+    too_large = ProgramCache(max_entries=None, max_bytes=len(a) - 1)
+    too_large.get(a, decode)
+    assert len(too_large) == 0
+
+
+def test_shared_program_is_reusable():
+    cache = ProgramCache()
+    binary = encode(Compiler().compile(programs.FIB))
+    program = cache.get(binary, decode)
+    assert isinstance(program.compile_result.instructions, tuple)
+    belts = []
+    for _ in range(2):
+        vm = VM(LoopStack([LoopTree.LEAF(20)]), program.compile_result.num_locals, ram_size=0)
+        program.block.run(vm)
+        belts.append([item.int_value for item in vm.belt().items()])
+    assert belts[0] == belts[1]
+    assert encode(program.compile_result) == binary
@@ -0,0 +1,113 @@
+import pytest
+from hypothesis import given, strategies as st
+
+from tx import Constraint, ConstraintType, Input, MerkleBranch, MerkleSide, Outpoint, Output, Signature, Tx, \
+    UnlockData
+from tx_encoding import HASH_SIZE, decode_tx, encode_tx
+from verify import _check_amounts
+
+uints = st.integers(0, (1 << 64) - 1)
+hashes = st.binary(min_size=HASH_SIZE, max_size=HASH_SIZE)
+data = st.binary(max_size=40)
+outpoints = st.builds(Outpoint, hashes, uints, uints,
+                      st.lists(st.builds(Constraint, st.sampled_from(list(ConstraintType)), data), max_size=3), data)
+inputs = st.builds(Input, st.lists(outpoints, max_size=3),
+                   st.lists(st.builds(MerkleBranch, st.sampled_from(list(MerkleSide)), hashes), max_size=3), data)
+txs = st.builds(
+    Tx,
+    st.lists(inputs, max_size=4),
+    st.lists(st.builds(Output, uints, hashes), max_size=4),
+    st.lists(data, max_size=3),
+    st.lists(st.builds(UnlockData, st.lists(data, max_size=3), data, uints), max_size=4),
+    st.lists(st.builds(Signature, uints, uints, data), max_size=3),
+)
+
+
+def _tx(num_inputs: int = 1) -> Tx:
+    return Tx(
+        inputs=[Input([Outpoint(bytes(32), 0, 1000, [], b'carry')], [MerkleBranch(MerkleSide.LEFT, bytes(32))],
+                      b'bytecode')] * num_inputs,
+        outputs=[Output(900, bytes(32))],
+        preambles=[b'preamble'],
+        unlock_data=[UnlockData([b'data'], bytes.fromhex('000a'), 16)] * num_inputs,
+        signatures=[Signature(1, 2, b'sig')],
+    )
+
+
+@given(tx=txs)
+def test_round_trip(tx: Tx):
+    encoded = encode_tx(tx)
+    view = decode_tx(encoded)
+    assert view.to_tx() == tx
+    assert encode_tx(view) == encoded
+
+
+def test_fields_are_views_of_the_buffer():
+    encoded = encode_tx(_tx())
+    view = decode_tx(encoded)
+    tx_input = view.inputs[0]
+    for field in [tx_input.bytecode, tx_input.outpoints[0].carryover, tx_input.bytecode_merkle_path[0].branch_hash,
+                  view.preambles[0], view.unlock_data[0].loop_trees]:
+        assert isinstance(field, memoryview) and field.obj is encoded
+    assert bytes(tx_input.bytecode) == b'bytecode'
+
+
+def test_lazy_sections():
+    encoded = bytearray(encode_tx(_tx(num_inputs=3)))
+    # garbage in the bodies of the unlock data (their sizes stay valid) is only found once they are read
+    at = encoded.index(b'\x01\x04data')
+    encoded[at:at + 10] = b'\xff' * 10
+    view = decode_tx(bytes(encoded))
+    _check_amounts(view)
+    assert view.inputs[2].outpoints[0].amount == 1000
+    with pytest.raises(ValueError, match='LEB128 value too large'):
+        view.unlock_data[0]
+
+
+@pytest.mark.parametrize('encoded, message', [
+    (b'', 'Unexpected end of transaction'),
+    (b'\x02', 'Unsupported transaction version 2'),
+    (encode_tx(_tx()) + b'\x00', 'Trailing bytes after transaction'),
+    # sections: inputs with one item that is longer than the section
+    (b'\x01\x02\x01\x05\x00\x01\x00\x01\x00\x01\x00\x01\x00', 'Unexpected end of transaction'),
+    # inputs section claiming 2**27 items in 4 bytes
+    (b'\x01\x04\x80\x80\x80\x40' + b'\x01\x00' * 4, 'Unexpected end of transaction'),
+    # outputs section with a trailing byte after its only item
+    (b'\x01\x01\x00\x24\x01\x21' + bytes(33) + b'\x00' + b'\x01\x00' * 3, 'Trailing bytes in section'),
+])
+def test_invalid_framing(encoded: bytes, message: str):
+    with pytest.raises(ValueError, match=message):
+        decode_tx(encoded)
+
+
+@pytest.mark.parametrize('output, message', [
+    # amount 0 encoded with a redundant continuation byte
+    (b'\x80\x00' + bytes(32), 'Non-canonical LEB128 value'),
+    (b'\x00' + bytes(32) + b'\x00', 'Trailing bytes in item'),
+    (b'\xff' * 9 + b'\x7f' + bytes(32), 'LEB128 value too large'),
+    (b'\x00' + bytes(31), 'Unexpected end of transaction'),
+])
+def test_invalid_items(output: bytes, message: str):
+    section = bytes([1, len(output)]) + output
+    view = decode_tx(b'\x01\x01\x00' + bytes([len(section)]) + section + b'\x01\x00' * 3)
+    with pytest.raises(ValueError, match=message):
+        view.outputs[0]
+
+
+@pytest.mark.parametrize('tx, message', [
+    (_tx()._replace(outputs=[Output(1, bytes(20))]), 'Expected a 32 byte hash, got 20 bytes'),
+    (_tx()._replace(outputs=[Output(-1, bytes(32))]), 'Cannot encode -1 as an unsigned 64 bit integer'),
+    (_tx()._replace(signatures=[Signature(1 << 64, 0, b'')]), 'as an unsigned 64 bit integer'),
+])
+def test_invalid_tx(tx: Tx, message: str):
+    with pytest.raises(ValueError, match=message):
+        encode_tx(tx)
+
+
+def test_lazy_list():
+    view = decode_tx(encode_tx(_tx(num_inputs=3)))
+    assert len(view.inputs) == 3
+    assert view.inputs[-1] is view.inputs[2]
+    assert view.inputs[1:] == [view.inputs[1], view.inputs[2]]
+    with pytest.raises(IndexError):
+        view.inputs[3]
@@ -0,0 +1,150 @@
+import pytest
+
+import programs
+from bytecode import MAGIC, VERSION, encode
+from lang.parse import Compiler
+from merkle import MerkleCache, merkle_levels, merkle_path
+from tx import Tx, Input, Output, UnlockData, Outpoint
+from tx_encoding import decode_tx, encode_tx
+from program_cache import ProgramCache
+from verify import verify_tx, verify_txs, ParallelVerifier
+from vm import CostLimitExceeded
+
+
+def _tx(bytecodes, loop_trees: bytes, output_amount: int = 900) -> Tx:
+    return Tx(
+        inputs=[
+            Input(
+                outpoints=[Outpoint(tx_hash=bytes(32), idx=0, amount=1000, constraints=[], carryover=b'')],
+                bytecode_merkle_path=[],
+                bytecode=bytecode,
+            )
+            for bytecode in bytecodes
+        ],
+        outputs=[Output(amount=output_amount, bytecode_merkle_root=bytes(32))],
+        preambles=[],
+        unlock_data=[UnlockData(data=[], loop_trees=loop_trees, ram_size=0) for _ in bytecodes],
+        signatures=[],
+    )
+
+
+def test_verify_source_and_binary():
+    src = programs.FIB.encode('ascii')
+    binary = encode(Compiler().compile(programs.FIB))
+    verify_tx(_tx([src, binary], loop_trees=bytes.fromhex('000a')), ProgramCache())
+
+
+def test_verify_binary_does_not_compile(monkeypatch):
+    binary = encode(Compiler().compile(programs.FIB))
+
+    def fail(*args):
+        raise AssertionError('Compiler used')
+
+    monkeypatch.setattr(Compiler, '__init__', fail)
+    verify_tx(_tx([binary], loop_trees=bytes.fromhex('000a')), ProgramCache())
+
+
+def test_verify_decoded():
+    src = programs.FIB.encode('ascii')
+    binary = encode(Compiler().compile(programs.FIB))
+    verify_tx(decode_tx(encode_tx(_tx([src, binary], loop_trees=bytes.fromhex('000a')))), ProgramCache())
+
+
+def test_verify_indexed_loop_trees():
+    binary = encode(Compiler().compile(programs.FIB))
+    # the second tree isn't started, so its invalid kind isn't decoded
+    verify_tx(_tx([binary], loop_trees=bytes.fromhex('ff' '02000a' '020300')), ProgramCache())
+    with pytest.raises(ValueError, match='Invalid loop tree kind 3'):
+        verify_tx(_tx([binary], loop_trees=bytes.fromhex('ff' '02030a')), ProgramCache())
+
+
+def test_verify_merkle_paths():
+    binary = encode(Compiler().compile(programs.FIB))
+    levels = merkle_levels([b'other contract', binary, b'third contract'])
+    tx = _tx([binary, binary], loop_trees=bytes.fromhex('000a'))
+    tx = tx._replace(inputs=[tx_input._replace(bytecode_merkle_path=merkle_path(levels, 1)) for tx_input in tx.inputs])
+    root = levels[-1][0]
+    cache = MerkleCache()
+    verify_tx(tx, ProgramCache(), spent_outputs=lambda outpoint: Output(1000, root), merkle_cache=cache)
+    # the second input hits the path verified for the first one
+    assert cache.stats().hits == 1
+    with pytest.raises(ValueError, match='Bytecode is not in the merkle tree of the spent output'):
+        verify_tx(tx, ProgramCache(), spent_outputs=lambda outpoint: Output(1000, bytes(32)))
+    # without the spent outputs the paths aren't checked
+    verify_tx(tx, ProgramCache())
+    src = programs.FIB.encode('ascii')
+    invalid_tx = tx._replace(inputs=tx.inputs[:1] + [tx.inputs[1]._replace(bytecode=src)])
+    valid, invalid = verify_txs([tx, invalid_tx], max_workers=1, spent_outputs=lambda outpoint: Output(1000, root))
+    assert valid is None
+    assert 'Bytecode is not in the merkle tree of the spent output' == str(invalid)
+
+
+def test_verify_amounts():
+    with pytest.raises(ValueError) as ex:
+        verify_tx(_tx([b''], loop_trees=b'', output_amount=1001), ProgramCache())
+    assert 'Output amounts exceeds input amounts' == str(ex.value)
+
+
+def test_verify_uses_cache():
+    cache = ProgramCache()
+    src = programs.FIB.encode('ascii')
+    binary = encode(Compiler().compile(programs.FIB))
+    for _ in range(3):
+        verify_tx(_tx([src, binary, src], loop_trees=bytes.fromhex('000a')), cache)
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.entries) == (7, 2, 2)
+
+
+def test_verify_cost():
+    binary = encode(Compiler().compile(programs.FIB))
+    tx = _tx([binary, binary], loop_trees=bytes.fromhex('000a'))
+    cost = verify_tx(tx, ProgramCache())
+    input_cost, other = cost.inputs
+    assert input_cost == other > 10
+    assert (cost.preambles, cost.total) == ([], 2 * input_cost)
+    assert verify_tx(tx, ProgramCache(), input_budget=input_cost, tx_budget=2 * input_cost) == cost
+    assert verify_tx(tx, ProgramCache(), input_budget=None, tx_budget=None) == cost
+    with pytest.raises(CostLimitExceeded, match=f'Execution cost exceeds the budget of {input_cost - 1}'):
+        verify_tx(tx, ProgramCache(), input_budget=input_cost - 1)
+    with pytest.raises(CostLimitExceeded, match=f'Transaction execution cost exceeds the budget of {cost.total - 1}'):
+        verify_tx(tx, ProgramCache(), tx_budget=cost.total - 1)
+    # a huge loop tree is cut off by the budget
+    with pytest.raises(CostLimitExceeded):
+        verify_tx(_tx([binary], loop_trees=bytes.fromhex('00ffffffffffffffff7f')), ProgramCache())
+    errors = verify_txs([tx], max_workers=1, input_budget=input_cost, tx_budget=cost.total - 1)
+    assert [str(error) for error in errors] == [f'Transaction execution cost exceeds the budget of {cost.total - 1}']
+    assert verify_txs([tx], max_workers=1, input_budget=input_cost, tx_budget=cost.total) == [None]
+
+
+def test_verify_charges_locals():
+    # 60000 locals and an empty block
+    binary = MAGIC + bytes([VERSION]) + bytes.fromhex('e0d403' '00')
+    assert verify_tx(_tx([binary], loop_trees=b''), ProgramCache()).total == 60000 * 8 // 64
+    with pytest.raises(CostLimitExceeded):
+        verify_tx(_tx([binary], loop_trees=b''), ProgramCache(), input_budget=1000)
+
+
+def test_verify_txs():
+    src = programs.FIB.encode('ascii')
+    binary = encode(Compiler().compile(programs.FIB))
+    unreachable = b'version 0.0.1; unreachable();'
+    txs = [
+        _tx([src, binary], loop_trees=bytes.fromhex('000a')),
+        _tx([binary, unreachable, binary], loop_trees=bytes.fromhex('000a')),
+        _tx([binary], loop_trees=bytes.fromhex('000a'), output_amount=1001),
+    ]
+    # decoded transactions verify like the ones they were encoded from
+    txs += [decode_tx(encode_tx(tx)) for tx in txs]
+    valid, unreachable_error, amount_error, *decoded_errors = verify_txs(txs, max_workers=2)
+    assert [str(error) if error else None for error in decoded_errors] == \
+        [None, 'Reached unreachable code', 'Output amounts exceeds input amounts']
+    assert valid is None
+    assert 'Reached unreachable code' == str(unreachable_error)
+    assert 'Output amounts exceeds input amounts' == str(amount_error)
+
+
+def test_parallel_verifier_reuses_pool():
+    binary = encode(Compiler().compile(programs.FIB))
+    with ParallelVerifier(max_workers=1) as verifier:
+        for _ in range(3):
+            assert verifier.verify_txs([_tx([binary] * 4, loop_trees=bytes.fromhex('000a'))]) == [None]
@@ -0,0 +1,305 @@
+"""
+Canonical binary encoding of transactions.
+
+    tx:       VERSION section{inputs} section{outputs} section{preambles} section{unlock_data} section{signatures}
+    section:  size:uleb num_items:uleb item*
+    item:     size:uleb body
+
+    input:       num_outpoints:uleb outpoint* num_branches:uleb (side:u8 hash:32)* bytecode:bytes
+    outpoint:    tx_hash:32 idx:uleb amount:uleb num_constraints:uleb (type:u8 payload:bytes)* carryover:bytes
+    output:      amount:uleb bytecode_merkle_root:32
+    preamble:    the bytecode itself
+    unlock_data: num_data:uleb data:bytes* loop_trees:bytes ram_size:uleb
+    signature:   sig_flags:uleb num_covered_checks:uleb signature:bytes
+    bytes:       length:uleb byte*
+
+Integers are unsigned LEB128 in their shortest form, so every transaction has exactly one encoding.
+
+decode_tx doesn't decode anything up front: it checks the section framing and returns a TxView, whose lists decode
+an item when it is first read. Sections and items are prefixed with their size so the others can be skipped, e.g.
+checking the amounts doesn't touch bytecode or unlock data. Bytes fields are memoryviews into the encoded buffer.
+"""
+from typing import Callable, Generic, Iterator, List, Optional, Sequence, TypeVar, Union, overload
+
+from tx import Constraint, ConstraintType, Input, MerkleBranch, MerkleSide, Outpoint, Output, Signature, Tx, \
+    UnlockData
+
+VERSION = 1
+HASH_SIZE = 32
+MAX_UINT = (1 << 64) - 1
+
+Buffer = Union[bytes, bytearray, memoryview]
+T = TypeVar('T')
+
+
+class _Reader:
+    def __init__(self, view: memoryview) -> None:
+        self._view = view
+        self._pos = 0
+
+    def at_end(self) -> bool:
+        return self._pos == len(self._view)
+
+    def byte(self) -> int:
+        if self._pos >= len(self._view):
+            raise ValueError('Unexpected end of transaction')
+        b = self._view[self._pos]
+        self._pos += 1
+        return b
+
+    def uleb(self) -> int:
+        view, pos = self._view, self._pos
+        result = 0
+        shift = 0
+        while True:
+            if pos >= len(view):
+                raise ValueError('Unexpected end of transaction')
+            b = view[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                if b == 0 and shift > 0:
+                    raise ValueError('Non-canonical LEB128 value')
+                break
+            shift += 7
+            if shift > 63:
+                raise ValueError('LEB128 value too large')
+        if result > MAX_UINT:
+            raise ValueError('LEB128 value too large')
+        self._pos = pos
+        return result
+
+    def take(self, size: int) -> memoryview:
+        end = self._pos + size
+        if end > len(self._view):
+            raise ValueError('Unexpected end of transaction')
+        data = self._view[self._pos:end]
+        self._pos = end
+        return data
+
+    def bytes(self) -> memoryview:
+        return self.take(self.uleb())
+
+    def remaining(self) -> int:
+        return len(self._view) - self._pos
+
+
+class LazyList(Sequence[T], Generic[T]):
+    """
+    Items of a section, each decoded from its bytes when it is first read.
+    """
+
+    def __init__(self, view: memoryview, decode_item: Callable[[memoryview], T]) -> None:
+        self._reader = _Reader(view)
+        self._decode_item = decode_item
+        self._len = self._reader.uleb()
+        # every item has at least its size byte, a larger count can't be framed and isn't allocated
+        if self._len > self._reader.remaining():
+            raise ValueError('Unexpected end of transaction')
+        # bytes of the items found so far, and the items decoded so far
+        self._bodies: List[memoryview] = []
+        self._items: List[Optional[T]] = [None] * self._len
+
+    def __len__(self) -> int:
+        return self._len
+
+    @overload
+    def __getitem__(self, idx: int) -> T: ...
+
+    @overload
+    def __getitem__(self, idx: slice) -> List[T]: ...
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self._len))]
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError('Item index out of range')
+        item = self._items[idx]
+        if item is None:
+            item = self._items[idx] = self._decode_item(self._body(idx))
+        return item
+
+    def __iter__(self) -> Iterator[T]:
+        for idx in range(self._len):
+            yield self[idx]
+
+    def _body(self, idx: int) -> memoryview:
+        bodies, reader = self._bodies, self._reader
+        while len(bodies) <= idx:
+            bodies.append(reader.bytes())
+        return bodies[idx]
+
+    def check_framing(self) -> None:
+        """
+        Finds the bytes of all items without decoding them, raises if they don't fill the section exactly.
+        """
+        if self._len:
+            self._body(self._len - 1)
+        if not self._reader.at_end():
+            raise ValueError('Trailing bytes in section')
+
+
+class TxView:
+    """
+    A transaction decoded lazily from its encoding. It has the fields of Tx and can be verified like one; to_tx()
+    decodes all of it.
+    """
+
+    def __init__(self, data: Buffer) -> None:
+        reader = _Reader(memoryview(data))
+        version = reader.byte()
+        if version != VERSION:
+            raise ValueError(f'Unsupported transaction version {version}')
+        self.inputs: LazyList[Input] = LazyList(reader.bytes(), _decode_item(_input))
+        self.outputs: LazyList[Output] = LazyList(reader.bytes(), _decode_item(_output))
+        self.preambles: LazyList[memoryview] = LazyList(reader.bytes(), lambda body: body)
+        self.unlock_data: LazyList[UnlockData] = LazyList(reader.bytes(), _decode_item(_unlock_data))
+        self.signatures: LazyList[Signature] = LazyList(reader.bytes(), _decode_item(_signature))
+        if not reader.at_end():
+            raise ValueError('Trailing bytes after transaction')
+        for section in (self.inputs, self.outputs, self.preambles, self.unlock_data, self.signatures):
+            section.check_framing()
+
+    def to_tx(self) -> Tx:
+        return Tx(list(self.inputs), list(self.outputs), list(self.preambles), list(self.unlock_data),
+                  list(self.signatures))
+
+
+def decode_tx(data: Buffer) -> TxView:
+    return TxView(data)
+
+
+def _decode_item(decode: Callable[[_Reader], T]) -> Callable[[memoryview], T]:
+    def decode_body(body: memoryview) -> T:
+        reader = _Reader(body)
+        item = decode(reader)
+        if not reader.at_end():
+            raise ValueError('Trailing bytes in item')
+        return item
+    return decode_body
+
+
+def _hash(reader: _Reader) -> memoryview:
+    return reader.take(HASH_SIZE)
+
+
+def _outpoint(reader: _Reader) -> Outpoint:
+    tx_hash = _hash(reader)
+    idx = reader.uleb()
+    amount = reader.uleb()
+    constraints = []
+    for _ in range(reader.uleb()):
+        constraint_type = reader.byte()
+        try:
+            constraint_type = ConstraintType(constraint_type)
+        except ValueError:
+            raise ValueError(f'Invalid constraint type {constraint_type}') from None
+        constraints.append(Constraint(constraint_type, reader.bytes()))
+    return Outpoint(tx_hash, idx, amount, constraints, reader.bytes())
+
+
+def _input(reader: _Reader) -> Input:
+    outpoints = [_outpoint(reader) for _ in range(reader.uleb())]
+    path = []
+    for _ in range(reader.uleb()):
+        side = reader.byte()
+        try:
+            side = MerkleSide(side)
+        except ValueError:
+            raise ValueError(f'Invalid merkle side {side}') from None
+        path.append(MerkleBranch(side, _hash(reader)))
+    return Input(outpoints, path, reader.bytes())
+
+
+def _output(reader: _Reader) -> Output:
+    return Output(reader.uleb(), _hash(reader))
+
+
+def _unlock_data(reader: _Reader) -> UnlockData:
+    data = [reader.bytes() for _ in range(reader.uleb())]
+    return UnlockData(data, reader.bytes(), reader.uleb())
+
+
+def _signature(reader: _Reader) -> Signature:
+    return Signature(reader.uleb(), reader.uleb(), reader.bytes())
+
+
+def _uleb(out: bytearray, value: int) -> None:
+    if not 0 <= value <= MAX_UINT:
+        raise ValueError(f'Cannot encode {value} as an unsigned 64 bit integer')
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _bytes(out: bytearray, data: Buffer) -> None:
+    _uleb(out, len(data))
+    out += data
+
+
+def _encode_hash(out: bytearray, data: Buffer) -> None:
+    if len(data) != HASH_SIZE:
+        raise ValueError(f'Expected a {HASH_SIZE} byte hash, got {len(data)} bytes')
+    out += data
+
+
+def _encode_input(out: bytearray, tx_input: Input) -> None:
+    _uleb(out, len(tx_input.outpoints))
+    for outpoint in tx_input.outpoints:
+        _encode_hash(out, outpoint.tx_hash)
+        _uleb(out, outpoint.idx)
+        _uleb(out, outpoint.amount)
+        _uleb(out, len(outpoint.constraints))
+        for constraint in outpoint.constraints:
+            out.append(constraint.constraint_type.value)
+            _bytes(out, constraint.payload)
+        _bytes(out, outpoint.carryover)
+    _uleb(out, len(tx_input.bytecode_merkle_path))
+    for branch in tx_input.bytecode_merkle_path:
+        out.append(branch.side.value)
+        _encode_hash(out, branch.branch_hash)
+    _bytes(out, tx_input.bytecode)
+
+
+def _encode_output(out: bytearray, output: Output) -> None:
+    _uleb(out, output.amount)
+    _encode_hash(out, output.bytecode_merkle_root)
+
+
+def _encode_unlock_data(out: bytearray, unlock_data: UnlockData) -> None:
+    _uleb(out, len(unlock_data.data))
+    for data in unlock_data.data:
+        _bytes(out, data)
+    _bytes(out, unlock_data.loop_trees)
+    _uleb(out, unlock_data.ram_size)
+
+
+def _encode_signature(out: bytearray, signature: Signature) -> None:
+    _uleb(out, signature.sig_flags)
+    _uleb(out, signature.num_covered_checks)
+    _bytes(out, signature.signature)
+
+
+def _encode_section(out: bytearray, items: Sequence[T], encode_item: Callable[[bytearray, T], None]) -> None:
+    section = bytearray()
+    _uleb(section, len(items))
+    body = bytearray()
+    for item in items:
+        del body[:]
+        encode_item(body, item)
+        _bytes(section, body)
+    _bytes(out, section)
+
+
+def encode_tx(tx: Union[Tx, TxView]) -> bytes:
+    out = bytearray()
+    out.append(VERSION)
+    _encode_section(out, tx.inputs, _encode_input)
+    _encode_section(out, tx.outputs, _encode_output)
+    _encode_section(out, tx.preambles, lambda body, preamble: body.extend(preamble))
+    _encode_section(out, tx.unlock_data, _encode_unlock_data)
+    _encode_section(out, tx.signatures, _encode_signature)
+    return bytes(out)
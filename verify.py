@@ -1,37 +1,216 @@
-from lang.parse import Compiler
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from bytecode import is_binary, decode
+from lang.parse import Compiler, CompileResult
 from loop_stack import LoopStack
-from loop_tree import parse_loop_trees
-from op import Block
-from tx import Tx
-from vm import VM
-import io
+from loop_tree import load_loop_trees
+from merkle import MerkleCache
+from program_cache import ProgramCache, CachedProgram
+from tx import Outpoint, Output, Tx, UnlockData
+from vm import VM, CostLimitExceeded
+
+default_program_cache = ProgramCache()
+default_merkle_cache = MerkleCache()
+
+# execution cost budgets (see Instruction.cost) of each input or preamble and of a whole transaction; None is unlimited
+DEFAULT_INPUT_BUDGET = 1_000_000
+DEFAULT_TX_BUDGET = 4_000_000
+
+# looks up the output an outpoint spends
+SpentOutputs = Callable[[Outpoint], Output]
+
+
+class ProgramLoader:
+    """
+    Loads input and preamble bytecode: binary programs are decoded directly, only source needs the compiler.
+    """
+
+    def __init__(self, cache: ProgramCache) -> None:
+        self._cache = cache
+        self._compiler: Optional[Compiler] = None
+
+    def load(self, bytecode: bytes) -> CachedProgram:
+        return self._cache.get(bytecode, self._load)
+
+    def _load(self, bytecode: bytes) -> CompileResult:
+        if is_binary(bytecode):
+            return decode(bytecode)
+        if self._compiler is None:
+            self._compiler = Compiler()
+        return self._compiler.compile(str(bytecode, 'ascii'))
+
 
+class TxCost(NamedTuple):
+    """
+    Execution cost of a verified transaction: of each input, of each preamble and in total.
+    """
+    inputs: List[int]
+    preambles: List[int]
+    total: int
 
-def verify_tx(tx: Tx) -> None:
-    compiler = Compiler()
 
+def run_program(program: CachedProgram, unlock_data: UnlockData, budget: Optional[int] = None) -> int:
+    """
+    Runs the program, returns its execution cost. Raises CostLimitExceeded if it costs more than budget.
+    """
+    loop_stack = LoopStack(load_loop_trees(unlock_data.loop_trees))
+    vm = VM(loop_stack, program.compile_result.num_locals, unlock_data.ram_size, budget=budget, metered=True)
+    program.block.run(vm)
+    return vm.cost()
+
+
+def _tx_cost_exceeded(tx_budget: int) -> CostLimitExceeded:
+    return CostLimitExceeded(f'Transaction execution cost exceeds the budget of {tx_budget}')
+
+
+def _check_amounts(tx: Tx) -> None:
     input_sum = sum(sum(outpoint.amount for outpoint in tx_input.outpoints) for tx_input in tx.inputs)
     output_sum = sum(output.amount for output in tx.outputs)
-
     if output_sum > input_sum:
         raise ValueError('Output amounts exceeds input amounts')
 
-    for input_idx, tx_input in enumerate(tx.inputs):
-        witness = tx.witnesses[input_idx]
-        loop_trees = parse_loop_trees(io.BytesIO(witness.loop_trees))
-        loop_stack = LoopStack(loop_trees)
-        src = tx_input.bytecode.decode('ascii')
-        compile_result = compiler.compile(src)
-        vm = VM(loop_stack, compile_result.num_locals, witness.ram_size)
-        instructions = Block(compile_result.instructions)
-        instructions.run(vm)
-
-    for preamble_idx, preamble in enumerate(tx.preambles):
-        witness = tx.witnesses[len(tx.inputs)+preamble_idx]
-        loop_trees = parse_loop_trees(io.BytesIO(witness.loop_trees))
-        loop_stack = LoopStack(loop_trees)
-        src = preamble.decode('ascii')
-        compile_result = compiler.compile(src)
-        vm = VM(loop_stack, compile_result.num_locals, witness.ram_size)
-        instructions = Block(compile_result.instructions)
-        instructions.run(vm)
+
+def _check_merkle_paths(tx: Tx, spent_outputs: SpentOutputs, cache: MerkleCache) -> None:
+    for tx_input in tx.inputs:
+        roots = {bytes(spent_outputs(outpoint).bytecode_merkle_root) for outpoint in tx_input.outpoints}
+        for root in roots:
+            cache.verify(tx_input.bytecode, tx_input.bytecode_merkle_path, root)
+
+
+def _tx_programs(tx: Tx) -> List[Tuple[bytes, UnlockData]]:
+    programs = [(tx_input.bytecode, tx.unlock_data[input_idx]) for input_idx, tx_input in enumerate(tx.inputs)]
+    programs.extend((preamble, tx.unlock_data[len(tx.inputs) + preamble_idx])
+                    for preamble_idx, preamble in enumerate(tx.preambles))
+    return programs
+
+
+def verify_tx(tx: Tx, cache: Optional[ProgramCache] = None, spent_outputs: Optional[SpentOutputs] = None,
+              merkle_cache: Optional[MerkleCache] = None, input_budget: Optional[int] = DEFAULT_INPUT_BUDGET,
+              tx_budget: Optional[int] = DEFAULT_TX_BUDGET) -> TxCost:
+    """
+    Raises if tx is invalid, returns its execution cost otherwise. The bytecode of each input is checked against the
+    merkle roots of the outputs it spends if spent_outputs is given.
+
+    Each input and preamble may cost at most input_budget, all of them together at most tx_budget; running a program
+    stops with CostLimitExceeded as soon as it exceeds either.
+    """
+    loader = ProgramLoader(cache if cache is not None else default_program_cache)
+
+    _check_amounts(tx)
+    if spent_outputs is not None:
+        _check_merkle_paths(tx, spent_outputs, merkle_cache if merkle_cache is not None else default_merkle_cache)
+    costs = []
+    total = 0
+    for bytecode, unlock_data in _tx_programs(tx):
+        remaining = tx_budget - total if tx_budget is not None else None
+        limited_by_tx = remaining is not None and (input_budget is None or remaining < input_budget)
+        try:
+            cost = run_program(loader.load(bytecode), unlock_data, remaining if limited_by_tx else input_budget)
+        except CostLimitExceeded:
+            if limited_by_tx:
+                raise _tx_cost_exceeded(tx_budget) from None
+            raise
+        costs.append(cost)
+        total += cost
+    return TxCost(costs[:len(tx.inputs)], costs[len(tx.inputs):], total)
+
+
+_worker_loader: Optional[ProgramLoader] = None
+
+
+def _owned(unlock_data: UnlockData) -> UnlockData:
+    return UnlockData([bytes(data) for data in unlock_data.data], bytes(unlock_data.loop_trees), unlock_data.ram_size)
+
+
+def _run_in_worker(bytecode: bytes, unlock_data: UnlockData, budget: Optional[int]) -> int:
+    # each worker process loads through its own default_program_cache
+    global _worker_loader
+    if _worker_loader is None:
+        _worker_loader = ProgramLoader(default_program_cache)
+    return run_program(_worker_loader.load(bytecode), unlock_data, budget)
+
+
+class ParallelVerifier:
+    """
+    Verifies batches of transactions on a process pool. Every input and preamble of every transaction is a separate
+    job, so the work of one large transaction is spread over all workers too. Once a job of a transaction fails, its
+    jobs that haven't started yet are cancelled.
+
+    The pool is kept between batches (and with it the program cache of each worker); close it with close() or use the
+    verifier as a context manager.
+
+    Jobs run in parallel, so each one is only limited by input_budget; the transaction fails with CostLimitExceeded
+    if their costs add up to more than tx_budget. That accepts and rejects the same transactions as verify_tx.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, executor: Optional[Executor] = None,
+                 merkle_cache: Optional[MerkleCache] = None, input_budget: Optional[int] = DEFAULT_INPUT_BUDGET,
+                 tx_budget: Optional[int] = DEFAULT_TX_BUDGET) -> None:
+        self._owns_executor = executor is None
+        self._executor = executor if executor is not None else ProcessPoolExecutor(max_workers)
+        self._merkle_cache = merkle_cache if merkle_cache is not None else default_merkle_cache
+        self._input_budget = input_budget
+        self._tx_budget = tx_budget
+
+    def verify_txs(self, txs: Sequence[Tx], spent_outputs: Optional[SpentOutputs] = None) -> List[Optional[Exception]]:
+        """
+        Returns one entry per transaction, None if it is valid, otherwise the error that made it fail. If several of
+        its inputs fail, it's the one that failed first. Merkle paths are checked here, before any job is submitted,
+        if spent_outputs is given.
+        """
+        errors: List[Optional[Exception]] = [None] * len(txs)
+        costs = [0] * len(txs)
+        futures: Dict[Future, int] = {}
+        tx_futures: List[List[Future]] = [[] for _ in txs]
+        for tx_idx, tx in enumerate(txs):
+            try:
+                _check_amounts(tx)
+                if spent_outputs is not None:
+                    _check_merkle_paths(tx, spent_outputs, self._merkle_cache)
+                programs = _tx_programs(tx)
+            except Exception as ex:
+                errors[tx_idx] = ex
+                continue
+            for bytecode, unlock_data in programs:
+                # fields of decoded transactions are memoryviews, which can't be pickled
+                future = self._executor.submit(_run_in_worker, bytes(bytecode), _owned(unlock_data),
+                                               self._input_budget)
+                futures[future] = tx_idx
+                tx_futures[tx_idx].append(future)
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            error = future.exception()
+            tx_idx = futures[future]
+            if error is None:
+                costs[tx_idx] += future.result()
+                if self._tx_budget is None or costs[tx_idx] <= self._tx_budget:
+                    continue
+                error = _tx_cost_exceeded(self._tx_budget)
+            if errors[tx_idx] is None:
+                errors[tx_idx] = error
+                for other in tx_futures[tx_idx]:
+                    other.cancel()
+        return errors
+
+    def close(self) -> None:
+        if self._owns_executor:
+            self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self) -> 'ParallelVerifier':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def verify_txs(txs: Sequence[Tx], max_workers: Optional[int] = None, spent_outputs: Optional[SpentOutputs] = None,
+               input_budget: Optional[int] = DEFAULT_INPUT_BUDGET,
+               tx_budget: Optional[int] = DEFAULT_TX_BUDGET) -> List[Optional[Exception]]:
+    """
+    Verifies a batch of transactions on a fresh process pool with max_workers processes (default: one per core), see
+    ParallelVerifier.
+    """
+    with ParallelVerifier(max_workers, input_budget=input_budget, tx_budget=tx_budget) as verifier:
+        return verifier.verify_txs(txs, spent_outputs)
@@ -1,14 +1,46 @@
-from belt import Belt, BeltNum, DataType, Integer, BeltSlice, BeltItem
+from typing import Any, Dict, Optional
+
+from belt import Belt, BeltNum, DataType, BeltSlice, BeltItem
+from hooks import Hook
 from loop_stack import LoopStack
 
 
+class CostLimitExceeded(ValueError):
+    """
+    Raised when running a program costs more than the budget of its VM.
+    """
+
+
 class VM:
-    def __init__(self, loop_stack: LoopStack, num_locals: int, ram_size: int):
+    # incremental hash states a program can have open at once
+    MAX_OPEN_HASHES = 64
+    # work on bytes (RAM, hashing, bulk slice ops) costs one unit per started chunk of this many bytes; hashing with
+    # the pure-Python RIPEMD-160 (ops/digest.py), used when hashlib lacks it, costs Ripemd160.COST_FACTOR times more
+    BYTES_PER_COST = 64
+    # bytes charged per local (a reference)
+    LOCAL_SIZE = 8
+
+    def __init__(self, loop_stack: LoopStack, num_locals: int, ram_size: int, hook: Optional[Hook] = None,
+                 budget: Optional[int] = None, metered: bool = False):
+        """
+        A metered VM (metered, or with a budget) is charged by the reference engine (Block.run) the cost of each
+        instruction and loop iteration it runs; execution stops with CostLimitExceeded once the total exceeds the
+        budget.
+        """
+        self._budget = budget
+        self._metered = metered or budget is not None
+        self._cost = 0
+        # locals and RAM are charged when the VM is created, before they are allocated
+        self.charge_bytes(num_locals * self.LOCAL_SIZE)
+        self.charge_bytes(ram_size)
         self._belt = Belt()
         self._loop_stack = loop_stack
-        self._locals = [BeltNum(data_type=DataType.I8, value=Integer(0))] * num_locals
-        self._ram = BeltSlice(bytearray(ram_size), 0, ram_size)
+        self._locals = [BeltNum.of(DataType.I8, 0)] * num_locals
+        self._ram = BeltSlice.over(bytearray(ram_size))
         self._alignment = 0
+        self._hook = hook
+        self._hashes: Dict[int, Any] = {}
+        self._next_hash = 0
 
     def belt(self) -> Belt:
         return self._belt
@@ -16,6 +48,9 @@ class VM:
     def loop_stack(self) -> LoopStack:
         return self._loop_stack
 
+    def num_locals(self) -> int:
+        return len(self._locals)
+
     def local(self, local_idx: int) -> BeltItem:
         return self._locals[local_idx]
 
@@ -25,8 +60,58 @@ class VM:
     def ram(self) -> BeltSlice:
         return self._ram
 
+    def open_hash(self, state: Any) -> int:
+        """
+        Keeps the incremental hash state, returns its handle. Handles aren't reused after a state is closed.
+        """
+        if len(self._hashes) >= self.MAX_OPEN_HASHES:
+            raise ValueError('Too many open hashes')
+        handle = self._next_hash
+        self._hashes[handle] = state
+        self._next_hash += 1
+        return handle
+
+    def hash_state(self, handle: int) -> Any:
+        state = self._hashes.get(handle)
+        if state is None:
+            raise ValueError('Invalid hash handle')
+        return state
+
+    def close_hash(self, handle: int) -> None:
+        del self._hashes[handle]
+
+    def budget(self) -> Optional[int]:
+        return self._budget
+
+    def metered(self) -> bool:
+        return self._metered
+
+    def cost(self) -> int:
+        """
+        Cost charged so far.
+        """
+        return self._cost
+
+    def charge(self, cost: int) -> None:
+        self._cost += cost
+        if self._budget is not None and self._cost > self._budget:
+            raise CostLimitExceeded(f'Execution cost exceeds the budget of {self._budget}')
+
+    def charge_bytes(self, num_bytes: int) -> None:
+        """
+        Charges a metered VM for work over num_bytes bytes, before doing it.
+        """
+        if self._metered:
+            self.charge(-(-num_bytes // self.BYTES_PER_COST))
+
     def alignment(self) -> int:
         return self._alignment
 
     def set_alignment(self, alignment: int) -> None:
         self._alignment = alignment
+
+    def hook(self) -> Optional[Hook]:
+        return self._hook
+
+    def set_hook(self, hook: Optional[Hook]) -> None:
+        self._hook = hook